@@ -1,33 +1,227 @@
 #!/usr/bin/env python3
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
-import subprocess
 import os
-import json
 import threading
-import shutil
 import time
+import queue
 
-# Punto de montaje temporal para el USB
-TEMP_MOUNT_POINT = "/mnt/multiboot_usb_creator_temp"
+from multiboot_engine import (
+    DeviceProber,
+    EngineListener,
+    IsoLibrary,
+    IsoLibraryIndex,
+    LogSink,
+    format_size,
+    MultibootEngine,
+    OperationCancelled,
+    UsbInventory,
+    format_time_remaining,
+    missing_dependencies,
+    partition_path_for,
+)
 
+# Cada cuánto vuelca la interfaz el log pendiente (ms) y cuántas líneas por vez
+LOG_DRAIN_INTERVAL_MS = 100
+LOG_DRAIN_BATCH = 500
+# Líneas que conserva el área de log; las más antiguas se borran
+LOG_MAX_LINES = 2000
+# Cada cuánto se muestrea y repinta el progreso de las copias (ms)
+PROGRESS_SAMPLE_MS = 500
+# Al cerrar con una operación en curso: cada cuánto se comprueba si ya terminó
+# su limpieza (ms) y cuánto se espera como máximo (s)
+CLOSE_POLL_MS = 100
+CLOSE_TIMEOUT_SECONDS = 5.0
+# Filas visibles de las tablas de ISOs (solo se crean esas, aunque haya miles)
+CREATE_TABLE_ROWS = 6
+MANAGE_TABLE_ROWS = 8
+LIBRARY_TABLE_ROWS = 12
+# Caracteres del SHA-256 que se muestran en las tablas
+HASH_DISPLAY_CHARS = 12
+# Columnas comunes de las tablas de ISOs: (id, título, ancho, alineación)
+ISO_TABLE_COLUMNS = (
+    ("nombre", "Nombre", 260, "w"),
+    ("tamano", "Tamaño", 70, "e"),
+    ("perfil", "Perfil", 90, "w"),
+    ("sha256", "SHA-256", 110, "w"),
+)
 
-def format_time_remaining(seconds):
-    """Formatea segundos a un string HH:MM:SS o MM:SS."""
-    if seconds is None or seconds == float("inf") or seconds < 0:
-        return "Calculando..."
-    if seconds < 1 and seconds > 0:
-        return "< 1 seg"
 
-    seconds = int(seconds)
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    secs = seconds % 60
+class TkEngineListener(EngineListener):
+    """Lleva los eventos del motor a la ventana (siempre desde el hilo de Tk).
 
-    if hours > 0:
-        return f"{hours:02d}:{minutes:02d}:{secs:02d}"
-    else:
-        return f"{minutes:02d}:{secs:02d}"
+    El motor los emite desde sus hilos de trabajo; Tk no es seguro entre
+    hilos, así que todo lo que toca la ventana pasa por `root.after`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def log(self, message):
+        self.app.log_message(message)
+
+    def device_status(self, device_path, phase=None, progress=None):
+        self.app.root.after(
+            0, self.app._update_device_status, device_path, phase, progress
+        )
+
+    def confirm(self, title, message):
+        """Pregunta en el hilo de Tk y espera allí la respuesta."""
+        if threading.current_thread() is threading.main_thread():
+            return messagebox.askyesno(title, message)
+        answer = queue.Queue(maxsize=1)
+        self.app.root.after(0, lambda: answer.put(messagebox.askyesno(title, message)))
+        return answer.get()
+
+
+class VirtualTable(ttk.Frame):
+    """Tabla filtrable que solo crea en el Treeview las filas visibles.
+
+    El contenido es una lista de claves; `row_for(clave)` da los valores de
+    sus columnas y `text_for(clave)` el texto sobre el que se filtra. Al
+    desplazarse se reutilizan las mismas filas, así que miles de entradas
+    cuestan lo mismo que unas pocas. La selección se guarda por clave.
+    """
+
+    def __init__(self, parent, columns, row_for, text_for=str, height=6):
+        super().__init__(parent)
+        self.row_for = row_for
+        self.text_for = text_for
+        self.height = height
+        self._keys = []
+        self._view = []
+        self._visible = []
+        self._filter_text = ""
+        self._offset = 0
+        self._selected = set()
+        self._slots = []
+
+        filter_frame = ttk.Frame(self)
+        filter_frame.pack(fill="x")
+        ttk.Label(filter_frame, text="Filtrar:").pack(side=tk.LEFT, padx=(0, 5))
+        self.filter_var = tk.StringVar()
+        self.filter_var.trace_add(
+            "write", lambda *_: self.set_filter(self.filter_var.get())
+        )
+        ttk.Entry(filter_frame, textvariable=self.filter_var).pack(
+            side=tk.LEFT, fill="x", expand=True
+        )
+        self.count_var = tk.StringVar(value="0")
+        ttk.Label(filter_frame, textvariable=self.count_var).pack(side=tk.LEFT, padx=5)
+
+        body = ttk.Frame(self)
+        body.pack(fill="both", expand=True, pady=(5, 0))
+        self.tree = ttk.Treeview(
+            body,
+            columns=[column for column, _, _, _ in columns],
+            show="headings",
+            height=height,
+            selectmode="extended",
+        )
+        for index, (column, heading, width, anchor) in enumerate(columns):
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=width, anchor=anchor, stretch=index == 0)
+        self.scrollbar = ttk.Scrollbar(
+            body, orient="vertical", command=self._on_scrollbar
+        )
+        self.tree.pack(side=tk.LEFT, fill="both", expand=True)
+        self.scrollbar.pack(side=tk.LEFT, fill="y")
+        self.tree.bind("<<TreeviewSelect>>", self._on_select)
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.tree.bind(sequence, self._on_wheel)
+        self.tree.bind("<Up>", lambda event: self._on_arrow(-1))
+        self.tree.bind("<Down>", lambda event: self._on_arrow(1))
+
+    def set_rows(self, keys):
+        """Sustituye el contenido conservando la selección de las claves que sigan."""
+        self._keys = list(keys)
+        self._selected &= set(self._keys)
+        self._apply_filter(self._keys)
+
+    def set_filter(self, text):
+        text = text.strip().lower()
+        # al añadir letras basta con filtrar lo que ya se mostraba
+        source = self._view if text.startswith(self._filter_text) else self._keys
+        self._filter_text = text
+        self._offset = 0
+        self._apply_filter(source)
+
+    def _apply_filter(self, source):
+        if self._filter_text:
+            self._view = [
+                key for key in source if self._filter_text in self.text_for(key).lower()
+            ]
+        else:
+            self._view = list(source)
+        self._render()
+
+    def refresh(self):
+        """Vuelve a pintar las filas visibles (p. ej. al conocerse un SHA-256)."""
+        self._render()
+
+    def selection(self):
+        """Claves seleccionadas, en el orden de la tabla."""
+        return [key for key in self._keys if key in self._selected]
+
+    def _render(self):
+        self._offset = max(0, min(self._offset, len(self._view) - self.height))
+        self._visible = self._view[self._offset : self._offset + self.height]
+        while len(self._slots) < len(self._visible):
+            self._slots.append(self.tree.insert("", tk.END))
+        while len(self._slots) > len(self._visible):
+            self.tree.delete(self._slots.pop())
+        for slot, key in zip(self._slots, self._visible):
+            self.tree.item(slot, values=self.row_for(key))
+        self.tree.selection_set(
+            [
+                slot
+                for slot, key in zip(self._slots, self._visible)
+                if key in self._selected
+            ]
+        )
+        total = len(self._view)
+        if total:
+            self.scrollbar.set(
+                self._offset / total, (self._offset + len(self._visible)) / total
+            )
+        else:
+            self.scrollbar.set(0, 1)
+        if self._filter_text:
+            self.count_var.set(f"{total} de {len(self._keys)}")
+        else:
+            self.count_var.set(str(total))
+
+    def _on_select(self, event=None):
+        selected_slots = set(self.tree.selection())
+        for slot, key in zip(self._slots, self._visible):
+            if slot in selected_slots:
+                self._selected.add(key)
+            else:
+                self._selected.discard(key)
+
+    def _scroll(self, rows):
+        self._offset += rows
+        self._render()
+
+    def _on_scrollbar(self, action, value, unit=None):
+        if action == "moveto":
+            self._offset = int(float(value) * len(self._view))
+            self._render()
+        else:
+            self._scroll(int(value) * (self.height if unit == "pages" else 1))
+
+    def _on_wheel(self, event):
+        up = event.num == 4 or getattr(event, "delta", 0) > 0
+        self._scroll(-3 if up else 3)
+        return "break"
+
+    def _on_arrow(self, step):
+        # en el borde de lo visible, desplazar en vez de salirse de la tabla
+        edge = self._slots[0 if step < 0 else -1] if self._slots else None
+        if edge is not None and self.tree.focus() == edge:
+            self._scroll(step)
+            return "break"
+        return None
 
 
 class MultibootUSBApp:
@@ -36,16 +230,30 @@ class MultibootUSBApp:
         self.root.title("Creador y Gestor USB Multiboot para Linux (exFAT)")
         self.root.geometry("750x800")
 
-        self.iso_files = []
+        # ISOs de la lista de creación, indexados por ruta y por nombre
+        self.iso_library = IsoLibrary()
         self.current_usb_device_path = None
         self.current_usb_partition1 = None
 
-        self.create_op_total_bytes_all_isos = 0
-        self.create_op_copied_bytes_all_isos = 0
-        self.create_op_start_time_overall = 0
-
-        self.manage_op_total_bytes_current_iso = 0
-        self.manage_op_start_time_current_iso = 0
+        self.log_sink = LogSink()
+        self.engine = MultibootEngine(TkEngineListener(self))
+        # Montar para inspeccionar un USB es lento: se hace fuera del hilo de Tk
+        self.device_prober = DeviceProber(self.engine.describe_usb)
+        # Biblioteca de ISOs: se muestra del índice guardado y se actualiza sola
+        self.library_index = IsoLibraryIndex(
+            self.engine.hash_cache,
+            self.engine.iso_boot_info,
+            on_change=lambda: self.root.after(0, self._on_library_changed),
+        )
+        # ISOs del USB de gestión y cambios pendientes de aplicar
+        self.usb_iso_names = []
+        self.usb_iso_info = {}
+        self.pending_adds = {}
+        self.pending_removes = []
+        self._manage_list_names = []
+        # Hilo de trabajo y botones Pausar/Cancelar de cada operación
+        self.workers = {}
+        self.job_buttons = {}
 
         log_frame_outer = ttk.Frame(self.root)
         log_frame_inner = ttk.LabelFrame(log_frame_outer, text="Log de Operaciones")
@@ -54,6 +262,7 @@ class MultibootUSBApp:
         )
         self.log_area.pack(padx=5, pady=5, fill="both", expand=True)
         log_frame_inner.pack(padx=10, pady=10, fill="both", expand=True)
+        self._drain_log_queue()
 
         if os.geteuid() != 0:
             messagebox.showerror(
@@ -64,18 +273,28 @@ class MultibootUSBApp:
         if not self.check_dependencies():
             self.root.destroy()
             return
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        try:
+            self.log_sink.open_file()
+        except OSError as e:
+            self.log_message(f"No se pudo abrir el fichero de log: {e}")
 
-        top_usb_frame = ttk.LabelFrame(self.root, text="Dispositivo USB")
+        top_usb_frame = ttk.LabelFrame(
+            self.root, text="Dispositivo(s) USB (Ctrl/Mayús+clic: varios al crear)"
+        )
         top_usb_frame.pack(padx=10, pady=10, fill="x")
         ttk.Label(top_usb_frame, text="Dispositivo USB:").pack(
             side=tk.LEFT, padx=5, pady=5
         )
-        self.usb_var = tk.StringVar()
-        self.usb_combo = ttk.Combobox(
-            top_usb_frame, textvariable=self.usb_var, state="readonly", width=45
+        self.usb_listbox = tk.Listbox(
+            top_usb_frame,
+            selectmode=tk.EXTENDED,
+            exportselection=False,
+            width=45,
+            height=3,
         )
-        self.usb_combo.pack(side=tk.LEFT, padx=5, pady=5, expand=True, fill="x")
-        self.usb_combo.bind("<<ComboboxSelected>>", self.on_usb_selected)
+        self.usb_listbox.pack(side=tk.LEFT, padx=5, pady=5, expand=True, fill="x")
+        self.usb_listbox.bind("<<ListboxSelect>>", self.on_usb_selected)
         refresh_button = ttk.Button(
             top_usb_frame,
             text="Refrescar Lista USBs",
@@ -83,6 +302,7 @@ class MultibootUSBApp:
         )
         refresh_button.pack(side=tk.LEFT, padx=5, pady=5)
 
+        self.verify_copies_var = tk.BooleanVar(value=False)
         self.notebook = ttk.Notebook(self.root)
         create_tab = ttk.Frame(self.notebook)
         self.notebook.add(create_tab, text="Crear Nuevo USB Multiboot (exFAT)")
@@ -90,12 +310,22 @@ class MultibootUSBApp:
         manage_tab = ttk.Frame(self.notebook)
         self.notebook.add(manage_tab, text="Gestionar USB Existente (exFAT)")
         self._populate_manage_tab(manage_tab)
+        library_tab = ttk.Frame(self.notebook)
+        self.notebook.add(library_tab, text="Biblioteca de ISOs")
+        self._populate_library_tab(library_tab)
 
         self.notebook.pack(padx=10, pady=10, fill="both", expand=True)
         log_frame_outer.pack(padx=0, pady=0, fill="both", expand=True)
 
-        self.populate_usb_devices()
         self._update_manage_ui_state(is_compatible=False)
+        self._on_library_changed()
+        self.library_index.start()
+        self.usb_inventory = UsbInventory(
+            on_change=lambda: self.root.after(0, self._on_usb_inventory_changed)
+        )
+        self.usb_inventory.start()
+        self.populate_usb_devices()
+        self._sample_progress()
 
     def get_downloads_folder(self):
         home_dir = os.path.expanduser("~")
@@ -120,10 +350,14 @@ class MultibootUSBApp:
             parent_tab, text="1. Seleccionar Archivos ISO para Nuevo USB"
         )
         iso_frame.pack(padx=10, pady=10, fill="both", expand=True)
-        self.iso_listbox_create = tk.Listbox(
-            iso_frame, selectmode=tk.MULTIPLE, width=60, height=5
+        self.iso_table_create = VirtualTable(
+            iso_frame,
+            ISO_TABLE_COLUMNS,
+            self._create_table_row,
+            os.path.basename,
+            height=CREATE_TABLE_ROWS,
         )
-        self.iso_listbox_create.pack(
+        self.iso_table_create.pack(
             padx=5, pady=5, side=tk.LEFT, fill="both", expand=True
         )
         iso_button_frame = ttk.Frame(iso_frame)
@@ -147,6 +381,18 @@ class MultibootUSBApp:
             command=self.start_creation_process,
         )
         self.create_button.pack(pady=10)
+        self._make_job_controls(action_frame_create, "create").pack(pady=(0, 5))
+        self.use_image_cache_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            action_frame_create,
+            text="Usar caché de imagen (repetir la misma selección a velocidad de escritura bruta)",
+            variable=self.use_image_cache_var,
+        ).pack(pady=(0, 5))
+        ttk.Checkbutton(
+            action_frame_create,
+            text="Verificar tras copiar (SHA-256, releyendo el USB sin caché)",
+            variable=self.verify_copies_var,
+        ).pack(pady=(0, 5))
 
         self.progress_info_frame_create = ttk.Frame(action_frame_create)
         self.progress_info_frame_create.pack(fill="x", padx=5, pady=(0, 5))
@@ -184,6 +430,17 @@ class MultibootUSBApp:
             anchor="w",
         ).pack(fill="x")
 
+        self.device_status_tree = ttk.Treeview(
+            action_frame_create, columns=("fase", "progreso"), height=3
+        )
+        self.device_status_tree.heading("#0", text="Dispositivo")
+        self.device_status_tree.heading("fase", text="Fase")
+        self.device_status_tree.heading("progreso", text="Progreso")
+        self.device_status_tree.column("#0", width=150)
+        self.device_status_tree.column("fase", width=300)
+        self.device_status_tree.column("progreso", width=80, anchor="e")
+        self.device_status_tree.pack(fill="x", padx=5, pady=(0, 5))
+
     def _populate_manage_tab(self, parent_tab):
         ttk.Label(
             parent_tab,
@@ -194,10 +451,13 @@ class MultibootUSBApp:
             parent_tab, text="ISOs en el USB Seleccionado"
         )
         mounted_iso_frame.pack(padx=10, pady=10, fill="both", expand=True)
-        self.mounted_iso_listbox = tk.Listbox(
-            mounted_iso_frame, selectmode=tk.SINGLE, width=60, height=6
+        self.mounted_iso_table = VirtualTable(
+            mounted_iso_frame,
+            ISO_TABLE_COLUMNS + (("estado", "Estado", 110, "w"),),
+            self._manage_table_row,
+            height=MANAGE_TABLE_ROWS,
         )
-        self.mounted_iso_listbox.pack(
+        self.mounted_iso_table.pack(
             padx=5, pady=5, side=tk.LEFT, fill="both", expand=True
         )
         mounted_iso_buttons = ttk.Frame(mounted_iso_frame)
@@ -208,21 +468,52 @@ class MultibootUSBApp:
             command=self.refresh_isos_on_selected_usb,
         )
         self.refresh_mounted_isos_button.pack(pady=5, fill="x")
+        self.fragmentation_button = ttk.Button(
+            mounted_iso_buttons,
+            text="Informe de Fragmentación",
+            command=self.start_fragmentation_report,
+        )
+        self.fragmentation_button.pack(pady=5, fill="x")
+        self.apply_changes_button = ttk.Button(
+            mounted_iso_buttons,
+            text="Aplicar Cambios",
+            command=self.start_apply_manage_changes,
+            state=tk.DISABLED,
+        )
+        self.apply_changes_button.pack(pady=5, fill="x")
+        self.discard_changes_button = ttk.Button(
+            mounted_iso_buttons,
+            text="Descartar Cambios",
+            command=self.discard_manage_changes,
+            state=tk.DISABLED,
+        )
+        self.discard_changes_button.pack(pady=5, fill="x")
 
         manage_actions_frame = ttk.LabelFrame(parent_tab, text="Acciones de Gestión")
         manage_actions_frame.pack(padx=10, pady=10, fill="x")
         self.add_to_usb_button = ttk.Button(
             manage_actions_frame,
-            text="Añadir Nuevo ISO al USB",
-            command=self.start_add_iso_to_usb_process,  # Modificado
+            text="Añadir ISOs al USB...",
+            command=self.queue_isos_to_add,
         )
         self.add_to_usb_button.pack(side=tk.LEFT, padx=10, pady=10)
         self.remove_from_usb_button = ttk.Button(
             manage_actions_frame,
-            text="Quitar ISO Seleccionado del USB",
-            command=self.start_remove_iso_from_usb_process,
+            text="Quitar ISOs Seleccionados",
+            command=self.queue_selected_isos_to_remove,
         )
         self.remove_from_usb_button.pack(side=tk.LEFT, padx=10, pady=10)
+        self.sync_usb_button = ttk.Button(
+            manage_actions_frame,
+            text="Sincronizar con Lista de Creación",
+            command=self.start_sync_usb_process,
+        )
+        self.sync_usb_button.pack(side=tk.LEFT, padx=10, pady=10)
+        ttk.Checkbutton(
+            manage_actions_frame,
+            text="Verificar tras copiar",
+            variable=self.verify_copies_var,
+        ).pack(side=tk.LEFT, padx=10, pady=10)
 
         self.progress_info_frame_manage = ttk.Frame(parent_tab)
         self.progress_info_frame_manage.pack(fill="x", padx=10, pady=(5, 10))
@@ -253,70 +544,151 @@ class MultibootUSBApp:
             textvariable=self.eta_current_iso_label_var_manage,
             anchor="w",
         ).pack(fill="x")
+        self._make_job_controls(self.progress_info_frame_manage, "manage").pack(
+            anchor="w", pady=(5, 0)
+        )
+
+    def _populate_library_tab(self, parent_tab):
+        roots_frame = ttk.LabelFrame(parent_tab, text="Carpetas de la Biblioteca")
+        roots_frame.pack(padx=10, pady=10, fill="x")
+        self.library_roots_listbox = tk.Listbox(
+            roots_frame, height=3, exportselection=False
+        )
+        self.library_roots_listbox.pack(
+            padx=5, pady=5, side=tk.LEFT, fill="x", expand=True
+        )
+        roots_buttons = ttk.Frame(roots_frame)
+        roots_buttons.pack(side=tk.LEFT, padx=5, pady=5, fill="y")
+        ttk.Button(
+            roots_buttons, text="Añadir Carpeta...", command=self.add_library_root
+        ).pack(pady=2, fill="x")
+        ttk.Button(
+            roots_buttons, text="Quitar Carpeta", command=self.remove_library_root
+        ).pack(pady=2, fill="x")
+
+        library_frame = ttk.LabelFrame(parent_tab, text="ISOs de la Biblioteca")
+        library_frame.pack(padx=10, pady=10, fill="both", expand=True)
+        self.library_table = VirtualTable(
+            library_frame,
+            ISO_TABLE_COLUMNS + (("carpeta", "Carpeta", 200, "w"),),
+            self._library_table_row,
+            height=LIBRARY_TABLE_ROWS,
+        )
+        self.library_table.pack(padx=5, pady=5, fill="both", expand=True)
+        library_buttons = ttk.Frame(library_frame)
+        library_buttons.pack(fill="x", padx=5, pady=(0, 5))
+        ttk.Button(
+            library_buttons,
+            text="Añadir a la Lista de Creación",
+            command=self.add_library_selection_to_create,
+        ).pack(side=tk.LEFT, padx=(0, 10))
+        self.library_add_to_usb_button = ttk.Button(
+            library_buttons,
+            text="Añadir al USB Seleccionado",
+            command=self.add_library_selection_to_usb,
+            state=tk.DISABLED,
+        )
+        self.library_add_to_usb_button.pack(side=tk.LEFT)
+        self.library_status_var = tk.StringVar(value="")
+        ttk.Label(library_buttons, textvariable=self.library_status_var).pack(
+            side=tk.RIGHT
+        )
+
+    def _make_job_controls(self, parent, operation):
+        """Crea los botones Pausar/Cancelar de `operation` ("create" o "manage")."""
+        frame = ttk.Frame(parent)
+        pause_button = ttk.Button(
+            frame,
+            text="Pausar",
+            command=lambda: self.toggle_pause(operation),
+            state=tk.DISABLED,
+        )
+        pause_button.pack(side=tk.LEFT, padx=5)
+        cancel_button = ttk.Button(
+            frame,
+            text="Cancelar",
+            command=lambda: self.cancel_operation(operation),
+            state=tk.DISABLED,
+        )
+        cancel_button.pack(side=tk.LEFT, padx=5)
+        self.job_buttons[operation] = (pause_button, cancel_button)
+        return frame
+
+    def _start_worker(self, operation, target, args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        self.workers[operation] = thread
+        self._set_job_running(operation, True)
+        thread.start()
+
+    def _set_job_running(self, operation, running):
+        pause_button, cancel_button = self.job_buttons[operation]
+        state = tk.NORMAL if running else tk.DISABLED
+        pause_button.config(text="Pausar", state=state)
+        cancel_button.config(state=state)
+
+    def toggle_pause(self, operation):
+        token = self.engine.tokens[operation]
+        pause_button, _ = self.job_buttons[operation]
+        if token.paused:
+            token.resume()
+            pause_button.config(text="Pausar")
+            self.log_message("Operación reanudada.")
+        else:
+            token.pause()
+            pause_button.config(text="Reanudar")
+            self.log_message("Operación en pausa.")
+
+    def cancel_operation(self, operation):
+        self.engine.tokens[operation].cancel()
+        for button in self.job_buttons[operation]:
+            button.config(state=tk.DISABLED)
+        self.log_message("Cancelando la operación en curso...")
+
+    def on_close(self):
+        """Al cerrar la ventana cancela lo que esté en curso y espera a su limpieza."""
+        running = [op for op, thread in self.workers.items() if thread.is_alive()]
+        if running:
+            if not messagebox.askyesno(
+                "Operación en curso", "Hay una operación en curso. ¿Cancelarla y salir?"
+            ):
+                return
+            for operation in running:
+                self.cancel_operation(operation)
+        self._close_when_idle(time.monotonic() + CLOSE_TIMEOUT_SECONDS)
+
+    def _close_when_idle(self, deadline):
+        # Sin bloquear el bucle de Tk: los hilos aún pueden necesitarlo al terminar
+        if (
+            any(thread.is_alive() for thread in self.workers.values())
+            and time.monotonic() < deadline
+        ):
+            self.root.after(CLOSE_POLL_MS, self._close_when_idle, deadline)
+            return
+        self.root.destroy()
 
     def log_message(self, message):
-        if hasattr(self, "log_area") and self.log_area:
-            self.log_area.configure(state=tk.NORMAL)
-            self.log_area.insert(tk.END, message + "\n")
-            self.log_area.configure(state=tk.DISABLED)
-            self.log_area.see(tk.END)
-            if hasattr(self, "root") and self.root.winfo_exists():
-                self.root.update_idletasks()
+        """Encola una línea de log; se puede llamar desde cualquier hilo."""
+        if hasattr(self, "log_sink"):
+            self.log_sink.write(message)
         else:
             print(f"LOG (pre-GUI): {message}")
 
-    def run_command(self, command_list, check=True, capture_output=False, log_cmd=True):
-        # ... (sin cambios) ...
-        if log_cmd:
-            self.log_message(f"Ejecutando: {' '.join(command_list)}")
-        try:
-            process = subprocess.run(
-                command_list,
-                check=check,
-                text=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            if process.stdout and log_cmd:
-                self.log_message(f"Salida: {process.stdout.strip()}")
-            if process.stderr and log_cmd:
-                self.log_message(f"Stderr: {process.stderr.strip()}")
-            if check and process.returncode != 0:
-                raise subprocess.CalledProcessError(
-                    process.returncode,
-                    command_list,
-                    output=process.stdout,
-                    stderr=process.stderr,
-                )
-            return process.stdout.strip() if capture_output else True
-        except subprocess.CalledProcessError as e:
-            self.log_message(
-                f"Error ejecutando comando '{' '.join(e.cmd)}': Código {e.returncode}"
-            )
-            if e.stdout:
-                self.log_message(f"  Stdout del error: {e.stdout.strip()}")
-            if e.stderr:
-                self.log_message(f"  Stderr del error: {e.stderr.strip()}")
-            return False
-        except FileNotFoundError:
-            self.log_message(f"Error: Comando '{command_list[0]}' no encontrado.")
-            return False
+    def _drain_log_queue(self):
+        """Vuelca por lotes el log pendiente y recorta el área a LOG_MAX_LINES."""
+        lines = self.log_sink.drain(LOG_DRAIN_BATCH)
+        if lines:
+            self.log_area.configure(state=tk.NORMAL)
+            self.log_area.insert(tk.END, "\n".join(lines) + "\n")
+            line_count = int(self.log_area.index("end-1c").split(".")[0]) - 1
+            if line_count > LOG_MAX_LINES:
+                self.log_area.delete("1.0", f"{line_count - LOG_MAX_LINES + 1}.0")
+            self.log_area.configure(state=tk.DISABLED)
+            self.log_area.see(tk.END)
+        self.root.after(LOG_DRAIN_INTERVAL_MS, self._drain_log_queue)
 
     def check_dependencies(self):
-        # ... (sin cambios, ya incluye mkfs.exfat) ...
-        dependencies = [
-            "lsblk",
-            "parted",
-            "mkfs.exfat",
-            "grub-install",
-            "umount",
-            "mount",
-            "partprobe",
-        ]
-        missing = []
-        for dep in dependencies:
-            if shutil.which(dep) is None:
-                missing.append(dep)
+        missing = missing_dependencies()
         if missing:
             messagebox.showerror(
                 "Dependencias Faltantes",
@@ -328,43 +700,38 @@ class MultibootUSBApp:
         return True
 
     def populate_usb_devices(self):
-        # ... (sin cambios) ...
-        self.log_message("Buscando dispositivos USB...")
-        self.usb_combo.set("")
-        self.usb_var.set("")
-        try:
-            result = subprocess.run(
-                ["lsblk", "-dJ", "-o", "NAME,SIZE,MODEL,TRAN,TYPE,PATH"],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            devices_data = json.loads(result.stdout)
-            usb_devices = []
-            if "blockdevices" in devices_data:
-                for device in devices_data["blockdevices"]:
-                    if (
-                        device.get("tran") == "usb"
-                        and device.get("type") == "disk"
-                        and device.get("name")
-                    ):
-                        path = device.get("path", f"/dev/{device['name']}")
-                        model = device.get("model", "N/A")
-                        size = device.get("size", "N/A")
-                        display_name = f"{path} - {model} ({size})"
-                        usb_devices.append(display_name)
-            self.usb_combo["values"] = usb_devices
-            if usb_devices:
-                self.usb_combo.current(0)
-                self.on_usb_selected()
-            else:
-                self.log_message("No se encontraron dispositivos USB.")
-                self._update_manage_ui_state(is_compatible=False)
-        except Exception as e:
-            self.log_message(f"Error al listar dispositivos: {e}")
-            messagebox.showerror("Error", f"{e}")
+        """Rellena la lista de USBs desde el inventario en memoria, conservando la selección."""
+        previous = {path for path, _ in self._get_selected_usb_devices()}
+        self.usb_listbox.delete(0, tk.END)
+        devices = self.usb_inventory.devices()
+        self.engine.device_models = {device.path: device.model for device in devices}
+        for index, device in enumerate(devices):
+            self.usb_listbox.insert(tk.END, device.display_name())
+            if device.path in previous:
+                self.usb_listbox.selection_set(index)
+        if devices:
+            if not self.usb_listbox.curselection():
+                self.usb_listbox.selection_set(0)
+            self.on_usb_selected()
+        else:
+            self.log_message("No se encontraron dispositivos USB.")
+            self.current_usb_device_path = self.current_usb_partition1 = None
             self._update_manage_ui_state(is_compatible=False)
 
+    def _on_usb_inventory_changed(self):
+        known = set(self.engine.device_models)
+        current = {device.path for device in self.usb_inventory.devices()}
+        for path in sorted(current - known):
+            self.log_message(f"USB conectado: {path}")
+        for path in sorted(known - current):
+            self.log_message(f"USB retirado: {path}")
+        for path in current ^ known:
+            self.device_prober.invalidate(path)
+            if path == self.current_usb_device_path:
+                # otro medio en la misma ruta: hay que volver a verificarlo
+                self.current_usb_device_path = self.current_usb_partition1 = None
+        self.populate_usb_devices()
+
     def add_iso_for_create(self):
         # MODIFICADO para usar initialdir
         initial_dir = self.get_downloads_folder()
@@ -375,71 +742,179 @@ class MultibootUSBApp:
             filetypes=(("Archivos ISO", "*.iso"), ("Todos los archivos", "*.*")),
         )
         if filepaths:
-            count_added = 0
-            for filepath in filepaths:
-                if filepath not in self.iso_files:
-                    if os.path.basename(filepath) not in self.iso_listbox_create.get(
-                        0, tk.END
-                    ):
-                        self.iso_files.append(filepath)
-                        self.iso_listbox_create.insert(
-                            tk.END, os.path.basename(filepath)
-                        )
-                        count_added += 1
-                    else:
-                        self.log_message(
-                            f"ISO {os.path.basename(filepath)} ya está en la lista de creación."
-                        )
-            if count_added > 0:
-                self.log_message(f"{count_added} ISO(s) nuevos añadidos para creación.")
+            self._add_paths_for_create(filepaths)
+
+    def _add_paths_for_create(self, filepaths):
+        new_paths = []
+        for filepath in filepaths:
+            if filepath in self.iso_library:
+                continue
+            if self.iso_library.add(filepath):
+                new_paths.append(filepath)
+            else:
+                self.log_message(
+                    f"ISO {os.path.basename(filepath)} ya está en la lista de creación."
+                )
+        if new_paths:
+            self.iso_table_create.set_rows(self.iso_library.paths())
+            self.log_message(f"{len(new_paths)} ISO(s) nuevos añadidos para creación.")
+            self._hash_sources_in_background(new_paths)
+            self._inspect_sources_in_background(new_paths)
+
+    def _hash_sources_in_background(self, paths):
+        """Muestra los SHA-256 ya conocidos y calcula en segundo plano los que falten."""
+
+        def on_done(path, digest, error):
+            name = os.path.basename(path)
+            if error is not None:
+                self.log_message(f"No se pudo calcular el SHA-256 de {name}: {error}")
+            else:
+                self.log_message(f"SHA-256 de {name}: {digest}")
+                self.library_index.record_hash(path, digest)
+                self.root.after(0, self._refresh_iso_tables)
+
+        cached = self.engine.hash_cache.hash_in_background(paths, on_done)
+        for path, digest in cached.items():
+            self.log_message(
+                f"SHA-256 de {os.path.basename(path)}: {digest} (en caché)"
+            )
+
+    def _inspect_sources_in_background(self, paths):
+        """Averigua (o toma de la caché) el perfil de arranque de los ISOs de origen."""
+
+        def worker():
+            for path in paths:
+                self.engine.iso_boot_info(path)
+            self.root.after(0, self._refresh_iso_tables)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _refresh_iso_tables(self):
+        self.iso_table_create.refresh()
+        self.mounted_iso_table.refresh()
+        self.library_table.refresh()
+
+    def _on_library_changed(self):
+        roots = self.library_index.roots()
+        if list(self.library_roots_listbox.get(0, tk.END)) != roots:
+            self.library_roots_listbox.delete(0, tk.END)
+            for root in roots:
+                self.library_roots_listbox.insert(tk.END, root)
+        paths = self.library_index.paths()
+        self.library_table.set_rows(paths)
+        mode = self.library_index.mode
+        self.library_status_var.set(
+            f"{len(paths)} ISO(s)" + (f" · vigilancia: {mode}" if mode else "")
+        )
+
+    def _library_table_row(self, path):
+        return self._details_row(
+            os.path.basename(path), self.library_index.entry(path)
+        ) + (os.path.dirname(path),)
+
+    def add_library_root(self):
+        directory = filedialog.askdirectory(
+            initialdir=self.get_downloads_folder(),
+            title="Seleccionar Carpeta de ISOs",
+        )
+        if directory and self.library_index.add_root(directory):
+            self.log_message(
+                f"Carpeta añadida a la biblioteca: {directory}. Indexando..."
+            )
+            self._on_library_changed()
+
+    def remove_library_root(self):
+        selection = self.library_roots_listbox.curselection()
+        if not selection:
+            return
+        directory = self.library_roots_listbox.get(selection[0])
+        if self.library_index.remove_root(directory):
+            self.log_message(f"Carpeta quitada de la biblioteca: {directory}")
+
+    def add_library_selection_to_create(self):
+        paths = self.library_table.selection()
+        if not paths:
+            messagebox.showwarning("Advertencia", "Ningún ISO seleccionado.")
+            return
+        self._add_paths_for_create(paths)
+
+    def add_library_selection_to_usb(self):
+        paths = self.library_table.selection()
+        if not paths:
+            messagebox.showwarning("Advertencia", "Ningún ISO seleccionado.")
+            return
+        self._queue_paths_to_add(paths)
+
+    def _source_details(self, path):
+        """Tamaño, SHA-256 y familia de un ISO de origen según las cachés del motor."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        boot = self.engine.hash_cache.get(path, "boot") or {}
+        return {
+            "size": size,
+            "sha256": self.engine.hash_cache.lookup(path),
+            "family": boot.get("family"),
+        }
+
+    @staticmethod
+    def _details_row(name, details):
+        size = details.get("size")
+        sha256 = details.get("sha256")
+        return (
+            name,
+            format_size(size) if size is not None else "?",
+            details.get("family") or "?",
+            sha256[:HASH_DISPLAY_CHARS] if sha256 else "?",
+        )
+
+    def _create_table_row(self, path):
+        return self._details_row(os.path.basename(path), self._source_details(path))
+
+    def _manage_table_row(self, name):
+        if name in self.pending_adds:
+            details = self._source_details(self.pending_adds[name])
+            status = "se sobrescribirá" if name in self.usb_iso_info else "se añadirá"
+        else:
+            details = self.usb_iso_info.get(name, {})
+            status = "se quitará" if name in self.pending_removes else ""
+        return self._details_row(name, details) + (status,)
 
     def remove_iso_for_create(self):
-        # ... (sin cambios) ...
-        selected_indices = self.iso_listbox_create.curselection()
-        if not selected_indices:
+        selected_paths = self.iso_table_create.selection()
+        if not selected_paths:
             return
-        for index in reversed(selected_indices):
-            iso_to_remove_display = self.iso_listbox_create.get(index)
-            paths_to_remove = [
-                p
-                for p in self.iso_files
-                if os.path.basename(p) == iso_to_remove_display
-            ]
-            for p_rem in paths_to_remove:
-                self.iso_files.remove(p_rem)
-            self.iso_listbox_create.delete(index)
-            self.log_message(f"ISO quitado de creación: {iso_to_remove_display}")
+        for path in selected_paths:
+            self.iso_library.remove(path)
+            self.log_message(f"ISO quitado de creación: {os.path.basename(path)}")
+        self.iso_table_create.set_rows(self.iso_library.paths())
+
+    def _get_selected_usb_devices(self):
+        """Devuelve [(dispositivo, partición 1)] de todos los USB seleccionados."""
+        devices = []
+        for index in self.usb_listbox.curselection():
+            device_path = self.usb_listbox.get(index).split(" - ")[0]
+            devices.append((device_path, partition_path_for(device_path)))
+        return devices
 
     def _get_selected_usb_paths(self):
-        # ... (sin cambios) ...
-        selected_usb_display = self.usb_var.get()
-        if not selected_usb_display:
+        devices = self._get_selected_usb_devices()
+        if not devices:
             return None, None
-        device_path = selected_usb_display.split(" - ")[0]
-        partition1 = device_path + "1"
-        base_name = os.path.basename(device_path)
-        if (
-            "mmcblk" in base_name
-            and "p" not in base_name
-            and not base_name.endswith("p")
-        ):
-            partition1 = device_path + "p1"
-        elif (
-            ("loop" in base_name or "nvme" in base_name)
-            and "p" not in base_name
-            and not base_name.endswith("p")
-        ):
-            if "nvme" in base_name and "n" in base_name:
-                partition1 = device_path + "p1"
-            elif "loop" in base_name:
-                partition1 = device_path + "p1"
-        return device_path, partition1
+        return devices[0]
 
     def on_usb_selected(self, event=None):
-        # ... (sin cambios) ...
+        # La pestaña de gestión trabaja siempre con el primer USB seleccionado
+        device_path, partition1 = self._get_selected_usb_paths()
+        if device_path and device_path == self.current_usb_device_path:
+            return
         self.current_usb_device_path, self.current_usb_partition1 = (
-            self._get_selected_usb_paths()
+            device_path,
+            partition1,
         )
+        self.pending_adds.clear()
+        self.pending_removes.clear()
         if self.current_usb_device_path:
             self.log_message(
                 f"USB seleccionado: {self.current_usb_device_path}, Partición: {self.current_usb_partition1}. Verificando..."
@@ -449,788 +924,491 @@ class MultibootUSBApp:
             self._update_manage_ui_state(is_compatible=False)
 
     def _update_manage_ui_state(self, is_compatible, isos_found=False):
-        # ... (sin cambios) ...
         if not hasattr(self, "add_to_usb_button"):
             return
         state_normal_if_compat = tk.NORMAL if is_compatible else tk.DISABLED
         self.add_to_usb_button.config(state=state_normal_if_compat)
+        self.library_add_to_usb_button.config(state=state_normal_if_compat)
+        self.sync_usb_button.config(state=state_normal_if_compat)
         self.refresh_mounted_isos_button.config(state=state_normal_if_compat)
+        self.fragmentation_button.config(
+            state=tk.NORMAL if is_compatible and self.usb_iso_names else tk.DISABLED
+        )
+        if not is_compatible:
+            self.usb_iso_names = []
+            self.usb_iso_info = {}
+            self.pending_adds.clear()
+            self.pending_removes.clear()
+        self._render_manage_list()
+        has_entries = bool(self._manage_list_names)
+        has_pending = bool(self.pending_adds or self.pending_removes)
         self.remove_from_usb_button.config(
-            state=tk.NORMAL if is_compatible and isos_found else tk.DISABLED
-        )  # Quitado self.mounted_iso_listbox.size() > 0 para que se active si hay isos_found
-        if not is_compatible and hasattr(self, "mounted_iso_listbox"):
-            self.mounted_iso_listbox.delete(0, tk.END)
+            state=tk.NORMAL if is_compatible and has_entries else tk.DISABLED
+        )
+        for button in (self.apply_changes_button, self.discard_changes_button):
+            button.config(
+                state=tk.NORMAL if is_compatible and has_pending else tk.DISABLED
+            )
 
-    def verify_and_load_isos_from_usb(self):
-        # ... (sin cambios) ...
-        if not self.current_usb_partition1:
+    def _render_manage_list(self):
+        """Muestra los ISOs del USB junto con los cambios pendientes de aplicar."""
+        on_usb = set(self.usb_iso_names)
+        self.pending_removes[:] = [
+            name for name in self.pending_removes if name in on_usb
+        ]
+        self._manage_list_names = list(self.usb_iso_names) + [
+            name for name in self.pending_adds if name not in on_usb
+        ]
+        self.mounted_iso_table.set_rows(self._manage_list_names)
+
+    def _set_manage_buttons_busy(self):
+        for button in (
+            self.add_to_usb_button,
+            self.library_add_to_usb_button,
+            self.remove_from_usb_button,
+            self.sync_usb_button,
+            self.apply_changes_button,
+            self.discard_changes_button,
+        ):
+            button.config(state=tk.DISABLED)
+
+    def _current_usb_device(self):
+        for device in self.usb_inventory.devices():
+            if device.path == self.current_usb_device_path:
+                return device
+        return None
+
+    def _show_usb_isos(self, names, sources=None):
+        """Refresca la lista con los ISOs leídos en la última operación, sin volver
+        a montar; con None (estado desconocido) hace la verificación completa.
+
+        `sources` ({nombre: ruta de origen}) da los datos de los recién copiados.
+        """
+        if names is None:
+            self.verify_and_load_isos_from_usb(force=True)
+            return
+        sources = sources or {}
+        self.usb_iso_info = {
+            name: (
+                self._source_details(sources[name])
+                if name in sources
+                else self.usb_iso_info.get(name, {})
+            )
+            for name in names
+        }
+        device = self._current_usb_device()
+        if device:
+            self.device_prober.store(device, dict(self.usb_iso_info))
+        self.usb_iso_names = list(names)
+        self._update_manage_ui_state(True, isos_found=bool(names))
+
+    def verify_and_load_isos_from_usb(self, force=False):
+        """Pide en segundo plano el estado del USB actual (o lo toma de la caché)."""
+        device = self._current_usb_device() if self.current_usb_partition1 else None
+        if device is None:
             self._update_manage_ui_state(is_compatible=False)
             self.log_message("Partición USB no válida.")
-            return False
-        if hasattr(self, "mounted_iso_listbox"):
-            self.mounted_iso_listbox.delete(0, tk.END)
+            return
+        self.log_message(f"Verificando {self.current_usb_partition1}...")
+        # mientras tanto, la pestaña de gestión queda inactiva
+        self._set_manage_buttons_busy()
+        self.device_prober.probe(
+            device,
+            lambda path, isos, error: self.root.after(
+                0, self._on_usb_probed, path, isos, error
+            ),
+            force=force,
+        )
+
+    def _on_usb_probed(self, device_path, details, error):
+        """Muestra el resultado de describe_usb ({nombre: datos} o None)."""
+        if device_path != self.current_usb_device_path:
+            # el usuario ya eligió otro USB; el resultado queda en la caché
+            return
+        if error is not None:
+            self.log_message(
+                f"No se pudo montar {self.current_usb_partition1}: {error}"
+            )
+        is_compatible_usb = details is not None
+        isos_on_device = sorted(details or {})
+        if is_compatible_usb:
+            self.log_message(f"USB {self.current_usb_device_path} compatible.")
+            if isos_on_device:
+                self.log_message(f"ISOs: {', '.join(isos_on_device)}")
+            else:
+                self.log_message(f"Directorio 'isos' vacío.")
+        else:
+            self.log_message(
+                f"USB {self.current_usb_device_path} no compatible (falta grub.cfg o /isos)."
+            )
+        self.usb_iso_names = isos_on_device
+        self.usb_iso_info = dict(details or {})
+        self._update_manage_ui_state(is_compatible_usb, isos_found=bool(isos_on_device))
+
+    def start_fragmentation_report(self):
+        if not self.current_usb_partition1:
+            return
         self.log_message(
-            f"Verificando {self.current_usb_partition1} en {TEMP_MOUNT_POINT}..."
-        )
-        self.run_command(["umount", TEMP_MOUNT_POINT], check=False, log_cmd=False)
-        if not os.path.exists(TEMP_MOUNT_POINT):
-            if not self.run_command(["mkdir", "-p", TEMP_MOUNT_POINT]):
-                self.log_message(f"Error: No se pudo crear {TEMP_MOUNT_POINT}.")
-                self._update_manage_ui_state(is_compatible=False)
-                return False
-        is_compatible_usb = False
-        isos_on_device = []
+            f"Analizando la fragmentación de {self.current_usb_partition1}..."
+        )
+        thread = threading.Thread(
+            target=self.worker_fragmentation_report,
+            args=(self.current_usb_partition1,),
+        )
+        thread.daemon = True
+        thread.start()
+
+    def worker_fragmentation_report(self, device_partition1):
         try:
-            mount_success = False
-            if self.run_command(
-                ["mount", "-t", "exfat", self.current_usb_partition1, TEMP_MOUNT_POINT],
-                check=False,
-            ):
-                mount_success = True
-            else:
-                self.log_message(
-                    f"Montaje exfat falló, intentando auto para {self.current_usb_partition1}..."
-                )
-                if self.run_command(
-                    ["mount", self.current_usb_partition1, TEMP_MOUNT_POINT]
-                ):
-                    mount_success = True
-            if mount_success:
-                grub_cfg_path = os.path.join(TEMP_MOUNT_POINT, "boot/grub/grub.cfg")
-                isos_dir = os.path.join(TEMP_MOUNT_POINT, "isos")
-                if os.path.exists(grub_cfg_path) and os.path.isdir(isos_dir):
-                    self.log_message(f"USB {self.current_usb_device_path} compatible.")
-                    is_compatible_usb = True
-                    for item in os.listdir(isos_dir):
-                        if item.lower().endswith(".iso"):
-                            isos_on_device.append(item)
-                            self.mounted_iso_listbox.insert(tk.END, item)
-                    if isos_on_device:
-                        self.log_message(f"ISOs: {', '.join(isos_on_device)}")
-                    else:
-                        self.log_message(f"Directorio 'isos' vacío.")
-                else:
-                    self.log_message(
-                        f"USB {self.current_usb_device_path} no compatible (falta grub.cfg o /isos)."
-                    )
+            report = self.engine.fragmentation_report(device_partition1)
+        except Exception as e:
+            self.log_message(f"Error analizando la fragmentación: {e}")
+            return
+        for name, size, fragments in report:
+            if fragments is None:
+                detail = "fragmentos desconocidos"
+            elif fragments == 1:
+                detail = "contiguo"
             else:
-                self.log_message(f"No se pudo montar {self.current_usb_partition1}.")
-        finally:
-            if os.path.ismount(TEMP_MOUNT_POINT):
-                self.run_command(["umount", TEMP_MOUNT_POINT], check=False)
-        self._update_manage_ui_state(is_compatible_usb, isos_found=bool(isos_on_device))
-        return is_compatible_usb
+                detail = f"{fragments} fragmentos"
+            self.log_message(f"  {name} ({format_size(size)}): {detail}")
+        fragmented = [
+            name for name, _, fragments in report if fragments and fragments > 1
+        ]
+        self.log_message(
+            f"{len(fragmented)} de {len(report)} ISO(s) fragmentados."
+            + (
+                " Volver a añadirlos (sobrescribiendo) los recoloca."
+                if fragmented
+                else ""
+            )
+        )
 
     def refresh_isos_on_selected_usb(self):
         # ... (sin cambios) ...
         if self.current_usb_device_path:
-            self.verify_and_load_isos_from_usb()
+            self.verify_and_load_isos_from_usb(force=True)
         else:
             messagebox.showinfo("Información", "Selecciona un USB primero.")
 
-    def _update_progress_and_eta(
-        self,
-        bar_widget,
-        label_var_widget,
-        speed_var_widget,
-        eta_curr_var_widget,
-        eta_total_var_widget,
-        copied_val,
-        max_val=None,
-        label_text=None,
-        speed_bytes_sec=None,
-        eta_curr_seconds=None,
-        eta_total_seconds=None,
+    def _sample_progress(self):
+        """Muestrea el progreso de ambas operaciones y lo pinta (temporizador de Tk)."""
+        self._render_progress(
+            self.engine.progress["create"].sample(),
+            self.engine.tokens["create"].paused,
+            self.progress_bar_create,
+            self.current_iso_label_var_create,
+            self.speed_label_var_create,
+            self.eta_current_iso_label_var_create,
+            self.eta_total_label_var_create,
+        )
+        self._render_progress(
+            self.engine.progress["manage"].sample(),
+            self.engine.tokens["manage"].paused,
+            self.progress_bar_manage,
+            self.current_iso_label_var_manage,
+            self.speed_label_var_manage,
+            self.eta_current_iso_label_var_manage,
+        )
+        self.root.after(PROGRESS_SAMPLE_MS, self._sample_progress)
+
+    def _render_progress(
+        self, sample, paused, bar, label_var, speed_var, eta_var, eta_total_var=None
     ):
-        # ... (sin cambios) ...
-        if not hasattr(self, "root") or not self.root.winfo_exists():
+        bar.config(maximum=sample["total"] or 100, value=sample["copied"])
+        label_var.set(sample["text"] or "Progreso de copia: N/A")
+        if not sample["active"]:
+            speed_var.set("Velocidad: N/A")
+            eta_var.set("Restante (ISO actual): N/A")
+            if eta_total_var:
+                eta_total_var.set("Restante (Total): N/A")
             return
-        if bar_widget:
-            if max_val is not None:
-                bar_widget.config(maximum=max_val)
-            bar_widget.config(value=copied_val)
-        if label_var_widget and label_text is not None:
-            label_var_widget.set(label_text)
-        if speed_var_widget:
-            if speed_bytes_sec is not None and speed_bytes_sec > 0.001:
-                speed_mb_sec = speed_bytes_sec / (1024 * 1024)
-                speed_var_widget.set(f"Velocidad: {speed_mb_sec:.2f} MB/s")
-            elif speed_bytes_sec == 0:
-                speed_var_widget.set("Velocidad: Calculando...")
-            else:
-                speed_var_widget.set("Velocidad: N/A")
-        if eta_curr_var_widget:
-            eta_curr_var_widget.set(
-                f"Restante (ISO actual): {format_time_remaining(eta_curr_seconds)}"
+        mb = 1024 * 1024
+        if paused:
+            speed_var.set("Velocidad: en pausa")
+        elif sample["speed"] is None:
+            speed_var.set("Velocidad: Calculando...")
+        else:
+            speed_var.set(
+                f"Velocidad: {sample['speed'] / mb:.2f} MB/s "
+                f"(instantánea {(sample['instant'] or 0) / mb:.2f}, "
+                f"media {(sample['average'] or 0) / mb:.2f})"
             )
-        if eta_total_var_widget:
-            eta_total_var_widget.set(
-                f"Restante (Total): {format_time_remaining(eta_total_seconds)}"
+        eta_var.set(f"Restante (ISO actual): {format_time_remaining(sample['eta'])}")
+        if eta_total_var:
+            eta_total_var.set(
+                f"Restante (Total): {format_time_remaining(sample['eta_total'])}"
             )
 
     def start_creation_process(self):
-        # ... (sin cambios) ...
-        device_path, _ = self._get_selected_usb_paths()
-        if not device_path:
+        devices = self._get_selected_usb_devices()
+        if not devices:
             messagebox.showerror("Error", "Selecciona un dispositivo USB.")
             return
-        if not self.iso_files:
+        if not self.iso_library:
             messagebox.showerror("Error", "Añade al menos un archivo ISO.")
             return
-        self.create_op_total_bytes_all_isos = 0
-        for iso_f_path in self.iso_files:
+        for iso_f_path in self.iso_library.paths():
             try:
-                self.create_op_total_bytes_all_isos += os.path.getsize(iso_f_path)
+                os.path.getsize(iso_f_path)
             except OSError:
                 messagebox.showerror(
                     "Error", f"No se pudo obtener tamaño de {iso_f_path}"
                 )
                 return
-        self.create_op_copied_bytes_all_isos = 0
-        self.create_op_start_time_overall = 0
+        device_list = ", ".join(device_path for device_path, _ in devices)
         confirm_msg = (
-            f"¡ADVERTENCIA! Se formateará {device_path} como exFAT.\n"
+            f"¡ADVERTENCIA! Se formateará {device_list} como exFAT.\n"
             f"TODOS LOS DATOS SE PERDERÁN.\n\n¿Continuar?"
         )
         if messagebox.askyesno("Confirmar Formateo exFAT", confirm_msg, icon="warning"):
             self.create_button.config(state=tk.DISABLED)
-            self.log_message("Iniciando creación del USB (exFAT)...")
-            self.root.after(
-                0,
-                self._update_progress_and_eta,
-                self.progress_bar_create,
-                self.current_iso_label_var_create,
-                self.speed_label_var_create,
-                self.eta_current_iso_label_var_create,
-                self.eta_total_label_var_create,
-                0,
-                100,
-                "Iniciando...",
-                None,
-                None,
-                None,
+            self.log_message(f"Iniciando creación del USB (exFAT) en {device_list}...")
+            self._reset_device_status([device_path for device_path, _ in devices])
+            self.engine.progress["create"].reset("Iniciando...")
+            self._start_worker(
+                "create",
+                self.create_multiboot_usb_worker,
+                (
+                    self.iso_library.paths(),
+                    devices,
+                    self.use_image_cache_var.get(),
+                    self.verify_copies_var.get(),
+                ),
             )
-            thread = threading.Thread(
-                target=self.create_multiboot_usb_worker, args=(list(self.iso_files),)
-            )
-            thread.daemon = True
-            thread.start()
         else:
             self.log_message("Creación cancelada.")
 
-    def create_multiboot_usb_worker(self, iso_list_paths):
-        # CORREGIDO EL TYPO AQUÍ
-        # ... (resto del worker como en la respuesta anterior, con el typo TEMP_MONT_POINT corregido a TEMP_MOUNT_POINT)
-        device_path, device_partition1 = (
-            self.current_usb_device_path,
-            self.current_usb_partition1,
-        )
-        if not device_path or not device_partition1:
-            self.log_message("Error worker: Dispositivo/Partición USB no definidos.")
-            self.root.after(
-                0,
-                self._update_progress_and_eta,
-                self.progress_bar_create,
-                self.current_iso_label_var_create,
-                self.speed_label_var_create,
-                self.eta_current_iso_label_var_create,
-                self.eta_total_label_var_create,
-                0,
-                100,
-                "Error de dispositivo",
-                None,
-                None,
-                None,
+    def _reset_device_status(self, device_paths):
+        tree = self.device_status_tree
+        tree.delete(*tree.get_children())
+        for device_path in device_paths:
+            tree.insert(
+                "",
+                tk.END,
+                iid=device_path,
+                text=device_path,
+                values=("En espera", ""),
             )
-            if hasattr(self, "create_button"):
-                self.create_button.config(state=tk.NORMAL)
-                return
 
+    def _update_device_status(self, device_path, phase=None, progress=None):
+        if not hasattr(self, "root") or not self.root.winfo_exists():
+            return
+        if not self.device_status_tree.exists(device_path):
+            return
+        if phase is not None:
+            self.device_status_tree.set(device_path, "fase", phase)
+        if progress is not None:
+            self.device_status_tree.set(device_path, "progreso", progress)
+
+    def create_multiboot_usb_worker(
+        self, iso_list_paths, devices, use_image_cache=False, verify=False
+    ):
         final_status_msg = "Creación fallida (exFAT)."
+        for device_path, _ in devices:
+            self.device_prober.invalidate(device_path)
         try:
-            self.log_message(
-                f"Worker: Usando {device_path}, part {device_partition1} con exFAT"
-            )
-            # 1. Desmontar
-            self.log_message(f"Desmontando particiones en {device_path}...")
-            try:
-                result = self.run_command(
-                    ["lsblk", "-no", "MOUNTPOINT,NAME", device_path],
-                    capture_output=True,
-                    log_cmd=False,
+            jobs = self.engine.create(iso_list_paths, devices, use_image_cache, verify)
+            ok_jobs = [job for job in jobs if job.error is None]
+            failed_jobs = [job for job in jobs if job.error is not None]
+            if failed_jobs:
+                failures = "\n".join(
+                    f"{job.device_path}: {job.error}" for job in failed_jobs
                 )
-                if result and isinstance(result, str) and result.strip():
-                    for line in result.strip().split("\n"):
-                        parts = line.split()
-                        if len(parts) > 1 and parts[0] and parts[0] != "[SWAP]":
-                            mountpoint = parts[0]
-                            part_name_suffix = parts[-1].split("/")[-1]
-                            partition_to_umount = f"/dev/{part_name_suffix}"
-                            self.log_message(
-                                f"Intentando desmontar {partition_to_umount} de {mountpoint}..."
-                            )
-                            self.run_command(
-                                ["umount", partition_to_umount], check=False
-                            )
-                            self.run_command(
-                                ["umount", "-lf", partition_to_umount], check=False
-                            )
-            except Exception as e:
-                self.log_message(f"Error durante desmontaje (puede ser normal): {e}")
-
-            # 2. Particionar y formatear
-            if not self.run_command(["parted", "-s", device_path, "mklabel", "msdos"]):
-                raise Exception("Fallo mklabel")
-            if not self.run_command(
-                [
-                    "parted",
-                    "-s",
-                    device_path,
-                    "mkpart",
-                    "primary",
-                    "ntfs",
-                    "1MiB",
-                    "100%",
-                ]
-            ):
-                raise Exception("Fallo mkpart (tipo ntfs para exFAT ID)")
-            if not self.run_command(
-                ["parted", "-s", device_path, "set", "1", "boot", "on"]
-            ):
-                raise Exception("Fallo set boot on")
-            self.log_message("Releyendo tabla...")
-            time.sleep(3)
-            self.run_command(["partprobe", device_path], check=False)
-            time.sleep(3)
-            self.log_message(f"Formateando {device_partition1} como exFAT...")
-            if not self.run_command(
-                ["mkfs.exfat", "-n", "MULTIBOOT", device_partition1]
-            ):
-                time.sleep(5)
-                self.run_command(["partprobe", device_path], check=False)
-                time.sleep(2)
-                if not self.run_command(
-                    ["mkfs.exfat", "-n", "MULTIBOOT", device_partition1]
-                ):
-                    raise Exception(f"Fallo formatear {device_partition1} exFAT")
-
-            # 3. Montar
-            self.run_command(
-                ["umount", TEMP_MOUNT_POINT], check=False, log_cmd=False
-            )  # Correcto
-            if not os.path.exists(TEMP_MOUNT_POINT):
-                self.run_command(["mkdir", "-p", TEMP_MOUNT_POINT])  # Correcto
-            mount_cmd_exfat = [
-                "mount",
-                "-t",
-                "exfat",
-                device_partition1,
-                TEMP_MOUNT_POINT,
-            ]  # CORRECTO
-            mount_cmd_auto = ["mount", device_partition1, TEMP_MOUNT_POINT]  # Correcto
-            if not self.run_command(mount_cmd_exfat, check=False):
-                if not self.run_command(mount_cmd_auto):
-                    raise Exception(f"Fallo mount {device_partition1}")
-
-            # 4. Instalar GRUB
-            grub_boot_dir = os.path.join(TEMP_MOUNT_POINT, "boot")  # Correcto
-            grub_install_cmd = [
-                "grub-install",
-                f"--boot-directory={grub_boot_dir}",
-                "--target=i386-pc",
-                "--no-floppy",
-                device_path,
-            ]
-            if not self.run_command(grub_install_cmd):
-                grub_install_cmd.append("--force")
-                if not self.run_command(grub_install_cmd):
-                    raise Exception(f"Fallo instalar GRUB2 en {device_path}")
-
-            # 5. Copiar ISOs (con lógica ETA completa)
-            self.create_op_start_time_overall = time.monotonic()
-            self.create_op_copied_bytes_all_isos = 0
-            isos_dir = os.path.join(TEMP_MOUNT_POINT, "isos")
-            self.run_command(["mkdir", "-p", isos_dir])  # Correcto
-            iso_filenames_on_usb = []
-            for idx, iso_path in enumerate(iso_list_paths):
-                iso_filename = os.path.basename(iso_path)
-                dest_iso_path = os.path.join(isos_dir, iso_filename)
-                text = f"Copiando ({idx + 1}/{len(iso_list_paths)}): {iso_filename}"
-                start_iso_t = time.monotonic()
-                size_iso = os.path.getsize(iso_path)
-                copied_iso = 0
+                final_status_msg = (
+                    f"Creación (exFAT) completada en {len(ok_jobs)} de {len(jobs)} USB."
+                )
+                self.log_message(final_status_msg)
                 self.root.after(
                     0,
-                    self._update_progress_and_eta,
-                    self.progress_bar_create,
-                    self.current_iso_label_var_create,
-                    self.speed_label_var_create,
-                    self.eta_current_iso_label_var_create,
-                    self.eta_total_label_var_create,
-                    0,
-                    size_iso,
-                    text,
-                    0,
-                    None,
-                    None,
+                    messagebox.showwarning,
+                    "Creación parcial",
+                    f"{final_status_msg}\n\n{failures}",
                 )
-                buf = 1024 * 1024
-                last_update_t = time.monotonic()
-                try:
-                    with (
-                        open(iso_path, "rb") as fsrc,
-                        open(dest_iso_path, "wb") as fdst,
-                    ):
-                        while True:
-                            chunk = fsrc.read(buf)
-                            if not chunk:
-                                break
-                            fdst.write(chunk)
-                            copied_iso += len(chunk)
-                            self.create_op_copied_bytes_all_isos += len(chunk)
-                            now = time.monotonic()
-                            if now - last_update_t >= 0.5:
-                                el_iso = max(0.1, now - start_iso_t)
-                                sp_iso = copied_iso / el_iso if el_iso > 0 else 0
-                                eta_iso = (
-                                    (size_iso - copied_iso) / sp_iso
-                                    if sp_iso > 0
-                                    else float("inf")
-                                )
-                                el_all = max(
-                                    0.1, now - self.create_op_start_time_overall
-                                )
-                                sp_all = (
-                                    self.create_op_copied_bytes_all_isos / el_all
-                                    if el_all > 0
-                                    else 0
-                                )
-                                eta_all = (
-                                    (
-                                        self.create_op_total_bytes_all_isos
-                                        - self.create_op_copied_bytes_all_isos
-                                    )
-                                    / sp_all
-                                    if sp_all > 0
-                                    else float("inf")
-                                )
-                                self.root.after(
-                                    0,
-                                    self._update_progress_and_eta,
-                                    self.progress_bar_create,
-                                    None,
-                                    self.speed_label_var_create,
-                                    self.eta_current_iso_label_var_create,
-                                    self.eta_total_label_var_create,
-                                    copied_iso,
-                                    None,
-                                    None,
-                                    sp_iso,
-                                    eta_iso,
-                                    eta_all,
-                                )
-                                last_update_t = now
-                    iso_filenames_on_usb.append(iso_filename)
-                    self.root.after(
-                        0,
-                        self._update_progress_and_eta,
-                        self.progress_bar_create,
-                        None,
-                        self.speed_label_var_create,
-                        self.eta_current_iso_label_var_create,
-                        None,
-                        size_iso,
-                        None,
-                        None,
-                        None,
-                        0,
-                        None,
-                    )
-                except Exception as e:
-                    self.log_message(f"Error copiando {iso_filename}: {e}")
-            if not iso_filenames_on_usb:
-                raise Exception("No se copió ningún ISO.")
-
-            # 6. Generar grub.cfg
-            grub_cfg_path = os.path.join(grub_boot_dir, "grub", "grub.cfg")
-            with open(grub_cfg_path, "w") as f:
-                f.write(self.generate_grub_cfg_content(iso_filenames_on_usb))
-            self.log_message("grub.cfg generado.")
-
-            # 7. Desmontar
-            if not self.run_command(
-                ["umount", TEMP_MOUNT_POINT], check=False
-            ):  # Correcto
-                self.run_command(["sync"])
-                time.sleep(1)
-                self.run_command(
-                    ["umount", "-lf", TEMP_MOUNT_POINT], check=False
-                )  # Correcto
-            final_status_msg = "¡Creación (exFAT) completada!"
+            else:
+                final_status_msg = "¡Creación (exFAT) completada!"
+                self.log_message(final_status_msg)
+                if len(jobs) == 1:
+                    success_msg = "USB multiboot (exFAT) creado."
+                else:
+                    success_msg = f"{len(jobs)} USB multiboot (exFAT) creados."
+                self.root.after(0, messagebox.showinfo, "Éxito", success_msg)
+        except OperationCancelled:
+            final_status_msg = "Creación cancelada."
             self.log_message(final_status_msg)
-            messagebox.showinfo("Éxito", "USB multiboot (exFAT) creado.")
         except Exception as e:
             self.log_message(f"ERROR CREACIÓN (exFAT): {e}")
-            messagebox.showerror("Error Creación", f"{e}")
+            self.root.after(0, messagebox.showerror, "Error Creación", f"{e}")
         finally:
-            if os.path.ismount(TEMP_MOUNT_POINT):
-                self.run_command(
-                    ["umount", "-lf", TEMP_MOUNT_POINT], check=False, log_cmd=False
-                )  # Correcto
-            self.root.after(
-                0,
-                self._update_progress_and_eta,
-                self.progress_bar_create,
-                self.current_iso_label_var_create,
-                self.speed_label_var_create,
-                self.eta_current_iso_label_var_create,
-                self.eta_total_label_var_create,
-                0,
-                100,
-                final_status_msg,
-                None,
-                None,
-                None,
-            )
+            for device_path, _ in devices:
+                self.device_prober.invalidate(device_path)
+            if self.current_usb_device_path in [path for path, _ in devices]:
+                self.root.after(0, self.verify_and_load_isos_from_usb)
+            self.engine.progress["create"].reset(final_status_msg)
+            self.root.after(0, self._set_job_running, "create", False)
             if hasattr(self, "create_button"):
-                self.create_button.config(state=tk.NORMAL)
-
-    def generate_grub_cfg_content(self, iso_filenames_on_usb):
-        cfg_parts = [
-            "set timeout=20",
-            "set default=0",
-            "insmod part_msdos",
-            "insmod exfat",
-            "insmod all_video",
-            "insmod gfxterm",
-            "terminal_output gfxterm",
-            "loadfont unicode",
-            "",
-        ]
-
-        for (
-            iso_filename
-        ) in iso_filenames_on_usb:  # Cambié el nombre de la variable aquí para claridad
-            title = iso_filename.replace(".iso", "").replace("_", " ").replace("-", " ")
-            grub_iso_path = f"/isos/{iso_filename}"
-
-            entry = [
-                f"""menuentry "Arrancar {title}" {{""",
-                f"""    set isofile="{grub_iso_path}" """,
-                f"""    echo "Cargando $isofile..." """,
-                f"""    loopback loop $isofile""",
-            ]
-
-            # ----- INICIO DE LÓGICA ESPECÍFICA PARA CLONEZILLA -----
-            # Asumimos que iso_filename es algo como "clonezilla-live-...amd64.iso"
-            # Si solo hay un ISO y es Clonezilla, esta lógica se aplicará.
-            # Si tienes más ISOs, necesitarías una forma de identificar que este es Clonezilla.
-            # Por ahora, como dijiste que solo tienes Clonezilla, esta será la única entrada generada.
+                self.root.after(0, lambda: self.create_button.config(state=tk.NORMAL))
 
-            if (
-                "clonezilla" in iso_filename.lower()
-            ):  # Condición simple para aplicar esta config
-                self.log_message(
-                    f"Generando entrada específica para Clonezilla: {iso_filename}"
-                )
-                entry.extend(
-                    [
-                        f"""    echo "Intentando arranque específico para Clonezilla..." """,
-                        # Parámetros comunes para Clonezilla. 'findiso=' es crucial.
-                        # La ruta al kernel/initrd suele ser /live/
-                        f"""    linux (loop)/live/vmlinuz boot=live union=overlay username=user config components quiet noswap edd=on nomodeset findiso=${{isofile}} toram --""",
-                        f"""    initrd (loop)/live/initrd.img""",
-                    ]
-                )
-            else:
-                # Si tuvieras otros ISOs, aquí volvería la lógica if/elif más genérica
-                # o un mensaje de error si no es Clonezilla y no tienes otra lógica.
-                # Por ahora, para la prueba con solo Clonezilla, podemos poner un mensaje de error
-                # si el ISO no parece ser Clonezilla.
-                entry.extend(
-                    [
-                        f"""    echo "Este ISO no parece ser Clonezilla y no hay otra configuración." """,
-                        f"""    echo "Presiona una tecla..." """,
-                        f"""    read""",
-                    ]
-                )
-            # ----- FIN DE LÓGICA ESPECÍFICA PARA CLONEZILLA -----
-
-            entry.append(f"""}}""")
-            cfg_parts.extend(entry)
-            cfg_parts.append("")
-        return "\n".join(cfg_parts)
-
-    def start_add_iso_to_usb_process(self):
-        # MODIFICADO para usar initialdir
+    def start_sync_usb_process(self):
         if not self.current_usb_device_path or not self.current_usb_partition1:
             messagebox.showerror("Error", "Ningún USB compatible.")
             return
-
-        initial_dir = self.get_downloads_folder()
-        self.log_message(f"Abriendo diálogo para añadir ISO en: {initial_dir}")
-        new_iso_path = filedialog.askopenfilename(
-            initialdir=initial_dir,  # <--- AÑADIDO
-            title="Seleccionar ISO para Añadir",
-            filetypes=(("Archivos ISO", "*.iso"),),
-        )
-        if not new_iso_path:
-            return
-        try:
-            self.manage_op_total_bytes_current_iso = os.path.getsize(new_iso_path)
-        except OSError as e:
-            messagebox.showerror("Error", f"No se pudo leer {new_iso_path}: {e}")
+        if not self.iso_library:
+            messagebox.showerror(
+                "Error", "La lista de creación está vacía; añade los ISOs deseados."
+            )
             return
-        self.manage_op_start_time_current_iso = 0
         self.log_message(
-            f"Añadiendo {os.path.basename(new_iso_path)} a {self.current_usb_device_path}"
-        )
-        self.add_to_usb_button.config(state=tk.DISABLED)
-        self.remove_from_usb_button.config(state=tk.DISABLED)
-        self.root.after(
-            0,
-            self._update_progress_and_eta,
-            self.progress_bar_manage,
-            self.current_iso_label_var_manage,
-            self.speed_label_var_manage,
-            self.eta_current_iso_label_var_manage,
-            None,
-            0,
-            100,
-            "Preparando...",
-            None,
-            None,
-            None,
+            f"Sincronizando {self.current_usb_device_path} con la lista de creación..."
         )
-        thread = threading.Thread(
-            target=self.worker_manage_iso,
-            args=(
+        self._set_manage_buttons_busy()
+        self.engine.progress["manage"].reset("Comparando ISOs...")
+        self._start_worker(
+            "manage",
+            self.worker_sync_usb,
+            (
                 self.current_usb_device_path,
                 self.current_usb_partition1,
-                "add",
-                new_iso_path,
+                self.iso_library.paths(),
+                self.verify_copies_var.get(),
             ),
         )
-        thread.daemon = True
-        thread.start()
 
-    def start_remove_iso_from_usb_process(self):
-        # ... (sin cambios) ...
+    def worker_sync_usb(
+        self, device_path, device_partition1, desired_paths, verify=False
+    ):
+        result = self.engine.sync(device_path, device_partition1, desired_paths, verify)
+        if result.error is not None:
+            self.root.after(
+                0, messagebox.showerror, "Error Sincronización", f"{result.error}"
+            )
+        sources = {
+            os.path.basename(path): path
+            for path in desired_paths
+            if os.path.basename(path) in result.added
+        }
+        self.root.after(0, self._show_usb_isos, result.names_on_usb, sources)
+        self.root.after(0, self._set_job_running, "manage", False)
+        self.engine.progress["manage"].reset(result.message)
+
+    def queue_isos_to_add(self):
+        if not self.current_usb_device_path or not self.current_usb_partition1:
+            messagebox.showerror("Error", "Ningún USB compatible.")
+            return
+        initial_dir = self.get_downloads_folder()
+        self.log_message(f"Abriendo diálogo para añadir ISOs en: {initial_dir}")
+        filepaths = filedialog.askopenfilenames(
+            initialdir=initial_dir,
+            title="Seleccionar ISOs para Añadir",
+            filetypes=(("Archivos ISO", "*.iso"),),
+        )
+        if filepaths:
+            self._queue_paths_to_add(filepaths)
+
+    def _queue_paths_to_add(self, filepaths):
+        for filepath in filepaths:
+            name = os.path.basename(filepath)
+            self.pending_adds[name] = filepath
+            if name in self.pending_removes:
+                self.pending_removes.remove(name)
+        self.log_message(
+            f"{len(filepaths)} ISO(s) pendientes de añadir a {self.current_usb_device_path}."
+        )
+        self._hash_sources_in_background(list(filepaths))
+        self._inspect_sources_in_background(list(filepaths))
+        self._update_manage_ui_state(True, isos_found=bool(self.usb_iso_names))
+
+    def queue_selected_isos_to_remove(self):
+        """Marca para quitar los ISOs seleccionados; sobre un cambio pendiente lo deshace."""
         if not self.current_usb_device_path:
             messagebox.showerror("Error", "Ningún USB compatible.")
             return
-        sel = self.mounted_iso_listbox.curselection()
-        if not sel:
+        selected_names = self.mounted_iso_table.selection()
+        if not selected_names:
             messagebox.showwarning("Advertencia", "Ningún ISO seleccionado.")
             return
-        iso_to_remove = self.mounted_iso_listbox.get(sel[0])
+        for name in selected_names:
+            if name in self.pending_adds:
+                del self.pending_adds[name]
+                self.log_message(f"{name} ya no se añadirá.")
+            elif name in self.pending_removes:
+                self.pending_removes.remove(name)
+                self.log_message(f"{name} ya no se quitará.")
+            else:
+                self.pending_removes.append(name)
+        self._update_manage_ui_state(True, isos_found=bool(self.usb_iso_names))
+
+    def discard_manage_changes(self):
+        self.pending_adds.clear()
+        self.pending_removes.clear()
+        self.log_message("Cambios pendientes descartados.")
+        self._update_manage_ui_state(True, isos_found=bool(self.usb_iso_names))
+
+    def start_apply_manage_changes(self):
+        if not self.current_usb_device_path or not self.current_usb_partition1:
+            messagebox.showerror("Error", "Ningún USB compatible.")
+            return
+        if not self.pending_adds and not self.pending_removes:
+            return
+        summary = "\n".join(
+            [
+                f"+ {name}" + ("  (sobrescribe)" if name in self.usb_iso_names else "")
+                for name in self.pending_adds
+            ]
+            + [f"- {name}" for name in self.pending_removes]
+        )
         if not messagebox.askyesno(
-            "Confirmar", f"¿Quitar '{iso_to_remove}' y actualizar GRUB?"
+            "Confirmar Cambios", f"Cambios a aplicar en el USB:\n\n{summary}"
         ):
             return
-        self.log_message(f"Quitando {iso_to_remove} de {self.current_usb_device_path}")
-        self.add_to_usb_button.config(state=tk.DISABLED)
-        self.remove_from_usb_button.config(state=tk.DISABLED)
-        self.root.after(
-            0,
-            self._update_progress_and_eta,
-            self.progress_bar_manage,
-            self.current_iso_label_var_manage,
-            self.speed_label_var_manage,
-            self.eta_current_iso_label_var_manage,
-            None,
-            0,
-            100,
-            f"Quitando {iso_to_remove}...",
-            None,
-            None,
-            None,
+        self.log_message(
+            f"Aplicando {len(self.pending_adds) + len(self.pending_removes)} cambio(s) "
+            f"en {self.current_usb_device_path}..."
         )
-        thread = threading.Thread(
-            target=self.worker_manage_iso,
-            args=(
+        self._set_manage_buttons_busy()
+        self.engine.progress["manage"].reset("Preparando...")
+        self._start_worker(
+            "manage",
+            self.worker_apply_manage_changes,
+            (
                 self.current_usb_device_path,
                 self.current_usb_partition1,
-                "remove",
-                iso_to_remove,
+                list(self.pending_adds.items()),
+                list(self.pending_removes),
+                self.verify_copies_var.get(),
             ),
         )
-        thread.daemon = True
-        thread.start()
 
-    def worker_manage_iso(self, device_path, device_partition1, action, target_param):
-        # ... (sin cambios, ya incluye lógica ETA para 'add')
-        verb = "añadido" if action == "add" else "quitado"
-        bar, lbl, spd, eta_curr = (
-            self.progress_bar_manage,
-            self.current_iso_label_var_manage,
-            self.speed_label_var_manage,
-            self.eta_current_iso_label_var_manage,
+    def worker_apply_manage_changes(
+        self, device_path, device_partition1, adds, removes, verify=False
+    ):
+        result = self.engine.apply_changes(
+            device_path, device_partition1, adds, removes, verify
         )
-        ok = False
-        final_msg = "Operación fallida."
-        try:
-            self.run_command(["umount", TEMP_MOUNT_POINT], check=False, log_cmd=False)
-            if not os.path.exists(TEMP_MOUNT_POINT):
-                self.run_command(["mkdir", "-p", TEMP_MOUNT_POINT])
-
-            mount_cmd_exfat = [
-                "mount",
-                "-t",
-                "exfat",
-                device_partition1,
-                TEMP_MOUNT_POINT,
-            ]
-            mount_cmd_auto = ["mount", device_partition1, TEMP_MOUNT_POINT]
-            if not self.run_command(mount_cmd_exfat, check=False):
-                if not self.run_command(mount_cmd_auto):
-                    raise Exception(f"No se pudo montar {device_partition1}")
-
-            isos_dir = os.path.join(TEMP_MOUNT_POINT, "isos")
-            grub_cfg = os.path.join(TEMP_MOUNT_POINT, "boot/grub/grub.cfg")
-            if not os.path.isdir(isos_dir):
-                self.run_command(["mkdir", "-p", isos_dir])
-
-            if action == "add":
-                iso_path, iso_name = target_param, os.path.basename(target_param)
-                dest_path = os.path.join(isos_dir, iso_name)
-                if os.path.exists(dest_path) and not messagebox.askyesno(
-                    "Sobrescribir", f"'{iso_name}' ya existe. ¿Sobrescribir?"
-                ):
-                    self.log_message(f"Adición de '{iso_name}' cancelada.")
-                    final_msg = "Adición cancelada."
-                    raise Exception("Cancelled by user")
-
-                text = f"Copiando: {iso_name}"
-                self.manage_op_start_time_current_iso = time.monotonic()
-                copied = 0
-                self.root.after(
-                    0,
-                    self._update_progress_and_eta,
-                    bar,
-                    lbl,
-                    spd,
-                    eta_curr,
-                    None,
-                    0,
-                    self.manage_op_total_bytes_current_iso,
-                    text,
-                    0,
-                    None,
-                    None,
-                )
-                buf = 1024 * 1024
-                last_t = time.monotonic()
-                with open(iso_path, "rb") as fsrc, open(dest_path, "wb") as fdst:
-                    while True:
-                        chunk = fsrc.read(buf)
-                        if not chunk:
-                            break
-                        fdst.write(chunk)
-                        copied += len(chunk)
-                        now = time.monotonic()
-                        if now - last_t >= 0.5:
-                            el = max(0.1, now - self.manage_op_start_time_current_iso)
-                            speed = copied / el if el > 0 else 0
-                            eta_s = (
-                                (self.manage_op_total_bytes_current_iso - copied)
-                                / speed
-                                if speed > 0
-                                else float("inf")
-                            )
-                            self.root.after(
-                                0,
-                                self._update_progress_and_eta,
-                                bar,
-                                None,
-                                spd,
-                                eta_curr,
-                                None,
-                                copied,
-                                None,
-                                None,
-                                speed,
-                                eta_s,
-                                None,
-                            )
-                            last_t = now
-                self.root.after(
-                    0,
-                    self._update_progress_and_eta,
-                    bar,
-                    None,
-                    spd,
-                    eta_curr,
-                    None,
-                    self.manage_op_total_bytes_current_iso,
-                    None,
-                    None,
-                    None,
-                    0,
-                    None,
-                )
-                self.log_message(f"ISO {iso_name} copiado.")
-            elif action == "remove":
-                path_to_rm = os.path.join(isos_dir, target_param)
-                if os.path.exists(path_to_rm):
-                    os.remove(path_to_rm)
-                    self.log_message(f"ISO {target_param} eliminado.")
-                else:
-                    self.log_message(f"Advertencia: {target_param} no encontrado.")
+        if result.error is not None:
+            self.root.after(0, messagebox.showerror, "Error Gestión", f"{result.error}")
+        self.root.after(0, self._finish_manage_changes, result)
+        self.root.after(0, self._set_job_running, "manage", False)
+        self.engine.progress["manage"].reset(result.message)
 
-            self.log_message("Actualizando grub.cfg...")
-            current_isos = [
-                f for f in os.listdir(isos_dir) if f.lower().endswith(".iso")
-            ]
-            if current_isos:
-                with open(grub_cfg, "w") as f:
-                    f.write(self.generate_grub_cfg_content(current_isos))
-                self.log_message("grub.cfg actualizado.")
-            else:
-                with open(grub_cfg, "w") as f:
-                    f.write(
-                        "set timeout=5\nmenuentry 'No hay ISOs' {echo 'Añade ISOs a /isos/'; sleep 10}\n"
-                    )
-                self.log_message("Directorio ISOs vacío; grub.cfg con mensaje.")
-            ok = True
-            final_msg = (
-                f"ISO {os.path.basename(str(target_param))} {verb} y GRUB actualizado."
-            )
-        except Exception as e:
-            self.log_message(
-                f"Error gestionando ISO ({action} {os.path.basename(str(target_param))}): {e}"
-            )
-            if "Cancelled by user" not in str(e):
-                messagebox.showerror("Error Gestión", f"{e}")
-            final_msg = (
-                f"Operación '{action}' fallida."
-                if "Cancelled" not in str(e)
-                else "Operación cancelada."
-            )
-        finally:
-            if os.path.ismount(TEMP_MOUNT_POINT):
-                self.run_command(
-                    ["umount", TEMP_MOUNT_POINT], check=False, log_cmd=False
-                )
-            self.root.after(0, self.verify_and_load_isos_from_usb)
-            self.root.after(
-                0,
-                self._update_progress_and_eta,
-                bar,
-                lbl,
-                spd,
-                eta_curr,
-                None,
-                0,
-                100,
-                final_msg,
-                None,
-                None,
-                None,
-            )
+    def _finish_manage_changes(self, result):
+        """Retira de la cola los cambios ya aplicados; los fallidos quedan pendientes."""
+        sources = {
+            name: self.pending_adds[name]
+            for name in result.added
+            if name in self.pending_adds
+        }
+        for name in result.added:
+            self.pending_adds.pop(name, None)
+        for name in result.removed:
+            if name in self.pending_removes:
+                self.pending_removes.remove(name)
+        self._show_usb_isos(result.names_on_usb, sources)
 
 
 if __name__ == "__main__":
     main_window = tk.Tk()
     app = MultibootUSBApp(main_window)
     main_window.mainloop()
+    app.engine.mount_manager.shutdown()
+    app.log_sink.close()
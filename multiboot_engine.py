@@ -0,0 +1,4503 @@
+"""Motor sin interfaz del creador USB multiboot (lo usan MultiBoot.py y multiboot)."""
+
+import subprocess
+import os
+import json
+import threading
+import shutil
+import time
+import errno
+import queue
+import hashlib
+import mmap
+import re
+import contextlib
+import socket
+import select
+import stat
+import math
+import signal
+import collections
+import ctypes
+import fcntl
+import struct
+import fnmatch
+import logging
+import logging.handlers
+
+# Comandos externos que necesita la aplicación
+REQUIRED_COMMANDS = (
+    "lsblk",
+    "mkfs.exfat",
+    "grub-install",
+    "umount",
+    "mount",
+    "partprobe",
+)
+# Punto de montaje temporal para el USB
+TEMP_MOUNT_POINT = "/mnt/multiboot_usb_creator_temp"
+# Segundos sin uso tras los que se desmonta un montaje propio (ver MountManager)
+MOUNT_IDLE_TIMEOUT = 30.0
+# Discos de bloque del sistema, leídos para el inventario de USBs
+SYS_BLOCK_DIR = "/sys/block"
+# Protocolo netlink de los uevents del kernel (linux/netlink.h)
+NETLINK_KOBJECT_UEVENT = 15
+# Segundos entre lecturas de /sys/block si no hay socket netlink
+INVENTORY_POLL_SECONDS = 2.0
+# Particiones de bloque en sysfs
+SYS_CLASS_BLOCK_DIR = "/sys/class/block"
+# Máximo de segundos esperando a que aparezca la partición tras particionar
+PARTITION_WAIT_TIMEOUT = 15.0
+# Intervalo de comprobación de la partición si no hay socket netlink
+PARTITION_POLL_SECONDS = 0.1
+# Inicio (en sectores de 512 bytes) de la partición 1 que crea la aplicación: 1MiB
+PARTITION1_START_SECTOR = 2048
+# Alineación de la partición 1 en bytes (1 MiB, como `parted mkpart ... 1MiB 100%`)
+PARTITION1_ALIGNMENT = 1024 * 1024
+# Tabla MBR: entradas desde el byte 446, firma 55AA al final del sector 0
+MBR_PARTITION_TABLE_OFFSET = 446
+MBR_DISK_ID_OFFSET = 440
+MBR_SIGNATURE = b"\x55\xaa"
+# Partición 1: arrancable, tipo 0x07 (NTFS/exFAT, lo que deja `parted ... ntfs`)
+MBR_BOOT_FLAG = 0x80
+MBR_PARTITION_TYPE_EXFAT = 0x07
+# Geometría BIOS para los campos CHS si el kernel no da una (la misma que usa parted)
+MBR_CHS_HEADS = 255
+MBR_CHS_SECTORS = 63
+# Cabecera GPT ("EFI PART"); se borra para que no quede una tabla GPT obsoleta
+GPT_SIGNATURE = b"EFI PART"
+# ioctl de dispositivos de bloque (linux/fs.h)
+BLKRRPART = 0x125F
+BLKSSZGET = 0x1268
+BLKGETSIZE64 = 0x80081272
+# ioctl de la geometría BIOS del disco (linux/hdreg.h, struct hd_geometry)
+HDIO_GETGEO = 0x0301
+
+# Tamaño de bloque para la copia de ISOs
+COPY_CHUNK_SIZE = 1024 * 1024
+# Métodos de copia en orden de preferencia (ver CopyEngine)
+COPY_METHODS = ("copy_file_range", "sendfile", "pipeline", "readwrite")
+# Métodos en los que los datos pasan por espacio de usuario y se pueden hashear al vuelo
+USERSPACE_COPY_METHODS = ("pipeline", "readwrite")
+# Número de buffers del anillo del método "pipeline" (lector y escritor en paralelo)
+COPY_PIPELINE_DEPTH = 4
+# Tamaño de lectura (alineado para O_DIRECT) al verificar lo escrito en el USB
+VERIFY_CHUNK_SIZE = 4 * 1024 * 1024
+# Buffers compartidos por todos los destinos en la copia en abanico (varios USB)
+FANOUT_RING_SIZE = 32
+# Segundos sin buffers libres antes de desenganchar del reparto al USB más lento
+FANOUT_LAG_TIMEOUT = 2.0
+# Tamaños de bloque que prueba el autoajuste al inicio de cada ISO
+AUTOTUNE_CHUNK_SIZES = (256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+# Segundos de medida por cada tamaño candidato
+AUTOTUNE_PROBE_SECONDS = 0.75
+# Directorio de caché persistente de la aplicación
+CACHE_DIR = "/var/cache/multiboot-usb-creator"
+# Mejor tamaño de bloque medido por modelo de dispositivo
+CHUNK_SIZE_CACHE_FILE = os.path.join(CACHE_DIR, "chunk_sizes.json")
+# Resúmenes SHA-256 (y otros metadatos) de los ISOs de origen ya analizados
+HASH_CACHE_FILE = os.path.join(CACHE_DIR, "iso_hashes.json")
+# Cambios de esa caché que se acumulan como mucho antes de escribirla dentro
+# de un lote (ver IsoHashCache.batch)
+HASH_CACHE_BATCH_LIMIT = 256
+# Imágenes de disco ya construidas, reutilizables para la misma selección de ISOs
+IMAGE_CACHE_DIR = os.path.join(CACHE_DIR, "images")
+# Versión del formato de imagen; cambiarla invalida las imágenes en caché
+IMAGE_CACHE_FORMAT = 1
+# Tamaño de bloque al volcar una imagen en caché a un USB
+IMAGE_WRITE_CHUNK_SIZE = 8 * 1024 * 1024
+# Bytes iniciales de la imagen que se escriben siempre, aunque sean huecos
+IMAGE_FORCE_HEAD_BYTES = 4 * 1024 * 1024
+# Bloques muestreados por la huella rápida de contenido (ver quick_fingerprint)
+QUICK_HASH_SAMPLES = 16
+QUICK_HASH_SAMPLE_SIZE = 64 * 1024
+# Sufijos del ISO a medio copiar en /isos y de su punto de control para reanudarlo
+PARTIAL_SUFFIX = ".part"
+CHECKPOINT_SUFFIX = ".resume.json"
+# Bytes copiados entre puntos de control (cada uno sincroniza el USB)
+CHECKPOINT_INTERVAL_BYTES = 256 * 1024 * 1024
+# Trazas de cada operación (formato trace-event de Chrome: chrome://tracing, Perfetto)
+TRACE_DIR = os.path.join(CACHE_DIR, "traces")
+# Trazas que se conservan por tipo de operación; las más antiguas se borran
+TRACE_KEEP = 20
+# Etiqueta del sistema de ficheros del USB (la usan las líneas de arranque)
+USB_VOLUME_LABEL = "MULTIBOOT"
+# Índice de la biblioteca de ISOs (carpetas raíz configuradas y sus ISOs)
+LIBRARY_INDEX_FILE = os.path.join(CACHE_DIR, "library.json")
+LIBRARY_INDEX_VERSION = 1
+# Sistemas de ficheros de red: inotify no ve los cambios hechos desde otra máquina
+NETWORK_FILESYSTEMS = frozenset(
+    ("nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs", "9p", "ceph", "glusterfs")
+)
+# Cada cuánto se comparan los mtime de las carpetas que no vigila inotify (s)
+LIBRARY_POLL_SECONDS = 60.0
+# Espera tras un evento de inotify para agrupar los de una misma copia (s)
+LIBRARY_SETTLE_SECONDS = 0.5
+# Máscaras de inotify (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+LIBRARY_WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+# Índice de los ISOs instalados, en la raíz del USB, y su versión de formato
+MANIFEST_FILE = "multiboot-manifest.json"
+MANIFEST_VERSION = 1
+# Geometría ISO9660: sectores de 2 KiB y descriptores de volumen desde el 16
+ISO_SECTOR_SIZE = 2048
+ISO_FIRST_DESCRIPTOR = 16
+ISO_MAX_DESCRIPTORS = 32
+# Versión del resultado de inspección guardado en la caché (subirla lo invalida)
+ISO_INSPECT_FORMAT = 1
+# Sistemas de arranque reconocidos: (familia, kernels, initrds, fichero marcador)
+ISO_BOOT_LAYOUTS = (
+    (
+        "clonezilla",
+        ("live/vmlinuz*",),
+        ("live/initrd*",),
+        "clonezilla?live?version",
+    ),
+    (
+        "casper",
+        ("casper/vmlinuz*",),
+        ("casper/initrd*",),
+        None,
+    ),
+    ("debian-live", ("live/vmlinuz*",), ("live/initrd*",), None),
+    (
+        "arch",
+        ("arch/boot/x86_64/vmlinuz-*",),
+        ("arch/boot/x86_64/initramfs-*.img",),
+        None,
+    ),
+    (
+        "fedora",
+        ("images/pxeboot/vmlinuz*",),
+        ("images/pxeboot/initrd*.img",),
+        None,
+    ),
+    (
+        "opensuse",
+        ("boot/x86_64/loader/linux",),
+        ("boot/x86_64/loader/initrd",),
+        None,
+    ),
+)
+# Parámetros del kernel por familia ({label} es la etiqueta del volumen del ISO)
+GRUB_FAMILY_ARGS = {
+    "clonezilla": "boot=live union=overlay username=user config components quiet noswap edd=on nomodeset findiso=${isofile} toram --",
+    "casper": "boot=casper iso-scan/filename=${isofile} quiet splash --",
+    "debian-live": "boot=live components findiso=${isofile} quiet splash --",
+    "arch": f"archisobasedir=arch img_dev=/dev/disk/by-label/{USB_VOLUME_LABEL} img_loop=${{isofile}} earlymodules=loop",
+    "fedora": "root=live:CDLABEL={label} rd.live.image iso-scan/filename=${isofile} quiet",
+    "opensuse": f"isofrom_device=/dev/disk/by-label/{USB_VOLUME_LABEL} isofrom_system=${{isofile}} quiet",
+}
+# ioctl para leer el mapa de extensiones de un fichero (linux/fs.h, linux/fiemap.h)
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_BATCH = 256
+FIBMAP = 1
+FIGETBSZ = 2
+# Con FIBMAP se consulta un bloque cada tantos bytes y solo se afina entre dos
+# muestras que no son contiguas
+FIBMAP_STRIDE = 1024 * 1024
+# Segundos entre SIGTERM y SIGKILL al cancelar un comando en curso
+CANCEL_KILL_SECONDS = 0.5
+# Constante de tiempo (s) de la media móvil exponencial de la velocidad
+PROGRESS_EWMA_SECONDS = 5.0
+# Intervalo mínimo entre muestras de velocidad
+PROGRESS_MIN_SAMPLE_SECONDS = 0.2
+# Cada cuánto se anuncia el porcentaje de cada USB durante una copia
+DEVICE_STATUS_INTERVAL = 0.5
+# Fichero de log persistente y su rotación (tamaño máximo y copias antiguas)
+LOG_FILE = "/var/log/multiboot-usb-creator.log"
+LOG_FILE_MAX_BYTES = 1024 * 1024
+LOG_FILE_BACKUPS = 3
+# Líneas de log que pueden esperar a la interfaz; las más antiguas se descartan
+LOG_QUEUE_MAX_RECORDS = 5000
+# errno con los que un método de copia del kernel no es aplicable y se pasa al siguiente
+_COPY_FALLBACK_ERRNOS = {
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+}
+
+
+def format_time_remaining(seconds):
+    """Formatea segundos a un string HH:MM:SS o MM:SS."""
+    if seconds is None or seconds == float("inf") or seconds < 0:
+        return "Calculando..."
+    if seconds < 1 and seconds > 0:
+        return "< 1 seg"
+
+    seconds = int(seconds)
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    secs = seconds % 60
+
+    if hours > 0:
+        return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+    else:
+        return f"{minutes:02d}:{secs:02d}"
+
+
+def partition_path_for(device_path, number=1):
+    """Devuelve la ruta de la partición `number` de un disco (sdb1, mmcblk0p1...)."""
+    # El kernel separa el número de partición con "p" cuando el nombre del
+    # disco termina en cifra (mmcblk0p1, nvme0n1p1, loop0p1).
+    if os.path.basename(device_path)[-1:].isdigit():
+        return f"{device_path}p{number}"
+    return f"{device_path}{number}"
+
+
+def is_partition_of(partition_path, device_path):
+    """True si `partition_path` es una partición del disco `device_path`.
+
+    Se mira el disco padre en sysfs; si la partición ya no existe, se compara
+    el nombre con partition_path_for (así /dev/sda no casa con /dev/sdaa1).
+    """
+    disk = os.path.basename(os.path.realpath(device_path))
+    part = os.path.basename(os.path.realpath(partition_path))
+    sys_part = os.path.join(SYS_CLASS_BLOCK_DIR, part)
+    if os.path.exists(os.path.join(sys_part, "partition")):
+        return os.path.basename(os.path.realpath(os.path.join(sys_part, ".."))) == disk
+    number = re.fullmatch(r".*?(\d+)", part)
+    return bool(number) and part == os.path.basename(
+        partition_path_for(disk, int(number.group(1)))
+    )
+
+
+def block_device_size(device_path):
+    """Tamaño en bytes de un disco leído de sysfs (sectores de 512 bytes)."""
+    name = os.path.basename(os.path.realpath(device_path))
+    with open(f"/sys/class/block/{name}/size") as f:
+        return int(f.read().strip()) * 512
+
+
+def image_data_regions(fd, size, head_bytes=0):
+    """Genera (offset, longitud) de las zonas con datos de un fichero disperso.
+
+    Los primeros `head_bytes` se devuelven siempre completos, haya datos o no.
+    """
+    offset = 0
+    if head_bytes:
+        offset = min(head_bytes, size)
+        yield 0, offset
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            raise
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+        yield data, hole - data
+        offset = hole
+
+
+def quick_fingerprint(
+    path, samples=QUICK_HASH_SAMPLES, sample_size=QUICK_HASH_SAMPLE_SIZE, length=None
+):
+    """Huella SHA-256 del tamaño y de bloques repartidos por todo el fichero.
+
+    Lee como mucho samples * sample_size bytes, así que sirve para comparar
+    ISOs de varios GB en el USB sin releerlos enteros. Con `length` solo se
+    considera el prefijo de esa longitud.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if length is not None:
+            size = min(size, length)
+        digest.update(str(size).encode())
+        last_offset = max(0, size - sample_size)
+        for i in range(samples):
+            offset = last_offset * i // max(1, samples - 1)
+            digest.update(os.pread(f.fileno(), min(sample_size, size), offset))
+    return digest.hexdigest()
+
+
+def file_sha256(path, chunk_size=VERIFY_CHUNK_SIZE):
+    """SHA-256 del fichero entero, leído secuencialmente."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+
+def plan_iso_sync(desired_paths, isos_dir, manifest=None, hash_cache=None):
+    """Compara la lista deseada con /isos del USB sin leer ningún ISO entero.
+
+    Devuelve (a_copiar, a_borrar, sin_cambios, por_comprobar): rutas de
+    origen que faltan o han cambiado, nombres en el USB que ya no se quieren,
+    nombres que ya están al día y rutas de origen que coinciden en nombre,
+    tamaño y huella rápida pero cuyo SHA-256 completo aún no se conoce en
+    ambos lados (ver check_iso_digests). Un ISO solo está al día si también
+    coincide el SHA-256: el del origen sale de `hash_cache` y el del USB, del
+    `manifest` si sigue siendo válido.
+    """
+    on_usb = {f for f in os.listdir(isos_dir) if f.lower().endswith(".iso")}
+    to_copy, unchanged, unverified = [], [], []
+    for src_path in desired_paths:
+        name = os.path.basename(src_path)
+        dest_path = os.path.join(isos_dir, name)
+        if name in on_usb and os.path.getsize(src_path) == os.path.getsize(dest_path):
+            entry = manifest.entry(name, dest_path) if manifest else None
+            recorded = entry.get("fingerprint") if entry else None
+            if quick_fingerprint(src_path) == (
+                recorded or quick_fingerprint(dest_path)
+            ):
+                src_digest = hash_cache.lookup(src_path) if hash_cache else None
+                dest_digest = entry.get("sha256") if entry else None
+                if not (src_digest and dest_digest):
+                    unverified.append(src_path)
+                    continue
+                if src_digest == dest_digest:
+                    unchanged.append(name)
+                    continue
+        to_copy.append(src_path)
+    desired_names = {os.path.basename(p) for p in desired_paths}
+    to_delete = sorted(on_usb - desired_names)
+    return to_copy, to_delete, unchanged, unverified
+
+
+def check_iso_digests(src_path, dest_path, manifest=None, hash_cache=None):
+    """Compara por SHA-256 completo un ISO de origen con su copia en el USB.
+
+    Los resúmenes que haya que calcular se guardan: el del origen en
+    `hash_cache` y el del USB en `manifest` (que el llamador debe guardar).
+    """
+    if hash_cache is not None:
+        src_digest = hash_cache.lookup(src_path) or hash_cache.hash_file(src_path)
+    else:
+        src_digest = file_sha256(src_path)
+    name = os.path.basename(dest_path)
+    entry = manifest.entry(name, dest_path) if manifest else None
+    dest_digest = entry.get("sha256") if entry else None
+    if not dest_digest:
+        dest_digest = file_sha256(dest_path)
+        if manifest is not None:
+            manifest.add(name, dest_path, sha256=dest_digest)
+    return src_digest == dest_digest
+
+
+def image_cache_key(iso_paths, grub_version, image_size):
+    """Clave de caché de una imagen: ISOs (nombre, tamaño, mtime), GRUB y tamaño."""
+    digest = hashlib.sha256()
+    digest.update(f"v{IMAGE_CACHE_FORMAT}|{grub_version}|{image_size}".encode())
+    for iso_path in iso_paths:
+        st = os.stat(iso_path)
+        digest.update(
+            f"|{os.path.basename(iso_path)}:{st.st_size}:{st.st_mtime_ns}".encode()
+        )
+    return digest.hexdigest()
+
+
+class SparseImageWriter:
+    """Vuelca una imagen dispersa a un disco escribiendo solo las zonas con datos.
+
+    El principio de la imagen se escribe entero para borrar firmas de sistemas
+    de ficheros anteriores, y el último MiB del disco se pone a cero para
+    eliminar restos de etiquetas antiguas (p. ej. la GPT de respaldo).
+    """
+
+    def __init__(
+        self, chunk_size=IMAGE_WRITE_CHUNK_SIZE, head_bytes=IMAGE_FORCE_HEAD_BYTES
+    ):
+        self.chunk_size = chunk_size
+        self.head_bytes = head_bytes
+
+    def data_size(self, image_path):
+        with open(image_path, "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            return sum(
+                length
+                for _, length in image_data_regions(f.fileno(), size, self.head_bytes)
+            )
+
+    def write(self, image_path, device_path, on_chunk=None):
+        view = memoryview(bytearray(self.chunk_size))
+        with open(image_path, "rb", buffering=0) as fsrc:
+            fd_src = fsrc.fileno()
+            image_size = os.fstat(fd_src).st_size
+            # O_EXCL en un dispositivo de bloques falla si está montado
+            fd_dev = os.open(device_path, os.O_WRONLY | os.O_EXCL)
+            try:
+                device_size = os.lseek(fd_dev, 0, os.SEEK_END)
+                if device_size < image_size:
+                    raise OSError(
+                        errno.ENOSPC,
+                        f"{device_path} es menor que la imagen ({image_size} bytes)",
+                    )
+                for start, length in image_data_regions(
+                    fd_src, image_size, self.head_bytes
+                ):
+                    pos, end = start, start + length
+                    while pos < end:
+                        n = os.preadv(
+                            fd_src, [view[: min(self.chunk_size, end - pos)]], pos
+                        )
+                        if n == 0:
+                            break
+                        chunk, out_pos = view[:n], pos
+                        while chunk:
+                            written = os.pwrite(fd_dev, chunk, out_pos)
+                            out_pos += written
+                            chunk = chunk[written:]
+                        pos += n
+                        if on_chunk:
+                            on_chunk(n)
+                tail = min(1024 * 1024, device_size - image_size)
+                if tail > 0:
+                    os.pwrite(fd_dev, bytes(tail), device_size - tail)
+                os.fsync(fd_dev)
+            finally:
+                os.close(fd_dev)
+
+
+class CopyUnsupportedError(OSError):
+    """El método de copia no puede usarse con este par de ficheros."""
+
+
+def write_json_atomic(path, data):
+    """Escribe data como JSON en path de forma atómica (fichero temporal + rename)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# fallocate(2) directo (ver preallocate); se carga al importar para que los
+# hilos escritores en paralelo no compitan por inicializarlo. glibc exporta
+# fallocate64; musl solo fallocate (su off_t ya es de 64 bits). Sin ninguno
+# no se reserva espacio
+_libc = ctypes.CDLL(None, use_errno=True)
+_fallocate = getattr(_libc, "fallocate64", None) or getattr(_libc, "fallocate", None)
+if _fallocate is not None:
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+
+
+def preallocate(fd, size):
+    """Reserva `size` bytes para `fd` antes de copiar, para que quede contiguo.
+
+    Usa fallocate(2) directamente: os.posix_fallocate, si el sistema de
+    ficheros no lo admite, lo emula escribiendo en cada bloque, lo que en un
+    USB duplicaría la escritura. Devuelve False si no se pudo reservar.
+    """
+    if size <= 0 or _fallocate is None:
+        return False
+    return _fallocate(fd, 0, 0, size) == 0
+
+
+def file_extents(fd):
+    """Devuelve las extensiones físicas de `fd` como [(lógico, físico, longitud)].
+
+    Usa FIEMAP y, si el sistema de ficheros no lo implementa, FIBMAP por
+    muestreo (necesita root; ver _fibmap_extents). Lanza OSError si ninguno
+    está disponible.
+    """
+    size = os.fstat(fd).st_size
+    try:
+        return _fiemap_extents(fd, size)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+            raise
+    return _fibmap_extents(fd, size)
+
+
+def _fiemap_extents(fd, size):
+    extents = []
+    start = 0
+    while start < size:
+        # buffer mutable: fcntl.ioctl limita a 1024 bytes los argumentos inmutables
+        request = bytearray(32 + 56 * FIEMAP_BATCH)
+        struct.pack_into(
+            "=QQLLLL",
+            request,
+            0,
+            start,
+            size - start,
+            FIEMAP_FLAG_SYNC,
+            0,
+            FIEMAP_BATCH,
+            0,
+        )
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+        mapped = struct.unpack_from("=L", request, 20)[0]
+        if not mapped:
+            break
+        for i in range(mapped):
+            logical, physical, length, _, _, flags = struct.unpack_from(
+                "=QQQQQL", request, 32 + 56 * i
+            )
+            extents.append((logical, physical, length))
+        if flags & FIEMAP_EXTENT_LAST:
+            break
+        start = logical + length
+    return extents
+
+
+def _fibmap_extents(fd, size, stride=FIBMAP_STRIDE):
+    """Extensiones con FIBMAP consultando un bloque cada `stride` bytes.
+
+    Si dos muestras están a la misma distancia física que lógica se da por
+    contiguo lo que hay entre ellas; si no, se parte el tramo por la mitad
+    hasta dar con el salto. Un ISO de 4 GiB en exFAT pasa así de millones de
+    ioctl a unos pocos miles.
+    """
+    block_size = struct.unpack("=i", fcntl.ioctl(fd, FIGETBSZ, struct.pack("=i", 0)))[0]
+    blocks = (size + block_size - 1) // block_size
+    extents = []
+
+    def physical_of(block):
+        # 0 = hueco o bloque reservado sin escribir
+        physical = struct.unpack(
+            "=i", fcntl.ioctl(fd, FIBMAP, struct.pack("=i", block))
+        )[0]
+        return physical * block_size
+
+    def add(block, physical, count):
+        if physical == 0:
+            return
+        logical, length = block * block_size, count * block_size
+        if extents and extents[-1][1] + extents[-1][2] == physical:
+            extents[-1] = (extents[-1][0], extents[-1][1], extents[-1][2] + length)
+        else:
+            extents.append((logical, physical, length))
+
+    def fill(lo, physical_lo, hi, physical_hi):
+        # bloques [lo, hi), con el físico de lo y de hi ya consultados
+        if physical_lo and physical_hi - physical_lo == (hi - lo) * block_size:
+            add(lo, physical_lo, hi - lo)
+        elif not (physical_lo or physical_hi) or hi - lo == 1:
+            # hueco entre dos muestras sin datos, o un solo bloque
+            add(lo, physical_lo, 1)
+        else:
+            mid = (lo + hi) // 2
+            physical_mid = physical_of(mid)
+            fill(lo, physical_lo, mid, physical_mid)
+            fill(mid, physical_mid, hi, physical_hi)
+
+    if not blocks:
+        return extents
+    step = max(1, stride // block_size)
+    last = blocks - 1
+    lo, physical_lo = 0, physical_of(0)
+    for hi in list(range(step, last, step)) + [last]:
+        if hi <= lo:
+            continue
+        physical_hi = physical_of(hi)
+        fill(lo, physical_lo, hi, physical_hi)
+        lo, physical_lo = hi, physical_hi
+    add(last, physical_lo, 1)
+    return extents
+
+
+def count_fragments(path):
+    """Número de tramos físicamente contiguos de `path` (1 = sin fragmentar)."""
+    with open(path, "rb", buffering=0) as f:
+        extents = file_extents(f.fileno())
+    fragments = 0
+    end = None
+    for _, physical, length in extents:
+        if physical != end:
+            fragments += 1
+        end = physical + length
+    return fragments
+
+
+class ChunkSizeProbe:
+    """Elige el tamaño de bloque de una copia midiendo cada candidato unos instantes.
+
+    Con `fixed` no se mide nada y siempre se usa ese tamaño.
+    """
+
+    def __init__(
+        self,
+        candidates=AUTOTUNE_CHUNK_SIZES,
+        probe_seconds=AUTOTUNE_PROBE_SECONDS,
+        fixed=None,
+        on_done=None,
+    ):
+        self.candidates = tuple(candidates) if fixed is None else (fixed,)
+        self.probe_seconds = probe_seconds
+        self.on_done = on_done
+        self.size = self.candidates[0]
+        self.done = fixed is not None
+        self.autotuned = False
+        self.results = {}
+        self._index = 0
+        self._window_start = None
+        self._window_bytes = 0
+
+    @property
+    def max_size(self):
+        return max(self.candidates)
+
+    def observe(self, n, fd_dst):
+        """Registra n bytes copiados y avanza al siguiente candidato al cerrar la ventana."""
+        if self.done:
+            return
+        now = time.monotonic()
+        if self._window_start is None:
+            self._window_start = now
+            return
+        self._window_bytes += n
+        if now - self._window_start < self.probe_seconds:
+            return
+        # Incluir el vaciado al dispositivo para medir el USB y no la caché de páginas
+        os.fdatasync(fd_dst)
+        elapsed = time.monotonic() - self._window_start
+        self.results[self.size] = self._window_bytes / max(elapsed, 0.001)
+        self._index += 1
+        self._window_start = None
+        self._window_bytes = 0
+        if self._index < len(self.candidates):
+            self.size = self.candidates[self._index]
+            return
+        self.size = max(self.results, key=self.results.get)
+        self.done = True
+        self.autotuned = True
+        if self.on_done:
+            self.on_done(self.size, self.results[self.size])
+
+
+class ChunkSizeTuner:
+    """Recuerda por modelo de dispositivo el tamaño de bloque con mejor rendimiento."""
+
+    def __init__(
+        self,
+        cache_file=CHUNK_SIZE_CACHE_FILE,
+        candidates=AUTOTUNE_CHUNK_SIZES,
+        probe_seconds=AUTOTUNE_PROBE_SECONDS,
+    ):
+        self.cache_file = cache_file
+        self.candidates = tuple(candidates)
+        self.probe_seconds = probe_seconds
+        self._lock = threading.Lock()
+        self._sizes = None
+
+    def _load(self):
+        if self._sizes is None:
+            try:
+                with open(self.cache_file) as f:
+                    self._sizes = json.load(f)
+            except (OSError, ValueError):
+                self._sizes = {}
+        return self._sizes
+
+    def known_size(self, model):
+        if not model or model == "N/A":
+            return None
+        with self._lock:
+            entry = self._load().get(model)
+        return entry.get("chunk_size") if entry else None
+
+    def remember(self, model, chunk_size, throughput):
+        if not model or model == "N/A":
+            return
+        with self._lock:
+            sizes = self._load()
+            sizes[model] = {
+                "chunk_size": chunk_size,
+                "throughput": int(throughput),
+                "updated": int(time.time()),
+            }
+            try:
+                write_json_atomic(self.cache_file, sizes)
+            except OSError:
+                pass
+
+    def probe_for(self, model):
+        """Devuelve un ChunkSizeProbe para una copia hacia un dispositivo de ese modelo."""
+        known = self.known_size(model)
+        if known:
+            return ChunkSizeProbe(fixed=known)
+        return ChunkSizeProbe(
+            self.candidates,
+            self.probe_seconds,
+            on_done=lambda size, tp: self.remember(model, size, tp),
+        )
+
+
+class StreamHasher:
+    """Calcula el SHA-256 de un flujo en un hilo aparte.
+
+    `feed` encola un bloque y vuelve al momento; `release` (opcional) se llama
+    cuando el bloque ya está hasheado y su buffer puede reutilizarse.
+    """
+
+    def __init__(self, algorithm="sha256"):
+        self._hash = hashlib.new(algorithm)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            data, release = item
+            self._hash.update(data)
+            if release:
+                release()
+
+    def feed(self, data, release=None):
+        self._queue.put((data, release))
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def hexdigest(self):
+        """Espera a que se procesen los bloques pendientes y devuelve el resumen."""
+        self.close()
+        return self._hash.hexdigest()
+
+
+class IsoInspector:
+    """Lector ISO9660/Joliet/Rock Ridge mínimo para decidir cómo arrancar un ISO.
+
+    Mapea el fichero con mmap y solo toca los descriptores de volumen, el
+    catálogo El Torito y los directorios de las rutas que se consultan, así
+    que un ISO de varios GB se inspecciona sin montarlo y sin leerlo.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.volume_id = ""
+        self.el_torito = False
+        self.platforms = set()
+        self.joliet = False
+        self.rock_ridge = False
+        self._root = None
+        self._rr_skip = 0
+        self._joliet_tree = False
+        self._dirs = {}
+        self._file = None
+        self._map = None
+
+    def __enter__(self):
+        self._file = open(self.path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.close()
+            raise ValueError(f"{self.path} está vacío")
+        try:
+            self._read_descriptors()
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _sector(self, lba, count=1):
+        start = lba * ISO_SECTOR_SIZE
+        end = start + count * ISO_SECTOR_SIZE
+        if end > len(self._map):
+            raise ValueError(f"{self.path}: sector {lba} fuera del fichero")
+        return self._map[start:end]
+
+    def _read_descriptors(self):
+        primary_root = joliet_root = None
+        for index in range(ISO_MAX_DESCRIPTORS):
+            desc = self._sector(ISO_FIRST_DESCRIPTOR + index)
+            if desc[1:6] != b"CD001":
+                break
+            kind = desc[0]
+            if kind == 255:
+                break
+            if kind == 0 and desc[7:30] == b"EL TORITO SPECIFICATION":
+                self.el_torito = True
+                self._read_boot_catalog(struct.unpack_from("<I", desc, 71)[0])
+            elif kind == 1 and primary_root is None:
+                self.volume_id = desc[40:72].decode("ascii", "replace").strip()
+                primary_root = self._record(desc, 156)
+            elif kind == 2 and desc[88:90] == b"%/" and desc[90:91] in b"@CE":
+                joliet_root = self._record(desc, 156)
+        if primary_root is None:
+            raise ValueError(f"{self.path} no es una imagen ISO9660")
+        self.joliet = joliet_root is not None
+        self._detect_rock_ridge(primary_root)
+        # Rock Ridge y Joliet guardan los nombres largos; sin ninguno quedan 8.3
+        if self.rock_ridge or not self.joliet:
+            self._root = primary_root
+        else:
+            self._root = joliet_root
+            self._joliet_tree = True
+
+    def _read_boot_catalog(self, lba):
+        """Anota las plataformas de arranque (0 = BIOS, 0xEF = UEFI) del catálogo."""
+        try:
+            catalog = self._sector(lba)
+        except ValueError:
+            return
+        if catalog[0] != 1:
+            return
+        self.platforms.add(catalog[1])
+        offset = 64
+        while offset + 32 <= len(catalog):
+            header = catalog[offset]
+            if header not in (0x90, 0x91):
+                break
+            self.platforms.add(catalog[offset + 1])
+            count = struct.unpack_from("<H", catalog, offset + 2)[0]
+            offset += 32 * (1 + count)
+            if header == 0x91:
+                break
+
+    @staticmethod
+    def _record(buf, offset):
+        """(lba, tamaño, es_directorio, nombre, área de sistema) de un registro."""
+        length = buf[offset]
+        (lba,) = struct.unpack_from("<I", buf, offset + 2)
+        (size,) = struct.unpack_from("<I", buf, offset + 10)
+        name_len = buf[offset + 32]
+        name = bytes(buf[offset + 33 : offset + 33 + name_len])
+        su_start = offset + 33 + name_len + (1 - name_len % 2)
+        return (
+            lba,
+            size,
+            bool(buf[offset + 25] & 0x02),
+            name,
+            buf[su_start : offset + length],
+        )
+
+    def _detect_rock_ridge(self, root):
+        dot = self._record(self._sector(root[0]), 0)
+        system_use = dot[4]
+        if system_use[:2] == b"SP" and system_use[4:6] == b"\xbe\xef":
+            self.rock_ridge = True
+            self._rr_skip = system_use[6]
+
+    def _rock_ridge_name(self, system_use):
+        name, offset = b"", self._rr_skip
+        while offset + 4 <= len(system_use):
+            signature, length = system_use[offset : offset + 2], system_use[offset + 2]
+            if length < 4:
+                break
+            if signature == b"NM":
+                name += system_use[offset + 5 : offset + length]
+            elif signature == b"ST":
+                break
+            offset += length
+        return name.decode("utf-8", "replace") if name else None
+
+    def _list_dir(self, lba, size):
+        """{nombre en minúsculas: registro} de un directorio (con caché por lba)."""
+        listing = self._dirs.get(lba)
+        if listing is not None:
+            return listing
+        listing = {}
+        sectors = max(1, -(-size // ISO_SECTOR_SIZE))
+        data = self._sector(lba, sectors)
+        for base in range(0, sectors * ISO_SECTOR_SIZE, ISO_SECTOR_SIZE):
+            offset = base
+            while offset < base + ISO_SECTOR_SIZE and data[offset]:
+                record = self._record(data, offset)
+                offset += data[offset]
+                raw = record[3]
+                if raw in (b"\x00", b"\x01"):
+                    continue
+                name = None
+                if self.rock_ridge:
+                    name = self._rock_ridge_name(record[4])
+                if name is None:
+                    if self._joliet_tree:
+                        name = raw.decode("utf-16-be", "replace")
+                    else:
+                        # GRUB muestra en minúsculas los nombres ISO9660 planos
+                        name = raw.decode("ascii", "replace").lower()
+                    name = name.split(";")[0]
+                    if not record[2]:
+                        name = name.rstrip(".")
+                listing[name.lower()] = (name,) + record[:3]
+        self._dirs[lba] = listing
+        return listing
+
+    def find(self, pattern):
+        """Primera ruta (por orden alfabético) que encaja con el patrón, o None.
+
+        Los comodines solo se admiten en el último componente y las
+        comparaciones no distinguen mayúsculas.
+        """
+        parts = pattern.strip("/").lower().split("/")
+        lba, size = self._root[0], self._root[1]
+        path = []
+        for part in parts[:-1]:
+            entry = self._list_dir(lba, size).get(part)
+            if entry is None or not entry[3]:
+                return None
+            path.append(entry[0])
+            lba, size = entry[1], entry[2]
+        matches = sorted(
+            entry[0]
+            for key, entry in self._list_dir(lba, size).items()
+            if fnmatch.fnmatchcase(key, parts[-1]) and not entry[3]
+        )
+        return "/" + "/".join(path + matches[:1]) if matches else None
+
+    def boot_info(self):
+        """Resumen serializable: familia, kernel, initrd y loopback.cfg."""
+        info = {
+            "format": ISO_INSPECT_FORMAT,
+            "label": self.volume_id,
+            "el_torito": self.el_torito,
+            "uefi": 0xEF in self.platforms,
+            "family": None,
+            "kernel": None,
+            "initrd": None,
+            "loopback_cfg": self.find("boot/grub/loopback.cfg"),
+        }
+        for family, kernels, initrds, marker in ISO_BOOT_LAYOUTS:
+            if marker and not self.find(marker):
+                continue
+            kernel = next(filter(None, map(self.find, kernels)), None)
+            initrd = next(filter(None, map(self.find, initrds)), None)
+            if kernel and initrd:
+                info.update(family=family, kernel=kernel, initrd=initrd)
+                break
+        return info
+
+
+def inspect_iso(path):
+    """Inspecciona un ISO sin montarlo (ver IsoInspector.boot_info)."""
+    with IsoInspector(path) as inspector:
+        try:
+            return inspector.boot_info()
+        except (IndexError, struct.error):
+            raise ValueError(f"{path}: estructura ISO9660 dañada")
+
+
+class IsoLibrary:
+    """Lista ordenada de ISOs de origen, indexada por ruta y por nombre.
+
+    En /isos del USB los ficheros se guardan por nombre, así que no se admiten
+    dos con el mismo nombre aunque vengan de carpetas distintas.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._names = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, path):
+        return path in self._entries
+
+    def paths(self):
+        return list(self._entries)
+
+    def path_for(self, name):
+        return self._names.get(name)
+
+    def add(self, path):
+        """Añade `path`; devuelve False si ya está esa ruta o ese nombre."""
+        name = os.path.basename(path)
+        if path in self._entries or name in self._names:
+            return False
+        self._entries[path] = name
+        self._names[name] = path
+        return True
+
+    def remove(self, path):
+        name = self._entries.pop(path, None)
+        if name is not None:
+            del self._names[name]
+
+
+class IsoLibraryIndex:
+    """Índice persistente de los ISOs que hay bajo unas carpetas raíz.
+
+    Cada raíz se recorre entera una sola vez; después el índice se carga del
+    disco al instante y se mantiene al día con inotify o, en sistemas de
+    ficheros de red (donde inotify no ve los cambios hechos desde otras
+    máquinas), comparando cada `poll_seconds` el mtime de las carpetas
+    conocidas y releyendo solo las que cambiaron. Por ISO guarda tamaño,
+    mtime, SHA-256 (si ya está en `hash_cache`) y familia de arranque
+    (`boot_info(ruta)`). `on_change()` se llama desde el hilo de fondo.
+    """
+
+    def __init__(
+        self,
+        hash_cache,
+        boot_info,
+        index_file=LIBRARY_INDEX_FILE,
+        on_change=None,
+        poll_seconds=LIBRARY_POLL_SECONDS,
+        mountinfo_path="/proc/self/mountinfo",
+    ):
+        self.hash_cache = hash_cache
+        self.boot_info = boot_info
+        self.index_file = index_file
+        self.on_change = on_change
+        self.poll_seconds = poll_seconds
+        self.mountinfo_path = mountinfo_path
+        self.mode = None
+        self._lock = threading.Lock()
+        self._roots = []
+        self._entries = {}
+        self._dirs = {}
+        # carpeta -> rutas de sus ISOs / subcarpetas conocidas, para no
+        # recorrer el índice entero en cada relectura
+        self._files_in = {}
+        self._subdirs_in = {}
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == LIBRARY_INDEX_VERSION:
+            self._roots = data.get("roots", [])
+            self._entries = data.get("entries", {})
+            self._dirs = data.get("dirs", {})
+            for path in self._entries:
+                self._link(self._files_in, path)
+            for path in self._dirs:
+                self._link(self._subdirs_in, path)
+
+    def _save(self):
+        with self._lock:
+            data = {
+                "version": LIBRARY_INDEX_VERSION,
+                "roots": list(self._roots),
+                "entries": dict(self._entries),
+                "dirs": dict(self._dirs),
+            }
+        try:
+            write_json_atomic(self.index_file, data)
+        except OSError:
+            pass
+
+    def roots(self):
+        with self._lock:
+            return list(self._roots)
+
+    def paths(self):
+        with self._lock:
+            return sorted(self._entries)
+
+    def entry(self, path):
+        with self._lock:
+            return dict(self._entries.get(path) or {})
+
+    def add_root(self, path):
+        """Añade una carpeta raíz; se recorre en el hilo de fondo."""
+        path = os.path.abspath(path)
+        with self._lock:
+            if path in self._roots:
+                return False
+            self._roots.append(path)
+        self._save()
+        self._wake()
+        return True
+
+    def remove_root(self, path):
+        with self._lock:
+            if path not in self._roots:
+                return False
+            self._roots.remove(path)
+            self._forget_locked(path, self._roots)
+        self._save()
+        self._notify()
+        self._wake()
+        return True
+
+    def record_hash(self, path, digest):
+        """Anota un SHA-256 recién calculado si `path` está en la biblioteca."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry.get("sha256") == digest:
+                return
+            entry["sha256"] = digest
+        self._save()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _wake(self):
+        os.write(self._wake_w, b"x")
+
+    def _notify(self):
+        if self.on_change:
+            self.on_change()
+
+    @staticmethod
+    def _inside(path, directory):
+        return path == directory or path.startswith(directory.rstrip("/") + "/")
+
+    @staticmethod
+    def _link(index, path):
+        index.setdefault(os.path.dirname(path), set()).add(path)
+
+    @staticmethod
+    def _unlink(index, path):
+        parent = os.path.dirname(path)
+        siblings = index.get(parent)
+        if siblings is not None:
+            siblings.discard(path)
+            if not siblings:
+                del index[parent]
+
+    def _put_entry_locked(self, path, entry):
+        self._entries[path] = entry
+        self._link(self._files_in, path)
+
+    def _pop_entry_locked(self, path):
+        self._entries.pop(path, None)
+        self._unlink(self._files_in, path)
+
+    def _put_dir_locked(self, path, mtime_ns):
+        self._dirs[path] = mtime_ns
+        self._link(self._subdirs_in, path)
+
+    def _pop_dir_locked(self, path):
+        self._dirs.pop(path, None)
+        self._unlink(self._subdirs_in, path)
+
+    def _subtree_locked(self, directory):
+        """Carpetas conocidas en `directory` o por debajo."""
+        found, pending = [], [directory]
+        while pending:
+            path = pending.pop()
+            if path in self._dirs:
+                found.append(path)
+            pending.extend(self._subdirs_in.get(path, ()))
+        return found
+
+    def _forget_locked(self, directory, keep_roots=()):
+        """Olvida las carpetas e ISOs bajo `directory` salvo lo que cubra `keep_roots`."""
+        pending = [directory]
+        while pending:
+            path = pending.pop()
+            if any(self._inside(path, root) for root in keep_roots):
+                continue
+            for entry_path in list(self._files_in.get(path, ())):
+                self._pop_entry_locked(entry_path)
+            pending.extend(self._subdirs_in.get(path, ()))
+            self._pop_dir_locked(path)
+
+    def _describe(self, path, st, old):
+        if old and (old.get("size"), old.get("mtime_ns")) == (
+            st.st_size,
+            st.st_mtime_ns,
+        ):
+            if old.get("sha256"):
+                return old
+            return dict(old, sha256=self.hash_cache.lookup(path))
+        info = self.boot_info(path)
+        return {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": self.hash_cache.lookup(path),
+            "family": info.get("family") if info else None,
+        }
+
+    def _rescan_dir(self, directory):
+        """Relee una carpeta (y entera cualquier subcarpeta nueva). Devuelve si cambió algo."""
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                children = list(it)
+        except OSError:
+            with self._lock:
+                known = directory in self._dirs
+                self._forget_locked(directory)
+            return known
+        changed = False
+        files, subdirs = {}, set()
+        for child in children:
+            try:
+                if child.is_dir(follow_symlinks=False):
+                    subdirs.add(child.path)
+                elif child.name.lower().endswith(".iso") and child.is_file():
+                    files[child.path] = child.stat()
+            except OSError:
+                continue
+        with self._lock:
+            self._put_dir_locked(directory, mtime_ns)
+            old_entries = {
+                path: self._entries[path] for path in self._files_in.get(directory, ())
+            }
+            gone_dirs = self._subdirs_in.get(directory, set()) - subdirs
+        for path in set(old_entries) - set(files):
+            with self._lock:
+                self._pop_entry_locked(path)
+            changed = True
+        for path, st in files.items():
+            entry = self._describe(path, st, old_entries.get(path))
+            if entry is not old_entries.get(path):
+                with self._lock:
+                    self._put_entry_locked(path, entry)
+                changed = True
+        for path in gone_dirs:
+            with self._lock:
+                self._forget_locked(path)
+            changed = True
+        for path in subdirs:
+            with self._lock:
+                known = path in self._dirs
+            if not known:
+                changed = self._rescan_tree(path) or changed
+        return changed
+
+    def _rescan_tree(self, directory):
+        changed = self._rescan_dir(directory)
+        with self._lock:
+            subdirs = list(self._subdirs_in.get(directory, ()))
+        for path in subdirs:
+            changed = self._rescan_tree(path) or changed
+        return changed
+
+    def _refresh_root(self, root):
+        """Recorre la raíz si es nueva; si no, relee solo las carpetas cuyo mtime cambió."""
+        with self._lock:
+            known = {path: self._dirs[path] for path in self._subtree_locked(root)}
+        if root not in known:
+            return self._rescan_tree(root)
+        changed = False
+        for directory, mtime_ns in sorted(known.items()):
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime_ns:
+                changed = self._rescan_dir(directory) or changed
+        return changed
+
+    def _refresh_roots(self, roots):
+        # un recorrido puede inspeccionar miles de ISOs: una sola escritura de la caché
+        with self.hash_cache.batch():
+            return any([self._refresh_root(root) for root in roots])
+
+    def _is_network(self, root):
+        return filesystem_type(root, self.mountinfo_path) in NETWORK_FILESYSTEMS
+
+    def _run(self):
+        try:
+            inotify = _Inotify()
+        except (OSError, AttributeError):
+            inotify = None
+        while True:
+            roots = self.roots()
+            if self._refresh_roots(roots):
+                self._save()
+                self._notify()
+            watched = []
+            if inotify is not None:
+                inotify.clear()
+                for root in roots:
+                    if self._is_network(root):
+                        continue
+                    with self._lock:
+                        directories = self._subtree_locked(root)
+                    try:
+                        for directory in directories:
+                            try:
+                                inotify.add_watch(directory)
+                            except FileNotFoundError:
+                                # borrada entretanto: lo dirá el evento de su padre
+                                continue
+                        watched.append(root)
+                    except OSError:
+                        # p. ej. límite de max_user_watches: esa raíz se sondea
+                        pass
+            polled = [root for root in roots if root not in watched]
+            self.mode = (
+                "inotify" if not polled else "sondeo" if not watched else "mixto"
+            )
+            self._wait_for_changes(inotify, watched, polled)
+
+    def _wait_for_changes(self, inotify, watched, polled):
+        """Atiende eventos hasta que hay que rehacer las vigilancias (raíces o
+        carpetas nuevas, o desbordamiento de la cola de inotify)."""
+        fds = [self._wake_r] + ([inotify.fd] if inotify and watched else [])
+        deadline = time.monotonic() + self.poll_seconds
+        while True:
+            timeout = max(0.0, deadline - time.monotonic()) if polled else None
+            ready, _, _ = select.select(fds, [], [], timeout)
+            if self._wake_r in ready:
+                os.read(self._wake_r, 4096)
+                return
+            if not ready:
+                if self._refresh_roots(polled):
+                    self._save()
+                    self._notify()
+                deadline = time.monotonic() + self.poll_seconds
+                continue
+            # agrupar los eventos de una misma copia o renombrado
+            time.sleep(LIBRARY_SETTLE_SECONDS)
+            events = inotify.read()
+            if any(mask & IN_Q_OVERFLOW for _, mask, _ in events):
+                return
+            dirty = {directory for directory, _, _ in events if directory}
+            changed = False
+            with self.hash_cache.batch():
+                for directory in sorted(dirty):
+                    changed = self._rescan_dir(directory) or changed
+            if changed:
+                self._save()
+                self._notify()
+            # las carpetas nuevas solo pueden colgar de las que se han releído
+            with self._lock:
+                new_dirs = [
+                    d
+                    for directory in dirty
+                    for d in self._subdirs_in.get(directory, ())
+                    if d not in inotify.watched
+                ]
+            if any(any(self._inside(d, root) for root in watched) for d in new_dirs):
+                # hay carpetas nuevas que vigilar
+                return
+
+
+class IsoHashCache:
+    """Índice persistente de metadatos derivados de los ISOs de origen.
+
+    Cada entrada se identifica por (dispositivo, inodo, tamaño, mtime_ns), así
+    que un fichero modificado o sustituido deja de coincidir y se vuelve a
+    hashear. Los ficheros nuevos se hashean en un hilo en segundo plano.
+    """
+
+    def __init__(self, cache_file=HASH_CACHE_FILE, chunk_size=VERIFY_CHUNK_SIZE):
+        self.cache_file = cache_file
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._entries = None
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._thread = None
+        self._batch_depth = 0
+        self._dirty = 0
+
+    @staticmethod
+    def key_for(path, st=None):
+        st = st or os.stat(path)
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.cache_file) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _get_locked(self, path, field):
+        try:
+            entry = self._load().get(self.key_for(path))
+        except OSError:
+            return None
+        return entry.get(field) if entry else None
+
+    def get(self, path, field="sha256"):
+        """Devuelve el valor guardado para el fichero tal como está ahora, o None."""
+        with self._lock:
+            return self._get_locked(path, field)
+
+    def lookup(self, path):
+        return self.get(path, "sha256")
+
+    def put(self, path, st=None, **fields):
+        """Guarda metadatos del fichero.
+
+        Con `st` (el stat tomado antes de calcularlos) no se guarda nada si el
+        fichero ha cambiado entretanto.
+        """
+        try:
+            key = self.key_for(path)
+        except OSError:
+            return
+        if st is not None and self.key_for(path, st) != key:
+            return
+        path = os.path.abspath(path)
+        with self._lock:
+            entries = self._load()
+            entry = entries.get(key)
+            if entry is None:
+                # las versiones anteriores del mismo fichero ya no sirven
+                for old_key in [k for k, e in entries.items() if e.get("path") == path]:
+                    del entries[old_key]
+                entry = entries[key] = {"path": path}
+            entry.update(fields)
+            entry["updated"] = int(time.time())
+            self._dirty += 1
+            if not self._batch_depth or self._dirty >= HASH_CACHE_BATCH_LIMIT:
+                self._flush_locked()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Agrupa los `put` del bloque: el fichero se reescribe al salir (y cada
+        HASH_CACHE_BATCH_LIMIT cambios), no una vez por fichero."""
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if not self._batch_depth and self._dirty:
+                    self._flush_locked()
+
+    def _flush_locked(self):
+        self._dirty = 0
+        try:
+            write_json_atomic(self.cache_file, self._entries)
+        except OSError:
+            pass
+
+    def hash_file(self, path):
+        """Calcula el SHA-256 de `path`, lo guarda en la caché y lo devuelve."""
+        st = os.stat(path)
+        digest = file_sha256(path, self.chunk_size)
+        self.put(path, st, sha256=digest)
+        return digest
+
+    def hash_in_background(self, paths, on_done=None):
+        """Encola los ficheros sin resumen en caché; `on_done(path, digest, error)`
+        se llama desde el hilo de fondo al terminar cada uno.
+
+        Devuelve los que ya estaban en caché como {ruta: resumen}.
+        """
+        cached = {}
+        with self._lock:
+            for path in paths:
+                digest = self._get_locked(path, "sha256")
+                if digest:
+                    cached[path] = digest
+                elif path not in self._pending:
+                    self._pending.add(path)
+                    self._queue.put((path, on_done))
+            if self._pending and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return cached
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._queue.empty():
+                    self._thread = None
+                    return
+                path, on_done = self._queue.get()
+            try:
+                digest, error = self.hash_file(path), None
+            except OSError as e:
+                digest, error = None, e
+            with self._lock:
+                self._pending.discard(path)
+            if on_done:
+                on_done(path, digest, error)
+
+
+class UsbManifest:
+    """Índice versionado de los ISOs instalados, guardado en la raíz del USB.
+
+    Por cada ISO anota tamaño, mtime, SHA-256 y huella rápida del origen, el
+    resultado de inspect_iso y su entrada de grub.cfg, para listar el USB o
+    regenerar el menú sin recorrer /isos ni volver a inspeccionar nada. Una
+    entrada solo vale mientras el fichero conserve el tamaño y el mtime.
+    """
+
+    def __init__(self, mount_point, isos=None):
+        self.path = os.path.join(mount_point, MANIFEST_FILE)
+        self.isos = isos if isos is not None else {}
+
+    @classmethod
+    def load(cls, mount_point):
+        """Lee el manifiesto del USB; None si no existe o es de otra versión."""
+        try:
+            with open(os.path.join(mount_point, MANIFEST_FILE)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get("version") != MANIFEST_VERSION:
+            return None
+        return cls(mount_point, data.get("isos") or {})
+
+    def names(self):
+        return sorted(self.isos)
+
+    def entry(self, name, path):
+        """Entrada de `name` si sigue describiendo el fichero `path`, o None."""
+        entry = self.isos.get(name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if entry and (entry.get("size"), entry.get("mtime_ns")) == (
+            st.st_size,
+            st.st_mtime_ns,
+        ):
+            return entry
+        return None
+
+    def fingerprint(self, name, path):
+        entry = self.entry(name, path)
+        return entry.get("fingerprint") if entry else None
+
+    def add(self, name, path, **fields):
+        """Actualiza la entrada de `name`; si el fichero cambió, la rehace."""
+        entry = self.entry(name, path)
+        if entry is None:
+            st = os.stat(path)
+            entry = self.isos[name] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        entry.update({k: v for k, v in fields.items() if v is not None})
+        return entry
+
+    def remove(self, name):
+        self.isos.pop(name, None)
+
+    def retain(self, names):
+        for name in set(self.isos) - set(names):
+            del self.isos[name]
+
+    def save(self):
+        write_json_atomic(
+            self.path,
+            {
+                "version": MANIFEST_VERSION,
+                "updated": int(time.time()),
+                "isos": self.isos,
+            },
+        )
+
+
+def verify_file_direct(
+    path, expected_hexdigest, on_chunk=None, chunk_size=VERIFY_CHUNK_SIZE
+):
+    """Relee `path` sin pasar por la caché de páginas y compara su SHA-256.
+
+    Usa O_DIRECT para leer lo que realmente guarda la memoria flash. Si el
+    sistema de ficheros no lo admite, vacía la caché del fichero con
+    posix_fadvise(DONTNEED) y lee de forma normal. Devuelve (coincide, modo).
+    """
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+    for mode in ("O_DIRECT", "fadvise"):
+        if mode == "O_DIRECT":
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                continue
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        hasher = StreamHasher()
+        # mmap anónimo: buffers alineados a página, como exige O_DIRECT
+        free_q = queue.Queue()
+        for _ in range(2):
+            free_q.put(mmap.mmap(-1, chunk_size))
+        pos = 0
+        try:
+            # una lectura corta no es el final: se sigue hasta leer 0 bytes
+            # o llegar al tamaño del fichero
+            size = os.fstat(fd).st_size
+            while True:
+                buf = free_q.get()
+                try:
+                    n = os.preadv(fd, [buf], pos)
+                except OSError as e:
+                    if mode == "O_DIRECT" and pos == 0 and e.errno == errno.EINVAL:
+                        break
+                    raise
+                if n:
+                    hasher.feed(memoryview(buf)[:n], lambda b=buf: free_q.put(b))
+                    pos += n
+                    if on_chunk:
+                        on_chunk(n)
+                if n == 0 or pos >= size:
+                    return hasher.hexdigest() == expected_hexdigest, mode
+        finally:
+            hasher.close()
+            os.close(fd)
+    raise OSError(errno.EIO, f"No se pudo releer {path} para verificarlo")
+
+
+class CopyResult:
+    """Resumen de una copia: método usado, bytes, duración y ocupación de la cola."""
+
+    def __init__(self, method, bytes_copied, elapsed, queue_stats=None, probe=None):
+        self.method = method
+        self.bytes_copied = bytes_copied
+        self.elapsed = elapsed
+        self.queue_stats = queue_stats or {}
+        self.chunk_size = probe.size if probe else None
+        self.autotuned = bool(probe and probe.autotuned)
+
+    def describe(self):
+        speed_mb = self.bytes_copied / max(self.elapsed, 0.001) / (1024 * 1024)
+        text = f"método: {self.method}, {speed_mb:.2f} MB/s"
+        if self.chunk_size:
+            text += f", bloque {self.chunk_size // 1024} KiB"
+            if self.autotuned:
+                text += " (autoajustado)"
+        qs = self.queue_stats
+        if qs.get("samples"):
+            avg = qs["occupancy_sum"] / qs["samples"]
+            if qs["reader_wait"] > qs["writer_wait"]:
+                bottleneck = "escritura (USB)"
+            else:
+                bottleneck = "lectura (origen)"
+            text += (
+                f", cola media {avg:.1f}/{qs['depth']}"
+                f", espera lector {qs['reader_wait']:.1f}s"
+                f", espera escritor {qs['writer_wait']:.1f}s"
+                f", cuello de botella: {bottleneck}"
+            )
+        return text
+
+
+class CopyEngine:
+    """Copia ISOs dejando que el kernel mueva los datos cuando es posible.
+
+    Prueba los métodos de `methods` en orden: copy_file_range (sin pasar por
+    espacio de usuario), sendfile, un pipeline lector/escritor con buffers
+    reutilizables y, como último recurso, el bucle clásico read/write. Si un
+    método falla a mitad de copia por no ser aplicable, el siguiente continúa
+    desde el mismo offset.
+    """
+
+    def __init__(
+        self,
+        methods=COPY_METHODS,
+        chunk_size=COPY_CHUNK_SIZE,
+        pipeline_depth=COPY_PIPELINE_DEPTH,
+    ):
+        self.methods = tuple(methods)
+        self.chunk_size = chunk_size
+        self.pipeline_depth = max(2, pipeline_depth)
+
+    def copy(self, src_path, dst_path, on_chunk=None, probe=None, hasher=None):
+        """Copia src_path en dst_path llamando a on_chunk(n) tras cada bloque.
+
+        `probe` (ChunkSizeProbe) decide el tamaño de bloque durante la copia;
+        sin él se usa `chunk_size`. Con `hasher` (StreamHasher) los datos de
+        origen se hashean al vuelo, por lo que solo se usan los métodos que
+        pasan por espacio de usuario. Devuelve un CopyResult con el método que
+        completó la copia.
+        """
+        start_t = time.monotonic()
+        with (
+            open(src_path, "rb", buffering=0) as fsrc,
+            open(dst_path, "wb", buffering=0) as fdst,
+        ):
+            preallocate(fdst.fileno(), os.fstat(fsrc.fileno()).st_size)
+            return self.copy_fds(
+                fsrc.fileno(), fdst.fileno(), 0, on_chunk, probe, start_t, hasher
+            )
+
+    def copy_fds(
+        self,
+        fd_src,
+        fd_dst,
+        offset,
+        on_chunk=None,
+        probe=None,
+        start_t=None,
+        hasher=None,
+    ):
+        """Copia desde `offset` hasta el final de fd_src en la misma posición de fd_dst."""
+        if probe is None:
+            probe = ChunkSizeProbe(fixed=self.chunk_size)
+        if start_t is None:
+            start_t = time.monotonic()
+        size = os.fstat(fd_src).st_size
+        methods = self.methods
+        if hasher is not None:
+            methods = [m for m in methods if m in USERSPACE_COPY_METHODS]
+        for method in methods:
+            copier = getattr(self, f"_copy_{method}", None)
+            if copier is None:
+                continue
+            stats = {}
+            try:
+                # closing(): si on_chunk lanza (p. ej. OperationCancelled) el
+                # generador se cierra ya, y el pipeline detiene y espera a su
+                # hilo lector antes de que el llamante cierre los descriptores
+                with contextlib.closing(
+                    copier(fd_src, fd_dst, offset, size, stats, probe, hasher)
+                ) as chunks:
+                    for n in chunks:
+                        offset += n
+                        probe.observe(n, fd_dst)
+                        if on_chunk:
+                            on_chunk(n)
+                return CopyResult(
+                    method, offset, time.monotonic() - start_t, stats, probe
+                )
+            except OSError as e:
+                if e.errno not in _COPY_FALLBACK_ERRNOS:
+                    raise
+        raise OSError("Ningún método de copia pudo completar la copia")
+
+    def _copy_copy_file_range(self, fd_src, fd_dst, offset, size, stats, probe, hasher):
+        if not hasattr(os, "copy_file_range"):
+            raise CopyUnsupportedError(errno.ENOSYS, "copy_file_range no disponible")
+        while True:
+            n = os.copy_file_range(
+                fd_src, fd_dst, probe.size, offset_src=offset, offset_dst=offset
+            )
+            if n == 0:
+                if offset < size:
+                    # Algunos kernels devuelven 0 en vez de EXDEV entre sistemas de ficheros
+                    raise CopyUnsupportedError(
+                        errno.EXDEV, "copy_file_range incompleto"
+                    )
+                return
+            offset += n
+            yield n
+
+    def _copy_sendfile(self, fd_src, fd_dst, offset, size, stats, probe, hasher):
+        os.lseek(fd_dst, offset, os.SEEK_SET)
+        while True:
+            n = os.sendfile(fd_dst, fd_src, offset, probe.size)
+            if n == 0:
+                if offset < size:
+                    raise CopyUnsupportedError(errno.EINVAL, "sendfile incompleto")
+                return
+            offset += n
+            yield n
+
+    def _copy_pipeline(self, fd_src, fd_dst, offset, size, stats, probe, hasher):
+        # Anillo de buffers preasignados: el hilo lector los rellena con preadv
+        # mientras este generador (escritor) vacía los ya leídos al USB.
+        free_q = queue.Queue()
+        filled_q = queue.Queue()
+        for _ in range(self.pipeline_depth):
+            free_q.put(memoryview(bytearray(probe.max_size)))
+        stats.update(
+            depth=self.pipeline_depth,
+            samples=0,
+            occupancy_sum=0,
+            reader_wait=0.0,
+            writer_wait=0.0,
+        )
+        reader_error = []
+        stop = threading.Event()
+
+        def reader():
+            pos = offset
+            try:
+                while True:
+                    t0 = time.monotonic()
+                    buf = free_q.get()
+                    stats["reader_wait"] += time.monotonic() - t0
+                    if buf is None or stop.is_set():
+                        return
+                    n = os.preadv(fd_src, [buf[: probe.size]], pos)
+                    if n == 0:
+                        return
+                    pos += n
+                    filled_q.put((buf, n))
+            except OSError as e:
+                reader_error.append(e)
+            finally:
+                filled_q.put(None)
+
+        reader_thread = threading.Thread(target=reader, daemon=True)
+        reader_thread.start()
+        pos = offset
+        try:
+            while True:
+                stats["samples"] += 1
+                stats["occupancy_sum"] += filled_q.qsize()
+                t0 = time.monotonic()
+                item = filled_q.get()
+                stats["writer_wait"] += time.monotonic() - t0
+                if item is None:
+                    break
+                buf, n = item
+                view = buf[:n]
+                while view:
+                    written = os.pwrite(fd_dst, view, pos)
+                    pos += written
+                    view = view[written:]
+                if hasher is not None:
+                    # El buffer vuelve al anillo cuando el hilo de hash termina con él
+                    hasher.feed(buf[:n], lambda b=buf: free_q.put(b))
+                else:
+                    free_q.put(buf)
+                yield n
+            if reader_error:
+                raise reader_error[0]
+        finally:
+            stop.set()
+            free_q.put(None)
+            reader_thread.join()
+
+    def _copy_readwrite(self, fd_src, fd_dst, offset, size, stats, probe, hasher):
+        os.lseek(fd_src, offset, os.SEEK_SET)
+        os.lseek(fd_dst, offset, os.SEEK_SET)
+        while True:
+            chunk = os.read(fd_src, probe.size)
+            if not chunk:
+                return
+            view = memoryview(chunk)
+            while view:
+                written = os.write(fd_dst, view)
+                view = view[written:]
+            if hasher is not None:
+                hasher.feed(chunk)
+            yield len(chunk)
+
+
+class ResumableCopy:
+    """Copia un ISO a `<destino>.part` de forma que se pueda reanudar.
+
+    Cada CHECKPOINT_INTERVAL_BYTES se sincroniza el USB y se guarda en
+    `<destino>.resume.json` la identidad del origen, el offset ya escrito y
+    la huella (quick_fingerprint) de ese prefijo. Si la copia se interrumpe,
+    el siguiente intento comprueba que origen y parcial siguen coincidiendo
+    hasta ese offset y continúa desde allí. Al cancelar no se crea un punto
+    de control nuevo (vaciar hasta un intervalo entero de datos a un USB lento
+    llevaría decenas de segundos): vale el último ya sincronizado. `commit` renombra el
+    parcial al nombre final.
+    """
+
+    def __init__(self, src_path, dest_path, interval=CHECKPOINT_INTERVAL_BYTES):
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.partial_path = dest_path + PARTIAL_SUFFIX
+        self.checkpoint_path = dest_path + CHECKPOINT_SUFFIX
+        self.interval = interval
+
+    @staticmethod
+    def _identity(st):
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    def resume_offset(self):
+        """Offset comprobado desde el que continuar, o 0 si no hay nada reutilizable."""
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+            offset = int(checkpoint["offset"])
+            if checkpoint["source"] != self._identity(os.stat(self.src_path)):
+                return 0
+            if os.path.getsize(self.partial_path) < offset:
+                return 0
+            fingerprint = checkpoint["prefix_fingerprint"]
+            for path in (self.src_path, self.partial_path):
+                if quick_fingerprint(path, length=offset) != fingerprint:
+                    return 0
+            return offset
+        except (OSError, ValueError, KeyError, TypeError):
+            return 0
+
+    def _save_checkpoint(self, fd_dst, offset, identity):
+        os.fdatasync(fd_dst)
+        write_json_atomic(
+            self.checkpoint_path,
+            {
+                "source": identity,
+                "offset": offset,
+                "prefix_fingerprint": quick_fingerprint(self.src_path, length=offset),
+            },
+        )
+
+    def run(self, copy_engine, offset=0, on_chunk=None, probe=None, hasher=None):
+        """Copia desde `offset` (ver resume_offset) hasta el final en el parcial.
+
+        Con `hasher` el prefijo ya copiado se vuelve a leer del origen para que
+        el resumen cubra el ISO entero. Devuelve el CopyResult de esta pasada.
+        """
+        if offset == 0:
+            self.discard()
+        src_stat = os.stat(self.src_path)
+        identity = self._identity(src_stat)
+        start_t = time.monotonic()
+        with open(self.src_path, "rb", buffering=0) as fsrc:
+            fd_src = fsrc.fileno()
+            fd_dst = os.open(self.partial_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            written = offset
+            try:
+                # lo escrito tras el último punto de control no está comprobado
+                os.ftruncate(fd_dst, offset)
+                preallocate(fd_dst, src_stat.st_size)
+                pos = 0
+                while hasher is not None and pos < offset:
+                    data = os.pread(fd_src, min(VERIFY_CHUNK_SIZE, offset - pos), pos)
+                    if not data:
+                        break
+                    hasher.feed(data)
+                    pos += len(data)
+                next_checkpoint = offset + self.interval
+
+                def on_copied(n):
+                    nonlocal written, next_checkpoint
+                    written += n
+                    if written >= next_checkpoint:
+                        self._save_checkpoint(fd_dst, written, identity)
+                        next_checkpoint = written + self.interval
+                    if on_chunk:
+                        on_chunk(n)
+
+                result = copy_engine.copy_fds(
+                    fd_src, fd_dst, offset, on_copied, probe, start_t, hasher
+                )
+            finally:
+                os.close(fd_dst)
+        result.bytes_copied -= offset
+        return result
+
+    def commit(self):
+        os.replace(self.partial_path, self.dest_path)
+        with contextlib.suppress(OSError):
+            os.remove(self.checkpoint_path)
+
+    def discard(self):
+        for path in (self.partial_path, self.checkpoint_path):
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+
+def partition_ready(partition_path, start_sector=None):
+    """True si el kernel ya expone la partición como nodo de bloque y en sysfs
+    y, con `start_sector`, si empieza donde se espera (tabla ya releída)."""
+    start_file = os.path.join(
+        SYS_CLASS_BLOCK_DIR, os.path.basename(partition_path), "start"
+    )
+    try:
+        if not stat.S_ISBLK(os.stat(partition_path).st_mode):
+            return False
+        with open(start_file) as f:
+            start = int(f.read())
+    except (OSError, ValueError):
+        return False
+    return start_sector is None or start == start_sector
+
+
+def _mbr_chs(lba, heads=MBR_CHS_HEADS, sectors=MBR_CHS_SECTORS):
+    """Campos CHS de 3 bytes de una entrada MBR (1023/254/63 si no cabe)."""
+    cylinder = lba // (heads * sectors)
+    if cylinder > 1023:
+        return b"\xfe\xff\xff"
+    head = (lba // sectors) % heads
+    sector = lba % sectors + 1
+    return bytes((head, sector | ((cylinder >> 2) & 0xC0), cylinder & 0xFF))
+
+
+def disk_geometry(fd):
+    """(cabezas, sectores por pista) que da el kernel para el disco, o los de
+    MBR_CHS_* si no da ninguna; parted calcula los campos CHS igual."""
+    try:
+        heads, sectors = struct.unpack_from(
+            "=BB", fcntl.ioctl(fd, HDIO_GETGEO, bytes(struct.calcsize("=BBHL")))
+        )
+    except OSError:
+        return MBR_CHS_HEADS, MBR_CHS_SECTORS
+    if not heads or not sectors:
+        return MBR_CHS_HEADS, MBR_CHS_SECTORS
+    return heads, sectors
+
+
+def build_mbr(
+    total_sectors,
+    disk_id,
+    sector_size=512,
+    geometry=(MBR_CHS_HEADS, MBR_CHS_SECTORS),
+    old_sector=None,
+):
+    """Sector 0 con una única partición arrancable de tipo 0x07 desde 1 MiB hasta el final.
+
+    Es la tabla que dejan `parted mklabel msdos`, `mkpart primary ntfs 1MiB
+    100%` y `set 1 boot on`. Como parted, si `old_sector` ya tiene código de
+    arranque se conserva y solo se rehace la tabla. Diferencia deliberada:
+    en un sector vacío parted copia su código de arranque genérico y aquí
+    queda a cero; en ambos casos grub-install lo sobrescribe justo después.
+    """
+    start = PARTITION1_ALIGNMENT // sector_size
+    # MBR direcciona como mucho 2^32 sectores
+    count = min(total_sectors - start, 0xFFFFFFFF)
+    if count <= 0:
+        raise ValueError(f"Disco demasiado pequeño ({total_sectors} sectores)")
+    entry = (
+        bytes((MBR_BOOT_FLAG,))
+        + _mbr_chs(start, *geometry)
+        + bytes((MBR_PARTITION_TYPE_EXFAT,))
+        + _mbr_chs(start + count - 1, *geometry)
+        + struct.pack("<II", start, count)
+    )
+    if old_sector and len(old_sector) >= 512 and old_sector[0]:
+        mbr = bytearray(old_sector[:sector_size].ljust(sector_size, b"\0"))
+        # tabla nueva: las otras tres entradas quedan vacías
+        mbr[MBR_PARTITION_TABLE_OFFSET:510] = bytes(510 - MBR_PARTITION_TABLE_OFFSET)
+    else:
+        mbr = bytearray(sector_size)
+    struct.pack_into("<I", mbr, MBR_DISK_ID_OFFSET, disk_id)
+    mbr[MBR_PARTITION_TABLE_OFFSET : MBR_PARTITION_TABLE_OFFSET + 16] = entry
+    mbr[510:512] = MBR_SIGNATURE
+    return bytes(mbr)
+
+
+def write_mbr(device_path):
+    """Escribe la tabla MBR de la aplicación (ver build_mbr) y pide al kernel releerla.
+
+    El sector 0 se escribe con un único pwrite; si el disco tenía GPT se
+    borran también sus dos cabeceras. Conserva el identificador de disco
+    existente (o genera uno, como parted) y toma la geometría CHS del kernel.
+    Devuelve True si el kernel releyó la tabla con BLKRRPART; False si no
+    pudo (p. ej. EBUSY) y hay que recurrir a partprobe.
+    """
+    fd = os.open(device_path, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        is_block = stat.S_ISBLK(os.fstat(fd).st_mode)
+        if is_block:
+            size = struct.unpack(
+                "=Q", fcntl.ioctl(fd, BLKGETSIZE64, struct.pack("=Q", 0))
+            )[0]
+            sector_size = struct.unpack(
+                "=i", fcntl.ioctl(fd, BLKSSZGET, struct.pack("=i", 0))
+            )[0]
+            geometry = disk_geometry(fd)
+        else:
+            size, sector_size = os.fstat(fd).st_size, 512
+            geometry = (MBR_CHS_HEADS, MBR_CHS_SECTORS)
+        total_sectors = size // sector_size
+        old = os.pread(fd, sector_size, 0)
+        disk_id = (
+            struct.unpack_from("<I", old, MBR_DISK_ID_OFFSET)[0]
+            if len(old) >= 512
+            else 0
+        )
+        mbr = build_mbr(
+            total_sectors,
+            disk_id or struct.unpack("<I", os.urandom(4))[0],
+            sector_size,
+            geometry,
+            old,
+        )
+        if os.pwrite(fd, mbr, 0) != len(mbr):
+            raise OSError(errno.EIO, f"Escritura incompleta del MBR en {device_path}")
+        for lba in (1, total_sectors - 1):
+            if os.pread(fd, len(GPT_SIGNATURE), lba * sector_size) == GPT_SIGNATURE:
+                os.pwrite(fd, bytes(sector_size), lba * sector_size)
+        os.fsync(fd)
+        if not is_block:
+            return False
+        try:
+            fcntl.ioctl(fd, BLKRRPART)
+        except OSError:
+            return False
+        return True
+    finally:
+        os.close(fd)
+
+
+def wait_for_partition(
+    partition_path, trigger=None, timeout=PARTITION_WAIT_TIMEOUT, start_sector=None
+):
+    """Ejecuta `trigger()` (p. ej. partprobe) y espera a que la partición esté lista.
+
+    En lugar de dormir un tiempo fijo se despierta con cada uevent del kernel
+    (el socket se abre antes del trigger para no perder ninguno) y, si no hay
+    netlink, comprueba cada PARTITION_POLL_SECONDS. Devuelve True si la
+    partición apareció antes de `timeout`.
+    """
+    try:
+        sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+        )
+        sock.bind((0, 1))
+        sock.setblocking(False)
+    except (OSError, AttributeError):
+        sock = None
+    try:
+        if trigger:
+            trigger()
+        deadline = time.monotonic() + timeout
+        while not partition_ready(partition_path, start_sector):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if sock is None:
+                time.sleep(min(remaining, PARTITION_POLL_SECONDS))
+                continue
+            # el sondeo de 1 s solo cubre eventos que no lleguen por netlink
+            readable, _, _ = select.select([sock], [], [], min(remaining, 1.0))
+            while readable:
+                try:
+                    sock.recv(65536)
+                except BlockingIOError:
+                    break
+        return True
+    finally:
+        if sock:
+            sock.close()
+
+
+def _unescape_mountinfo(field):
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def find_mount_point(device_path, mountinfo_path="/proc/self/mountinfo"):
+    """Devuelve dónde está montada la raíz del sistema de ficheros de `device_path`
+    (por nosotros o por el automontador del escritorio), o None."""
+    try:
+        rdev = os.stat(device_path).st_rdev
+        with open(mountinfo_path) as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    wanted = f"{os.major(rdev)}:{os.minor(rdev)}"
+    for line in lines:
+        fields = line.split()
+        # fields[2] = major:minor, fields[3] = raíz dentro del fs, fields[4] = punto de montaje
+        if len(fields) > 4 and fields[2] == wanted and fields[3] == "/":
+            return _unescape_mountinfo(fields[4])
+    return None
+
+
+def filesystem_type(path, mountinfo_path="/proc/self/mountinfo"):
+    """Tipo del sistema de ficheros que contiene `path` (p. ej. 'ext4', 'nfs4')."""
+    path = os.path.realpath(path)
+    best, best_type = "", None
+    try:
+        with open(mountinfo_path) as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    for line in lines:
+        fields = line.split()
+        # tras el separador '-' vienen el tipo, el origen y las opciones
+        if "-" not in fields:
+            continue
+        mount_point = _unescape_mountinfo(fields[4])
+        inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) >= len(best):
+            best, best_type = mount_point, fields[fields.index("-") + 1]
+    return best_type
+
+
+class _Inotify:
+    """Envoltorio mínimo de inotify(7) con ctypes."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.paths = {}
+        self.watched = set()
+
+    def add_watch(self, path, mask=LIBRARY_WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {path}")
+        self.paths[wd] = path
+        self.watched.add(path)
+        return wd
+
+    def clear(self):
+        for wd in list(self.paths):
+            self._libc.inotify_rm_watch(self.fd, wd)
+        self.paths.clear()
+        self.watched.clear()
+
+    def read(self):
+        """Devuelve [(carpeta vigilada, máscara, nombre)] de los eventos pendientes."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset + 16 <= len(data):
+                wd, mask, _cookie, length = struct.unpack_from("iIII", data, offset)
+                name = data[offset + 16 : offset + 16 + length].rstrip(b"\0")
+                events.append((self.paths.get(wd), mask, os.fsdecode(name)))
+                offset += 16 + length
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _MountSession:
+    def __init__(self, path, owned):
+        self.path = path
+        self.owned = owned
+        self.refs = 0
+        self.timer = None
+
+
+class MountManager:
+    """Comparte montajes de particiones entre operaciones consecutivas.
+
+    Si la partición ya está montada (por nosotros o por el escritorio) se usa
+    ese montaje; si no, se monta en un directorio propio. Los montajes propios
+    se cuentan por referencias y se desmontan tras `idle_timeout` segundos sin
+    uso. `run_command(cmd, check=...)` ejecuta mount/umount y devuelve si tuvo
+    éxito.
+    """
+
+    def __init__(
+        self,
+        run_command,
+        mount_base=TEMP_MOUNT_POINT,
+        idle_timeout=MOUNT_IDLE_TIMEOUT,
+        mountinfo_path="/proc/self/mountinfo",
+    ):
+        self.run_command = run_command
+        self.mount_base = mount_base
+        self.idle_timeout = idle_timeout
+        self.mountinfo_path = mountinfo_path
+        self._lock = threading.RLock()
+        self._sessions = {}
+        # particiones que algún hilo está montando (el Event se activa al acabar)
+        self._mounting = {}
+
+    def acquire(self, partition):
+        """Devuelve un punto de montaje de `partition` válido hasta `release`.
+
+        `mount` se ejecuta fuera del cerrojo, para no bloquear a los demás
+        USB; quien pida la misma partición mientras tanto espera a que acabe.
+        """
+        while True:
+            with self._lock:
+                pending = self._mounting.get(partition)
+                if pending is None:
+                    session = self._reuse_locked(partition)
+                    if session is not None:
+                        session.refs += 1
+                        return session.path
+                    pending = self._mounting[partition] = threading.Event()
+                    break
+            pending.wait()
+        try:
+            path = self._mount(partition)
+            with self._lock:
+                session = self._sessions[partition] = _MountSession(path, owned=True)
+                session.refs += 1
+            return path
+        finally:
+            with self._lock:
+                del self._mounting[partition]
+            pending.set()
+
+    def _reuse_locked(self, partition):
+        """Sesión en uso o montaje ajeno de `partition`, o None si hay que montarla."""
+        session = self._sessions.get(partition)
+        if session and session.timer:
+            session.timer.cancel()
+            session.timer = None
+        if session and (
+            find_mount_point(partition, self.mountinfo_path) != session.path
+        ):
+            # desmontado desde fuera mientras estaba en reposo
+            del self._sessions[partition]
+            session = None
+        if session is None:
+            existing = find_mount_point(partition, self.mountinfo_path)
+            if existing:
+                session = self._sessions[partition] = _MountSession(
+                    existing, owned=False
+                )
+        return session
+
+    def release(self, partition):
+        with self._lock:
+            session = self._sessions.get(partition)
+            if session is None or session.refs == 0:
+                return
+            session.refs -= 1
+            if session.refs:
+                return
+            if not session.owned:
+                del self._sessions[partition]
+                return
+            session.timer = threading.Timer(
+                self.idle_timeout, self._expire, (partition, session)
+            )
+            session.timer.daemon = True
+            session.timer.start()
+
+    @contextlib.contextmanager
+    def session(self, partition):
+        path = self.acquire(partition)
+        try:
+            yield path
+        finally:
+            self.release(partition)
+
+    def _mount(self, partition):
+        path = f"{self.mount_base}_{os.path.basename(partition)}"
+        os.makedirs(path, exist_ok=True)
+        if not self.run_command(
+            ["mount", "-t", "exfat", partition, path], check=False
+        ) and not self.run_command(["mount", partition, path], check=False):
+            raise Exception(f"No se pudo montar {partition}")
+        return path
+
+    def _unmount(self, session):
+        if session.timer:
+            session.timer.cancel()
+            session.timer = None
+        if session.owned and os.path.ismount(session.path):
+            if not self.run_command(["umount", session.path], check=False):
+                self.run_command(["umount", "-lf", session.path], check=False)
+
+    def _expire(self, partition, session):
+        with self._lock:
+            if self._sessions.get(partition) is session and session.refs == 0:
+                del self._sessions[partition]
+                self._unmount(session)
+
+    def release_device(self, device_path):
+        """Olvida (y desmonta si son nuestros) los montajes de las particiones de
+        un disco, p. ej. antes de reparticionarlo."""
+        with self._lock:
+            for partition in list(self._sessions):
+                if is_partition_of(partition, device_path):
+                    self._unmount(self._sessions.pop(partition))
+
+    def shutdown(self):
+        """Desmonta todos los montajes propios (al cerrar la aplicación)."""
+        with self._lock:
+            for partition in list(self._sessions):
+                self._unmount(self._sessions.pop(partition))
+
+
+def format_size(num_bytes):
+    """Tamaño legible al estilo de lsblk (p. ej. '14.9G')."""
+    size = float(num_bytes)
+    for unit in ("B", "K", "M", "G", "T"):
+        if size < 1024 or unit == "T":
+            break
+        size /= 1024
+    text = f"{size:.1f}".rstrip("0").rstrip(".")
+    return f"{text}{unit}"
+
+
+class UsbDevice:
+    def __init__(self, path, model, size_bytes, removable):
+        self.path = path
+        self.model = model
+        self.size_bytes = size_bytes
+        self.removable = removable
+
+    def display_name(self):
+        return f"{self.path} - {self.model} ({format_size(self.size_bytes)})"
+
+
+class UsbInventory:
+    """Inventario en memoria de los discos USB leído directamente de /sys/block.
+
+    Con `start()` un hilo escucha los uevents del kernel (socket netlink) y
+    actualiza el inventario al conectar o retirar un USB, llamando a
+    `on_change()`. Si el socket no está disponible se compara /sys/block cada
+    `poll_seconds`.
+    """
+
+    def __init__(
+        self,
+        sys_block=SYS_BLOCK_DIR,
+        on_change=None,
+        poll_seconds=INVENTORY_POLL_SECONDS,
+    ):
+        self.sys_block = sys_block
+        self.on_change = on_change
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._thread = None
+        self.hotplug = None
+
+    def _read_attr(self, name, attr):
+        try:
+            with open(os.path.join(self.sys_block, name, attr)) as f:
+                return f.read().strip()
+        except OSError:
+            return ""
+
+    def read_device(self, name):
+        """Lee un disco de sysfs; devuelve None si no es un disco USB con medio."""
+        device_link = os.path.join(self.sys_block, name, "device")
+        if "/usb" not in os.path.realpath(device_link):
+            return None
+        try:
+            size_bytes = int(self._read_attr(name, "size") or 0) * 512
+        except ValueError:
+            size_bytes = 0
+        if not size_bytes:
+            # lector de tarjetas sin tarjeta
+            return None
+        vendor = self._read_attr(name, "device/vendor")
+        model = " ".join(
+            part for part in (vendor, self._read_attr(name, "device/model")) if part
+        )
+        return UsbDevice(
+            f"/dev/{name}",
+            model or "N/A",
+            size_bytes,
+            self._read_attr(name, "removable") == "1",
+        )
+
+    def rescan(self):
+        """Relee todos los discos de /sys/block. Devuelve True si algo cambió."""
+        devices = {}
+        try:
+            names = os.listdir(self.sys_block)
+        except OSError:
+            names = []
+        for name in names:
+            device = self.read_device(name)
+            if device:
+                devices[device.path] = device
+        with self._lock:
+            changed = self._snapshot(devices) != self._snapshot(self._devices)
+            self._devices = devices
+        return changed
+
+    @staticmethod
+    def _snapshot(devices):
+        return {path: (d.model, d.size_bytes) for path, d in devices.items()}
+
+    def devices(self):
+        with self._lock:
+            return sorted(self._devices.values(), key=lambda d: d.path)
+
+    def start(self):
+        self.rescan()
+        try:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+            )
+            sock.bind((0, 1))  # grupo 1: eventos emitidos por el kernel
+            target, args, self.hotplug = self._listen, (sock,), "netlink"
+        except (OSError, AttributeError):
+            target, args, self.hotplug = self._poll, (), "sondeo"
+        self._thread = threading.Thread(target=target, args=args, daemon=True)
+        self._thread.start()
+
+    def _notify(self):
+        if self.on_change:
+            self.on_change()
+
+    def handle_uevent(self, data):
+        """Aplica un uevent del kernel. Devuelve True si cambió el inventario."""
+        fields = data.split(b"\0")
+        env = dict(
+            field.decode(errors="replace").split("=", 1)
+            for field in fields[1:]
+            if b"=" in field
+        )
+        if env.get("SUBSYSTEM") != "block" or env.get("DEVTYPE") != "disk":
+            return False
+        name = env.get("DEVNAME", "").rsplit("/", 1)[-1]
+        if not name:
+            return False
+        path = f"/dev/{name}"
+        device = None if env.get("ACTION") == "remove" else self.read_device(name)
+        with self._lock:
+            old = self._devices.get(path)
+            if device:
+                self._devices[path] = device
+            else:
+                self._devices.pop(path, None)
+        return self._snapshot({path: device} if device else {}) != self._snapshot(
+            {path: old} if old else {}
+        )
+
+    def _listen(self, sock):
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            if self.handle_uevent(data):
+                self._notify()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            if self.rescan():
+                self._notify()
+
+
+class DeviceProber:
+    """Averigua en segundo plano si un USB es compatible y qué ISOs tiene.
+
+    `inspect(partición)` (normalmente MultibootEngine.inspect_usb) se ejecuta
+    en un único hilo, en orden de petición, para no montar desde la interfaz.
+    El resultado se guarda por dispositivo junto con su tamaño y modelo: si
+    vuelve a pedirse con la misma firma se responde sin montar nada.
+    `invalidate` lo descarta al conectar o retirar el USB o al cambiar su
+    contenido.
+    """
+
+    def __init__(self, inspect):
+        self.inspect = inspect
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._generation = collections.Counter()
+        self._waiting = {}
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @staticmethod
+    def _signature(device):
+        return (device.size_bytes, device.model)
+
+    def cached(self, device):
+        """Devuelve (True, ISOs o None) si hay un resultado válido; si no, (False, None)."""
+        with self._lock:
+            entry = self._cache.get(device.path)
+        if entry and entry[0] == self._signature(device):
+            return True, entry[1]
+        return False, None
+
+    def probe(self, device, on_done, force=False):
+        """Pide el estado de `device`; `on_done(ruta, ISOs o None, error)`.
+
+        Con un resultado en caché (y sin `force`) se llama en el acto y se
+        devuelve True; si no, se llama desde el hilo de fondo. Varias
+        peticiones del mismo USB pendientes a la vez comparten una sola
+        inspección.
+        """
+        found, names = (False, None) if force else self.cached(device)
+        if found:
+            on_done(device.path, names, None)
+            return True
+        with self._lock:
+            key = (device.path, self._generation[device.path])
+            waiting = self._waiting.get(key)
+            if waiting is not None:
+                waiting.append(on_done)
+                return False
+            self._waiting[key] = [on_done]
+            self._queue.put((device, key[1]))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return False
+
+    def store(self, device, names):
+        """Guarda un resultado conocido (p. ej. tras aplicar cambios en el USB)."""
+        with self._lock:
+            self._cache[device.path] = (self._signature(device), names)
+
+    def invalidate(self, device_path):
+        with self._lock:
+            self._cache.pop(device_path, None)
+            self._generation[device_path] += 1
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._queue.empty():
+                    self._thread = None
+                    return
+                device, generation = self._queue.get()
+            try:
+                names, error = self.inspect(partition_path_for(device.path)), None
+            except Exception as e:
+                names, error = None, e
+            with self._lock:
+                # si se invalidó mientras se inspeccionaba, el resultado ya no vale
+                if error is None and self._generation[device.path] == generation:
+                    self._cache[device.path] = (self._signature(device), names)
+                callbacks = self._waiting.pop((device.path, generation), [])
+            for on_done in callbacks:
+                on_done(device.path, names, error)
+
+
+class DeviceJob:
+    """Estado de un USB durante una creación, posiblemente en paralelo con otros."""
+
+    def __init__(self, device_path, partition1, model=None):
+        self.device_path = device_path
+        self.partition1 = partition1
+        self.model = model
+        self.mount_point = f"{TEMP_MOUNT_POINT}_{os.path.basename(device_path)}"
+        self.phase = "Pendiente"
+        self.error = None
+        self.copied_iso = 0
+        self.copied_total = 0
+        self.iso_filenames = []
+        # {nombre: {"sha256": ..., "fingerprint": ...}} para el manifiesto
+        self.iso_records = {}
+
+
+class FanOutTarget:
+    """Destino de una copia en abanico: fichero, callback de progreso y estado."""
+
+    def __init__(self, key, dst_path, on_chunk=None):
+        self.key = key
+        self.dst_path = dst_path
+        self.on_chunk = on_chunk
+        self.queue = queue.Queue()
+        self.written = 0
+        self.stall = 0.0
+        self.detached = False
+        self.error = None
+        self.result = None
+
+
+class _FanOutBlock:
+    __slots__ = ("buf", "n", "offset", "refs")
+
+    def __init__(self, buf, n, offset, refs):
+        self.buf = buf
+        self.n = n
+        self.offset = offset
+        self.refs = refs
+
+
+class FanOutCopier:
+    """Lee cada ISO una sola vez y reparte sus bloques a varios USB.
+
+    Cada destino tiene su propio hilo escritor. Los bloques leídos se
+    comparten (contador de referencias) y vuelven al anillo cuando todos los
+    destinos los han escrito. Si el anillo se queda sin buffers durante
+    `lag_timeout` segundos, el destino más retrasado se desengancha y termina
+    la copia por su cuenta desde el origen, sin frenar al resto. Un fallo de
+    escritura solo afecta a su destino.
+    """
+
+    def __init__(
+        self,
+        engine=None,
+        chunk_size=COPY_CHUNK_SIZE,
+        ring_size=FANOUT_RING_SIZE,
+        lag_timeout=FANOUT_LAG_TIMEOUT,
+    ):
+        self.engine = engine or CopyEngine(chunk_size=chunk_size)
+        self.chunk_size = chunk_size
+        self.ring_size = max(2, ring_size)
+        self.lag_timeout = lag_timeout
+
+    def copy(self, src_path, targets, hasher=None, token=None):
+        """Copia src_path en todos los `targets` (FanOutTarget).
+
+        Con `hasher` (StreamHasher) el origen se hashea una sola vez al leerlo.
+        Con `token` (CancelToken) la lectura se detiene al pausar o cancelar.
+        Al terminar, cada destino tiene `result` (CopyResult) o `error`.
+        """
+        start_t = time.monotonic()
+        free_q = queue.Queue()
+        for _ in range(self.ring_size):
+            free_q.put(bytearray(self.chunk_size))
+        refs_lock = threading.Lock()
+
+        def release(block):
+            with refs_lock:
+                block.refs -= 1
+                last_ref = block.refs == 0
+            if last_ref:
+                free_q.put(block.buf)
+
+        writers = []
+        for target in targets:
+            writer = threading.Thread(
+                target=self._writer,
+                args=(src_path, target, release, start_t),
+                daemon=True,
+            )
+            writer.start()
+            writers.append(writer)
+        try:
+            with open(src_path, "rb", buffering=0) as fsrc:
+                fd_src = fsrc.fileno()
+                offset = 0
+                while True:
+                    if token is not None:
+                        token.check()
+                    buf = self._get_free_buffer(free_q, targets, token)
+                    if buf is None:
+                        break
+                    n = os.preadv(fd_src, [buf], offset)
+                    if n == 0:
+                        break
+                    live = self._live_targets(targets)
+                    refs = len(live) + (1 if hasher is not None else 0)
+                    block = _FanOutBlock(buf, n, offset, refs)
+                    if hasher is not None:
+                        hasher.feed(memoryview(buf)[:n], lambda b=block: release(b))
+                    for target in live:
+                        target.queue.put(block)
+                    offset += n
+        except (OSError, OperationCancelled) as e:
+            for target in self._live_targets(targets):
+                target.error = e
+        finally:
+            for target in targets:
+                target.queue.put(None)
+            for writer in writers:
+                writer.join()
+        return targets
+
+    @staticmethod
+    def _live_targets(targets):
+        return [t for t in targets if t.error is None and not t.detached]
+
+    def _get_free_buffer(self, free_q, targets, token=None):
+        # El tiempo que el lector espera por un buffer se achaca al destino con
+        # más bloques pendientes; al acumular lag_timeout se le desengancha.
+        # Mientras la operación está en pausa no se achaca a nadie.
+        while True:
+            live = self._live_targets(targets)
+            if not live:
+                return None
+            try:
+                return free_q.get_nowait()
+            except queue.Empty:
+                pass
+            t0 = time.monotonic()
+            try:
+                buf = free_q.get(timeout=self.lag_timeout)
+            except queue.Empty:
+                buf = None
+            if len(live) > 1 and not (token is not None and token.paused):
+                slowest = max(live, key=lambda t: t.queue.qsize())
+                slowest.stall += time.monotonic() - t0
+                if slowest.stall >= self.lag_timeout:
+                    slowest.detached = True
+            if buf is not None:
+                return buf
+
+    def _writer(self, src_path, target, release, start_t):
+        fd_dst = None
+        method = "fanout"
+        try:
+            fd_dst = os.open(
+                target.dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644
+            )
+            preallocate(fd_dst, os.path.getsize(src_path))
+        except OSError as e:
+            target.error = e
+        while True:
+            block = target.queue.get()
+            if block is None:
+                break
+            try:
+                if target.error is None and not target.detached:
+                    view = memoryview(block.buf)[: block.n]
+                    pos = block.offset
+                    while view:
+                        written = os.pwrite(fd_dst, view, pos)
+                        pos += written
+                        view = view[written:]
+                    target.written += block.n
+                    if target.on_chunk:
+                        target.on_chunk(block.n)
+            except (OSError, OperationCancelled) as e:
+                target.error = e
+            finally:
+                release(block)
+        try:
+            if target.error is None and target.detached:
+                # Desenganchado por lento: continuar en solitario desde lo ya escrito
+                method = "fanout+solo"
+                with open(src_path, "rb", buffering=0) as fsrc:
+                    self.engine.copy_fds(
+                        fsrc.fileno(), fd_dst, target.written, target.on_chunk
+                    )
+            if target.error is None:
+                target.result = CopyResult(
+                    method, os.fstat(fd_dst).st_size, time.monotonic() - start_t
+                )
+        except (OSError, OperationCancelled) as e:
+            target.error = e
+        finally:
+            if fd_dst is not None:
+                os.close(fd_dst)
+
+
+class LogSink:
+    """Cola de líneas de log segura entre hilos, con fichero rotativo opcional.
+
+    `write` no bloquea a quien registra (hilos de copia, salida de comandos);
+    la interfaz recoge las líneas por lotes con `drain`. Si nadie las recoge,
+    la cola se queda en las `max_records` más recientes.
+    """
+
+    def __init__(self, max_records=LOG_QUEUE_MAX_RECORDS):
+        self._records = collections.deque()
+        self._max_records = max_records
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._file_handler = None
+
+    def open_file(
+        self, path=LOG_FILE, max_bytes=LOG_FILE_MAX_BYTES, backups=LOG_FILE_BACKUPS
+    ):
+        """Copia además cada línea a `path`, rotándolo al llegar a `max_bytes`."""
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        with self._lock:
+            old, self._file_handler = self._file_handler, handler
+        if old is not None:
+            old.close()
+
+    def write(self, message):
+        with self._lock:
+            if len(self._records) >= self._max_records:
+                self._records.popleft()
+                self._dropped += 1
+            self._records.append(message)
+            handler = self._file_handler
+        if handler is not None:
+            handler.handle(logging.makeLogRecord({"msg": message}))
+
+    def drain(self, max_records=None):
+        """Saca hasta `max_records` líneas pendientes (todas si es None)."""
+        with self._lock:
+            count = len(self._records)
+            if max_records is not None:
+                count = min(count, max_records)
+            lines = [self._records.popleft() for _ in range(count)]
+            if self._dropped:
+                lines.insert(0, f"({self._dropped} líneas de log descartadas)")
+                self._dropped = 0
+        return lines
+
+    def close(self):
+        with self._lock:
+            handler, self._file_handler = self._file_handler, None
+        if handler is not None:
+            handler.close()
+
+
+class ProgressTracker:
+    """Progreso compartido de una operación (crear o gestionar).
+
+    Los hilos de trabajo solo actualizan contadores con `update`; quien
+    muestra el progreso llama a `sample` con su propio temporizador. La
+    velocidad es una media móvil exponencial con constante de tiempo
+    PROGRESS_EWMA_SECONDS, así que las ETA siguen a la velocidad reciente
+    (p. ej. cuando se llena la caché SLC del USB) y no a la media global.
+    """
+
+    def __init__(self, ewma_seconds=PROGRESS_EWMA_SECONDS):
+        self.ewma_seconds = ewma_seconds
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, text=None):
+        """Deja el progreso en reposo mostrando `text` (o nada)."""
+        now = time.monotonic()
+        with self._lock:
+            self._active = False
+            self._text = text
+            self._total = 0
+            self._copied = 0
+            self._step_base = 0
+            self._step_start = now
+            self._overall_total = None
+            self._overall_copied = 0
+            self._moved = 0
+            self._sample_t = now
+            self._sample_moved = 0
+            self._speed = None
+            self._instant = None
+
+    def begin_overall(self, total):
+        """Empieza a contar el total de la operación (`total` bytes)."""
+        with self._lock:
+            self._overall_total = total
+            self._overall_copied = 0
+
+    def begin_step(self, text, total, copied=0):
+        """Empieza un paso (copiar o verificar un ISO) de `total` bytes.
+
+        `copied` es lo que ya estaba hecho (p. ej. al reanudar una copia) y no
+        cuenta para la velocidad.
+        """
+        with self._lock:
+            self._active = True
+            self._text = text
+            self._total = total
+            self._copied = copied
+            self._step_base = copied
+            self._step_start = time.monotonic()
+
+    def update(self, copied, overall_copied=None):
+        """Fija los bytes hechos del paso actual (y del total, si se indica)."""
+        with self._lock:
+            if copied > self._copied:
+                self._moved += copied - self._copied
+            self._copied = copied
+            if overall_copied is not None:
+                self._overall_copied = overall_copied
+
+    def sample(self):
+        """Devuelve el estado actual como dict y actualiza la media de velocidad.
+
+        Claves: active, text, copied, total, speed (media móvil), instant,
+        average (media del paso), eta y eta_total; las velocidades en bytes/s
+        y las ETA en segundos, None mientras no se puedan estimar.
+        """
+        now = time.monotonic()
+        with self._lock:
+            dt = now - self._sample_t
+            if dt >= PROGRESS_MIN_SAMPLE_SECONDS:
+                instant = (self._moved - self._sample_moved) / dt
+                if self._speed is not None:
+                    weight = 1 - math.exp(-dt / self.ewma_seconds)
+                    self._speed += weight * (instant - self._speed)
+                elif instant > 0:
+                    self._speed = instant
+                self._instant = instant
+                self._sample_t = now
+                self._sample_moved = self._moved
+            speed = self._speed
+            elapsed = now - self._step_start
+            eta = eta_total = None
+            if speed:
+                eta = max(0, self._total - self._copied) / speed
+                if self._overall_total is not None:
+                    eta_total = (
+                        max(0, self._overall_total - self._overall_copied) / speed
+                    )
+            return {
+                "active": self._active,
+                "text": self._text,
+                "copied": self._copied,
+                "total": self._total,
+                "speed": speed,
+                "instant": self._instant,
+                "average": (
+                    (self._copied - self._step_base) / elapsed if elapsed > 0 else None
+                ),
+                "eta": eta,
+                "eta_total": eta_total,
+            }
+
+
+def communicate_with_rusage(process):
+    """Como Popen.communicate(), pero devuelve también el rusage del hijo.
+
+    El rusage (CPU y bloques leídos/escritos) solo se puede obtener al
+    recoger el proceso; es None si otro hilo lo recogió antes (poll/kill).
+    """
+    stderr_chunks = []
+    reader = threading.Thread(
+        target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True
+    )
+    reader.start()
+    stdout = process.stdout.read()
+    reader.join()
+    process.stdout.close()
+    process.stderr.close()
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        process.wait()
+        rusage = None
+    else:
+        process.returncode = os.waitstatus_to_exitcode(status)
+    return stdout, stderr_chunks[0] if stderr_chunks else "", rusage
+
+
+class JobTrace:
+    """Tramos cronometrados de una operación, exportables como traza de Chrome.
+
+    `span()` mide un bloque en el hilo que lo ejecuta (cada USB tiene su
+    hilo, con el nombre del dispositivo); el diccionario que devuelve admite
+    datos extra (bytes, código de salida...) que acaban en `args` del evento.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.started = time.time()
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+
+    @contextlib.contextmanager
+    def span(self, name, category="paso", **args):
+        start = time.perf_counter()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = str(e) or type(e).__name__
+            raise
+        finally:
+            self.add(name, start, time.perf_counter(), category, **args)
+
+    def add(self, name, start, end, category="paso", **args):
+        """Registra un tramo ya medido (instantes de time.perf_counter())."""
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self._origin) * 1e6),
+            "dur": round((end - start) * 1e6),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args,
+        }
+        with self._lock:
+            self._threads.setdefault(thread.ident, thread.name)
+            self._events.append(event)
+
+    def to_chrome(self):
+        pid = os.getpid()
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        metadata = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": 0,
+                "args": {"name": f"multiboot {self.operation}"},
+            }
+        ] + [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in threads.items()
+        ]
+        return {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {"operation": self.operation, "started": self.started},
+        }
+
+    def save(self, directory=TRACE_DIR, keep=TRACE_KEEP):
+        """Escribe la traza en `directory` y borra las más antiguas de la misma operación."""
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        stamp += f".{int(self.started * 1000) % 1000:03d}"
+        path = os.path.join(directory, f"{self.operation}-{stamp}.json")
+        write_json_atomic(path, self.to_chrome())
+        old_traces = sorted(
+            name
+            for name in os.listdir(directory)
+            if name.startswith(f"{self.operation}-") and name.endswith(".json")
+        )
+        for name in old_traces[:-keep]:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(directory, name))
+        return path
+
+    def summary(self):
+        """Líneas de una tabla por tramo: veces, tiempo total, máximo y datos.
+
+        Con varios hilos (un USB por hilo) se indica también en cuál fue el máximo.
+        """
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        rows = {}
+        for event in events:
+            row = rows.setdefault(
+                event["name"], {"count": 0, "total": 0, "max": -1, "bytes": 0}
+            )
+            row["count"] += 1
+            row["total"] += event["dur"]
+            row["bytes"] += event["args"].get("bytes", 0)
+            if event["dur"] > row["max"]:
+                row["max"] = event["dur"]
+                row["where"] = threads.get(event["tid"], "")
+        show_where = len(threads) > 1
+        width = max((len(name) for name in rows), default=5)
+        lines = [
+            f"{'Tramo':<{width}}  {'Veces':>5}  {'Total':>9}  {'Máximo':>9}  "
+            f"{'Datos':>8}" + ("  Máximo en" if show_where else "")
+        ]
+        for name, row in sorted(rows.items(), key=lambda item: -item[1]["total"]):
+            lines.append(
+                f"{name:<{width}}  {row['count']:>5}  {row['total'] / 1e6:>8.2f}s  "
+                f"{row['max'] / 1e6:>8.2f}s  "
+                f"{format_size(row['bytes']) if row['bytes'] else '-':>8}"
+                + (f"  {row['where']}" if show_where else "")
+            )
+        return lines
+
+
+class OperationCancelled(Exception):
+    """La operación se canceló a petición del usuario."""
+
+    def __init__(self, message="Operación cancelada por el usuario."):
+        super().__init__(message)
+
+
+class CancelToken:
+    """Cancelación y pausa cooperativas de una operación larga.
+
+    Los bucles de copia llaman a `check()` entre bloques: espera mientras la
+    operación está en pausa y lanza OperationCancelled si se ha cancelado.
+    Los comandos registrados con `register` se detienen con SIGSTOP/SIGCONT
+    al pausar/reanudar y se terminan (SIGTERM y, si no basta, SIGKILL) al
+    cancelar.
+    """
+
+    def __init__(self):
+        # reentrante: cancel() puede llegar desde un manejador de señales
+        self._lock = threading.RLock()
+        self._running = threading.Event()
+        self._processes = set()
+        self.reset()
+
+    def reset(self):
+        """Deja el token listo para una operación nueva."""
+        with self._lock:
+            self.cancelled = False
+            self.paused = False
+            self._running.set()
+
+    def check(self):
+        self._running.wait()
+        if self.cancelled:
+            raise OperationCancelled()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            self.paused = False
+            self._running.set()
+            processes = list(self._processes)
+        for process in processes:
+            self._signal(process, signal.SIGTERM)
+            self._signal(process, signal.SIGCONT)
+        if processes:
+            timer = threading.Timer(CANCEL_KILL_SECONDS, self._kill, (processes,))
+            timer.daemon = True
+            timer.start()
+
+    def pause(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.paused = True
+            self._running.clear()
+            processes = list(self._processes)
+        for process in processes:
+            self._signal(process, signal.SIGSTOP)
+
+    def resume(self):
+        with self._lock:
+            self.paused = False
+            self._running.set()
+            processes = list(self._processes)
+        for process in processes:
+            self._signal(process, signal.SIGCONT)
+
+    def register(self, process):
+        """Asocia un subprocess.Popen en curso a la operación."""
+        with self._lock:
+            self._processes.add(process)
+            cancelled, paused = self.cancelled, self.paused
+        if cancelled:
+            self._signal(process, signal.SIGTERM)
+        elif paused:
+            self._signal(process, signal.SIGSTOP)
+
+    def unregister(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    @staticmethod
+    def _signal(process, signum):
+        try:
+            process.send_signal(signum)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _kill(processes):
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+
+
+class EngineListener:
+    """Recibe lo que el motor quiere mostrar; por defecto lo ignora.
+
+    Los métodos se llaman desde los hilos de trabajo. El progreso de las
+    copias no pasa por aquí: se muestrea de MultibootEngine.progress.
+    """
+
+    def log(self, message):
+        pass
+
+    def device_status(self, device_path, phase=None, progress=None):
+        pass
+
+    def confirm(self, title, message):
+        return True
+
+
+class ManageResult:
+    """Resultado de aplicar cambios o sincronizar un USB ya creado."""
+
+    def __init__(self):
+        self.names_on_usb = None  # ISOs en /isos al terminar; None si se desconoce
+        self.added = []
+        self.removed = []
+        self.failed = []
+        self.error = None
+        self.cancelled = False
+        self.message = ""
+
+
+def missing_dependencies():
+    """Devuelve los comandos externos necesarios que no están instalados."""
+    return [dep for dep in REQUIRED_COMMANDS if shutil.which(dep) is None]
+
+
+class MultibootEngine:
+    """Particionado, formateo, GRUB, copia de ISOs y grub.cfg, sin interfaz.
+
+    La GUI y la línea de comandos lo usan igual: todo lo que hay que mostrar
+    o preguntar pasa por `listener` (ver EngineListener), y el progreso de
+    cada operación se lee de `progress["create"]` y `progress["manage"]`.
+    `tokens` tiene el CancelToken de cada una para pausarla o cancelarla.
+    """
+
+    def __init__(self, listener=None):
+        self.listener = listener or EngineListener()
+        self.copy_engine = CopyEngine()
+        self.chunk_tuner = ChunkSizeTuner()
+        self.hash_cache = IsoHashCache()
+        self.mount_manager = MountManager(self.run_command)
+        self.device_models = {}
+        self.progress = {"create": ProgressTracker(), "manage": ProgressTracker()}
+        self.tokens = {"create": CancelToken(), "manage": CancelToken()}
+        # JobTrace de la operación que ejecuta cada hilo (ver _traced)
+        self._trace_local = threading.local()
+
+    def log(self, message):
+        self.listener.log(message)
+
+    def run_command(
+        self,
+        command_list,
+        check=True,
+        capture_output=False,
+        log_cmd=True,
+        token=None,
+    ):
+        """Ejecuta un comando externo; con `token` se puede pausar o cancelar."""
+        if token is not None:
+            token.check()
+        if log_cmd:
+            self.log(f"Ejecutando: {' '.join(command_list)}")
+        try:
+            start_t = time.perf_counter()
+            process = subprocess.Popen(
+                command_list,
+                text=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            if token is not None:
+                token.register(process)
+            try:
+                stdout, stderr, rusage = communicate_with_rusage(process)
+            finally:
+                if token is not None:
+                    token.unregister(process)
+            self._trace_command(command_list, start_t, process.returncode, rusage)
+            if token is not None and token.cancelled:
+                raise OperationCancelled(f"{command_list[0]} interrumpido.")
+            if stdout and log_cmd:
+                self.log(f"Salida: {stdout.strip()}")
+            if stderr and log_cmd:
+                self.log(f"Stderr: {stderr.strip()}")
+            if check and process.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    process.returncode,
+                    command_list,
+                    output=stdout,
+                    stderr=stderr,
+                )
+            return stdout.strip() if capture_output else True
+        except subprocess.CalledProcessError as e:
+            self.log(
+                f"Error ejecutando comando '{' '.join(e.cmd)}': Código {e.returncode}"
+            )
+            if e.stdout:
+                self.log(f"  Stdout del error: {e.stdout.strip()}")
+            if e.stderr:
+                self.log(f"  Stderr del error: {e.stderr.strip()}")
+            return False
+        except FileNotFoundError:
+            self.log(f"Error: Comando '{command_list[0]}' no encontrado.")
+            return False
+
+    # ----- Trazas -----
+
+    def _trace_command(self, command_list, start_t, returncode, rusage):
+        trace = getattr(self._trace_local, "trace", None)
+        if trace is None:
+            return
+        args = {"cmd": " ".join(command_list), "exit": returncode}
+        if rusage is not None:
+            # ru_inblock/ru_oublock cuentan bloques de 512 bytes
+            args["bytes"] = (rusage.ru_inblock + rusage.ru_oublock) * 512
+            args["cpu_s"] = round(rusage.ru_utime + rusage.ru_stime, 3)
+        trace.add(
+            os.path.basename(command_list[0]),
+            start_t,
+            time.perf_counter(),
+            "comando",
+            **args,
+        )
+
+    def _span(self, name, **args):
+        """Tramo de la traza de la operación en curso en este hilo (si la hay)."""
+        trace = getattr(self._trace_local, "trace", None)
+        if trace is None:
+            return contextlib.nullcontext(args)
+        return trace.span(name, **args)
+
+    @contextlib.contextmanager
+    def _traced(self, operation):
+        """Traza la operación entera; al acabar la guarda y resume sus tramos en el log."""
+        trace = JobTrace(operation)
+        self._trace_local.trace = trace
+        try:
+            with trace.span(operation, "operación"):
+                yield trace
+        finally:
+            self._trace_local.trace = None
+            try:
+                path = trace.save()
+            except OSError as e:
+                path = None
+                self.log(f"Advertencia: no se pudo guardar la traza: {e}")
+            self.log(f"Tiempos de '{operation}':")
+            for line in trace.summary():
+                self.log(f"  {line}")
+            if path:
+                self.log(f"Traza guardada en {path} (ábrela en chrome://tracing).")
+
+    # ----- Creación -----
+
+    def _set_device_phase(self, job, phase, progress=None):
+        job.phase = phase
+        self.listener.device_status(job.device_path, phase, progress)
+
+    def _run_for_each_device(self, jobs, func):
+        """Ejecuta func(job) en paralelo para cada USB; un fallo solo descarta ese USB."""
+
+        trace = getattr(self._trace_local, "trace", None)
+
+        def run(job):
+            self._trace_local.trace = trace
+            try:
+                func(job)
+            except OperationCancelled as e:
+                job.error = e
+                self._set_device_phase(job, "Cancelado")
+            except Exception as e:
+                job.error = e
+                self.log(f"ERROR en {job.device_path}: {e}")
+                self._set_device_phase(job, f"Error: {e}")
+
+        threads = [
+            threading.Thread(target=run, args=(job,), name=job.device_path, daemon=True)
+            for job in jobs
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def create(self, iso_list_paths, devices, use_image_cache=False, verify=False):
+        """Crea el USB multiboot en cada (dispositivo, partición 1) de `devices`.
+
+        Devuelve los DeviceJob; los USB que fallan llevan el motivo en
+        `job.error`. Si no se crea ninguno se lanza una excepción, y si se
+        cancela con tokens["create"], OperationCancelled (tras desmontar).
+        """
+        token = self.tokens["create"]
+        token.reset()
+        jobs = [
+            DeviceJob(device_path, partition1, self.device_models.get(device_path))
+            for device_path, partition1 in devices
+        ]
+        with self._traced("create"):
+            try:
+                if use_image_cache:
+                    self._create_from_image_cache(iso_list_paths, jobs, verify)
+                else:
+                    # 1-4. Desmontar, particionar, formatear, montar e instalar GRUB (en paralelo)
+                    self._run_for_each_device(jobs, self._prepare_device_for_create)
+                    token.check()
+                    active_jobs = [job for job in jobs if job.error is None]
+                    if not active_jobs:
+                        raise Exception("No se pudo preparar ningún USB.")
+
+                    # 5. Copiar ISOs (cada ISO se lee una sola vez aunque haya varios USB)
+                    self._copy_isos_to_devices(iso_list_paths, active_jobs, verify)
+                    token.check()
+
+                    # 6-7. Generar grub.cfg y desmontar
+                    self._run_for_each_device(
+                        active_jobs, self._finalize_created_device
+                    )
+            finally:
+                for job in jobs:
+                    if os.path.ismount(job.mount_point):
+                        self.run_command(
+                            ["umount", "-lf", job.mount_point],
+                            check=False,
+                            log_cmd=False,
+                        )
+        if not any(job.error is None for job in jobs):
+            raise Exception(
+                "\n".join(f"{job.device_path}: {job.error}" for job in jobs)
+            )
+        return jobs
+
+    def _unmount_device_partitions(self, device_path):
+        self.log(f"Desmontando particiones en {device_path}...")
+        self.mount_manager.release_device(device_path)
+        try:
+            result = self.run_command(
+                ["lsblk", "-no", "MOUNTPOINT,NAME", device_path],
+                capture_output=True,
+                log_cmd=False,
+            )
+            if result and isinstance(result, str) and result.strip():
+                for line in result.strip().split("\n"):
+                    parts = line.split()
+                    if len(parts) > 1 and parts[0] and parts[0] != "[SWAP]":
+                        mountpoint = parts[0]
+                        part_name_suffix = parts[-1].split("/")[-1]
+                        partition_to_umount = f"/dev/{part_name_suffix}"
+                        self.log(
+                            f"Intentando desmontar {partition_to_umount} de {mountpoint}..."
+                        )
+                        self.run_command(["umount", partition_to_umount], check=False)
+                        self.run_command(
+                            ["umount", "-lf", partition_to_umount], check=False
+                        )
+        except Exception as e:
+            self.log(f"Error durante desmontaje (puede ser normal): {e}")
+
+    def _prepare_device_for_create(self, job):
+        device_path, device_partition1 = job.device_path, job.partition1
+        token = self.tokens["create"]
+        self.log(f"Worker: Usando {device_path}, part {device_partition1} con exFAT")
+        # 1. Desmontar
+        self._set_device_phase(job, "Desmontando")
+        with self._span("Desmontar"):
+            self._unmount_device_partitions(device_path)
+
+        # 2. Particionar y formatear
+        self._set_device_phase(job, "Particionando")
+        with self._span("Particionar"):
+            reread = self._partition_device(device_path, token)
+        self.log("Releyendo tabla...")
+        self._wait_for_partition(device_path, device_partition1, partprobe=not reread)
+        token.check()
+        self._set_device_phase(job, "Formateando (exFAT)")
+        self.log(f"Formateando {device_partition1} como exFAT...")
+        mkfs_cmd = ["mkfs.exfat", "-n", USB_VOLUME_LABEL, device_partition1]
+        with self._span("Formatear"):
+            if not self.run_command(mkfs_cmd, token=token):
+                self._wait_for_partition(device_path, device_partition1)
+                if not self.run_command(mkfs_cmd, token=token):
+                    raise Exception(f"Fallo formatear {device_partition1} exFAT")
+
+        # 3. Montar
+        self._set_device_phase(job, "Montando")
+        with self._span("Montar"):
+            self._mount_created_device(job)
+
+        # 4. Instalar GRUB
+        self._set_device_phase(job, "Instalando GRUB")
+        with self._span("Instalar GRUB"):
+            self._install_grub(job, token)
+        self._set_device_phase(job, "Listo para copiar")
+
+    def _partition_device(self, device_path, token):
+        """Escribe la tabla MBR sin parted; devuelve True si el kernel ya la releyó."""
+        token.check()
+        self.log(f"Escribiendo tabla de particiones MBR en {device_path}...")
+        try:
+            return write_mbr(device_path)
+        except (OSError, ValueError) as e:
+            raise Exception(f"Fallo escribir la tabla de particiones: {e}")
+
+    def _mount_created_device(self, job):
+        device_partition1 = job.partition1
+        self.run_command(["umount", job.mount_point], check=False, log_cmd=False)
+        if not os.path.exists(job.mount_point):
+            self.run_command(["mkdir", "-p", job.mount_point])
+        mount_cmd_exfat = ["mount", "-t", "exfat", device_partition1, job.mount_point]
+        mount_cmd_auto = ["mount", device_partition1, job.mount_point]
+        if not self.run_command(mount_cmd_exfat, check=False):
+            if not self.run_command(mount_cmd_auto):
+                raise Exception(f"Fallo mount {device_partition1}")
+
+    def _install_grub(self, job, token):
+        device_path = job.device_path
+        grub_boot_dir = os.path.join(job.mount_point, "boot")
+        grub_install_cmd = [
+            "grub-install",
+            f"--boot-directory={grub_boot_dir}",
+            "--target=i386-pc",
+            "--no-floppy",
+            device_path,
+        ]
+        if not self.run_command(grub_install_cmd, token=token):
+            grub_install_cmd.append("--force")
+            if not self.run_command(grub_install_cmd, token=token):
+                raise Exception(f"Fallo instalar GRUB2 en {device_path}")
+        if not self.run_command(["mkdir", "-p", os.path.join(job.mount_point, "isos")]):
+            raise Exception(f"No se pudo crear /isos en {device_path}")
+
+    def _wait_for_partition(self, device_path, device_partition1, partprobe=True):
+        """Sigue en cuanto la partición 1 está lista; con `partprobe`, relee antes la tabla."""
+        trigger = None
+        if partprobe:
+            trigger = lambda: self.run_command(["partprobe", device_path], check=False)
+        start_t = time.monotonic()
+        with self._span("Esperar partición") as span:
+            ready = wait_for_partition(
+                device_partition1, trigger, start_sector=PARTITION1_START_SECTOR
+            )
+            if shutil.which("udevadm"):
+                # que udev termine de sondear la partición antes de formatearla
+                self.run_command(
+                    ["udevadm", "settle", f"--timeout={int(PARTITION_WAIT_TIMEOUT)}"],
+                    check=False,
+                    log_cmd=False,
+                )
+            span["ready"] = ready
+        if ready:
+            self.log(f"{device_partition1} lista en {time.monotonic() - start_t:.1f}s.")
+        else:
+            self.log(
+                f"Advertencia: {device_partition1} no apareció en {PARTITION_WAIT_TIMEOUT:.0f}s."
+            )
+        return ready
+
+    def _create_from_image_cache(self, iso_list_paths, jobs, verify=False):
+        """Crea los USB volcando una imagen en caché (construyéndola si no existe)."""
+        if shutil.which("losetup") is None:
+            raise Exception("El modo caché de imagen necesita 'losetup' (util-linux).")
+        image_size = min(block_device_size(job.device_path) for job in jobs)
+        grub_version = (
+            self.run_command(
+                ["grub-install", "--version"], capture_output=True, log_cmd=False
+            )
+            or ""
+        )
+        key = image_cache_key(iso_list_paths, grub_version, image_size)
+        image_path = os.path.join(IMAGE_CACHE_DIR, f"{key}.img")
+        if os.path.exists(image_path):
+            self.log(f"Usando imagen en caché: {image_path}")
+        else:
+            self.log(f"Imagen no encontrada en caché; construyendo {image_path}...")
+            with self._span("Construir imagen"):
+                self._build_cached_image(
+                    iso_list_paths, image_path, image_size, grub_version, verify
+                )
+
+        writer = SparseImageWriter()
+        data_size = writer.data_size(image_path)
+        text = f"Escribiendo imagen ({data_size / (1024 * 1024):.0f} MiB con datos)"
+        self.progress["create"].begin_overall(data_size)
+        self.progress["create"].begin_step(text, data_size)
+        for job in jobs:
+            job.copied_iso = 0
+        on_chunk_for = self._make_create_progress_callbacks(
+            [(job, None) for job in jobs], data_size, text
+        )
+
+        def write_image(job):
+            self._set_device_phase(job, "Desmontando")
+            with self._span("Desmontar"):
+                self._unmount_device_partitions(job.device_path)
+            self._set_device_phase(job, text)
+            with self._span("Volcar imagen", bytes=data_size):
+                writer.write(image_path, job.device_path, on_chunk_for(job))
+            self.run_command(["partprobe", job.device_path], check=False)
+            self.log(f"Imagen escrita en {job.device_path}.")
+            self._set_device_phase(job, "Completado", "100%")
+
+        self._run_for_each_device(jobs, write_image)
+        self.tokens["create"].check()
+
+    def _build_cached_image(
+        self, iso_list_paths, image_path, image_size, grub_version, verify=False
+    ):
+        """Construye la imagen sobre un fichero disperso montado con losetup."""
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        partial_path = f"{image_path}.partial"
+        with open(partial_path, "wb") as f:
+            f.truncate(image_size)
+        loop_device = self.run_command(
+            ["losetup", "--find", "--show", "--partscan", partial_path],
+            capture_output=True,
+        )
+        if not loop_device:
+            os.remove(partial_path)
+            raise Exception(f"No se pudo asociar {partial_path} a un dispositivo loop")
+        job = DeviceJob(loop_device, partition_path_for(loop_device))
+        try:
+            self._prepare_device_for_create(job)
+            self._copy_isos_to_devices(iso_list_paths, [job], verify)
+            if len(job.iso_filenames) != len(iso_list_paths):
+                raise Exception("No se copiaron todos los ISOs a la imagen.")
+            self._finalize_created_device(job)
+        except Exception:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        finally:
+            if os.path.ismount(job.mount_point):
+                self.run_command(
+                    ["umount", "-lf", job.mount_point], check=False, log_cmd=False
+                )
+            self.run_command(["losetup", "-d", loop_device], check=False)
+        os.replace(partial_path, image_path)
+        write_json_atomic(
+            f"{image_path[: -len('.img')]}.json",
+            {
+                "format": IMAGE_CACHE_FORMAT,
+                "grub_version": grub_version,
+                "image_size": image_size,
+                "isos": job.iso_filenames,
+                "created": int(time.time()),
+            },
+        )
+        self.log(f"Imagen guardada en caché: {image_path}")
+
+    def _make_create_progress_callbacks(
+        self, entries, size_iso, iso_label, count_total=True
+    ):
+        """Devuelve on_chunk(job) -> callback que avanza el progreso según el USB más lento.
+
+        `entries` es una lista de (job, FanOutTarget o None); los destinos que ya
+        han fallado en este ISO no cuentan.
+        """
+        tracker = self.progress["create"]
+        token = self.tokens["create"]
+        lock = threading.Lock()
+        last_status_t = time.monotonic()
+
+        def live_jobs():
+            live = [
+                job for job, target in entries if target is None or target.error is None
+            ]
+            return live or [job for job, _ in entries]
+
+        def for_job(job):
+            def on_chunk(n):
+                nonlocal last_status_t
+                token.check()
+                with lock:
+                    job.copied_iso += n
+                    if count_total:
+                        job.copied_total += n
+                    live = live_jobs()
+                    tracker.update(
+                        min(j.copied_iso for j in live),
+                        min(j.copied_total for j in live) if count_total else None,
+                    )
+                    now = time.monotonic()
+                    if now - last_status_t < DEVICE_STATUS_INTERVAL:
+                        return
+                    last_status_t = now
+                    for j, _ in entries:
+                        pct = j.copied_iso * 100 // size_iso if size_iso else 100
+                        self.listener.device_status(j.device_path, iso_label, f"{pct}%")
+
+            return on_chunk
+
+        return for_job
+
+    def _copy_isos_to_devices(self, iso_list_paths, jobs, verify=False):
+        tracker = self.progress["create"]
+        token = self.tokens["create"]
+        tracker.begin_overall(sum(os.path.getsize(p) for p in iso_list_paths))
+        fanout = FanOutCopier(self.copy_engine) if len(jobs) > 1 else None
+        # Los más grandes primero, mientras el USB aún tiene huecos contiguos grandes
+        copy_order = sorted(iso_list_paths, key=os.path.getsize, reverse=True)
+        for idx, iso_path in enumerate(copy_order):
+            token.check()
+            live_jobs = [job for job in jobs if job.error is None]
+            if not live_jobs:
+                break
+            iso_filename = os.path.basename(iso_path)
+            text = f"Copiando ({idx + 1}/{len(iso_list_paths)}): {iso_filename}"
+            src_stat = os.stat(iso_path)
+            size_iso = src_stat.st_size
+            tracker.begin_step(text, size_iso)
+            for job in live_jobs:
+                job.copied_iso = 0
+                job.phase = text
+            # El SHA-256 del origen se calcula durante la copia si la caché
+            # no lo conoce: lo usan la verificación y el manifiesto del USB
+            source_digest = self.hash_cache.lookup(iso_path)
+            hasher = StreamHasher() if not source_digest else None
+            # Se copia a nombre.iso.part y solo se renombra al terminar (y
+            # verificar): un fallo o una cancelación no deja un ISO a medias
+            # (ya reservado a tamaño completo) con el nombre definitivo
+            partial_paths = {
+                job: os.path.join(
+                    job.mount_point, "isos", iso_filename + PARTIAL_SUFFIX
+                )
+                for job in live_jobs
+            }
+            with self._span("Copiar ISO", iso=iso_filename) as span:
+                try:
+                    if fanout is None:
+                        job = live_jobs[0]
+                        on_chunk_for = self._make_create_progress_callbacks(
+                            [(job, None)], size_iso, text
+                        )
+                        result = self.copy_engine.copy(
+                            iso_path,
+                            partial_paths[job],
+                            on_chunk_for(job),
+                            self.chunk_tuner.probe_for(job.model),
+                            hasher,
+                        )
+                        outcomes = [(job, result, None)]
+                    else:
+                        targets = [
+                            FanOutTarget(job, partial_paths[job]) for job in live_jobs
+                        ]
+                        on_chunk_for = self._make_create_progress_callbacks(
+                            [(target.key, target) for target in targets],
+                            size_iso,
+                            text,
+                        )
+                        for target in targets:
+                            target.on_chunk = on_chunk_for(target.key)
+                        fanout.copy(iso_path, targets, hasher, token)
+                        outcomes = [(t.key, t.result, t.error) for t in targets]
+                except Exception as e:
+                    outcomes = [(job, None, e) for job in live_jobs]
+                finally:
+                    if hasher:
+                        source_digest = hasher.hexdigest()
+                span["bytes"] = size_iso * sum(
+                    error is None for _, _, error in outcomes
+                )
+            try:
+                token.check()
+                if hasher and any(error is None for _, _, error in outcomes):
+                    self.hash_cache.put(iso_path, src_stat, sha256=source_digest)
+                if verify:
+                    self.log(f"SHA-256 de {iso_filename}: {source_digest}")
+                    outcomes = self._verify_copied_iso(
+                        iso_filename, size_iso, source_digest, outcomes
+                    )
+                    token.check()
+                outcomes = [
+                    (job, result, error or self._commit_partial(partial_paths[job]))
+                    for job, result, error in outcomes
+                ]
+            finally:
+                # los que fallaron (o todos, si se canceló) no dejan restos
+                for partial_path in partial_paths.values():
+                    with contextlib.suppress(OSError):
+                        os.remove(partial_path)
+            record = {
+                "sha256": source_digest,
+                "fingerprint": quick_fingerprint(iso_path),
+                "boot": self.iso_boot_info(iso_path),
+            }
+            for job, result, error in outcomes:
+                if error is None:
+                    job.iso_filenames.append(iso_filename)
+                    job.iso_records[iso_filename] = record
+                    self.log(
+                        f"{iso_filename} copiado en {job.device_path} ({result.describe()})."
+                    )
+                    self.listener.device_status(job.device_path, None, "100%")
+                else:
+                    self.log(
+                        f"Error copiando {iso_filename} en {job.device_path}: {error}"
+                    )
+            tracker.update(size_iso)
+        # El menú de GRUB conserva el orden elegido por el usuario
+        menu_order = [os.path.basename(p) for p in iso_list_paths]
+        for job in jobs:
+            job.iso_filenames.sort(key=menu_order.index)
+
+    @staticmethod
+    def _commit_partial(partial_path):
+        """Da a un ISO ya copiado su nombre definitivo; devuelve el error, o None."""
+        try:
+            os.replace(partial_path, partial_path[: -len(PARTIAL_SUFFIX)])
+        except OSError as e:
+            return e
+        return None
+
+    def _verify_copied_iso(self, iso_filename, size_iso, source_digest, outcomes):
+        """Relee en cada USB (en paralelo) el .part recién copiado y lo compara con el origen."""
+        text = f"Verificando: {iso_filename}"
+        copied_jobs = [job for job, _, error in outcomes if error is None]
+        for job in copied_jobs:
+            job.copied_iso = 0
+        self.progress["create"].begin_step(text, size_iso)
+        on_chunk_for = self._make_create_progress_callbacks(
+            [(job, None) for job in copied_jobs], size_iso, text, count_total=False
+        )
+        errors = {}
+        trace = getattr(self._trace_local, "trace", None)
+
+        def verify(job):
+            self._trace_local.trace = trace
+            start_t = time.monotonic()
+            try:
+                with self._span("Verificar ISO", iso=iso_filename, bytes=size_iso):
+                    matches, mode = verify_file_direct(
+                        os.path.join(
+                            job.mount_point, "isos", iso_filename + PARTIAL_SUFFIX
+                        ),
+                        source_digest,
+                        on_chunk_for(job),
+                    )
+            except (OSError, OperationCancelled) as e:
+                errors[job] = e
+                return
+            if not matches:
+                errors[job] = Exception(
+                    "la verificación SHA-256 no coincide con el origen"
+                )
+                return
+            speed = size_iso / max(time.monotonic() - start_t, 0.001) / (1024 * 1024)
+            self.log(
+                f"{iso_filename} verificado en {job.device_path} ({mode}, {speed:.2f} MB/s)."
+            )
+
+        threads = [
+            threading.Thread(
+                target=verify, args=(job,), name=job.device_path, daemon=True
+            )
+            for job in copied_jobs
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [
+            (job, result, error if error is not None else errors.get(job))
+            for job, result, error in outcomes
+        ]
+
+    def _finalize_created_device(self, job):
+        if not job.iso_filenames:
+            raise Exception("No se copió ningún ISO.")
+        # 6. Generar grub.cfg
+        self._set_device_phase(job, "Generando grub.cfg")
+        grub_cfg_path = os.path.join(job.mount_point, "boot", "grub", "grub.cfg")
+        isos_dir = os.path.join(job.mount_point, "isos")
+        with self._span("Generar grub.cfg"):
+            manifest = UsbManifest(job.mount_point)
+            for name, record in job.iso_records.items():
+                manifest.add(name, os.path.join(isos_dir, name), **record)
+            with open(grub_cfg_path, "w") as f:
+                f.write(
+                    self.generate_grub_cfg_content(
+                        job.iso_filenames, isos_dir, manifest
+                    )
+                )
+            self._save_manifest(manifest)
+        self.log(f"grub.cfg generado en {job.device_path}.")
+
+        # 7. Desmontar
+        self._set_device_phase(job, "Desmontando (vaciando caché)")
+        with self._span("Desmontar (vaciar caché)"):
+            if not self.run_command(["umount", job.mount_point], check=False):
+                self.run_command(["sync"])
+                time.sleep(1)
+                self.run_command(["umount", "-lf", job.mount_point], check=False)
+        self._set_device_phase(job, "Completado", "100%")
+
+    def iso_boot_info(self, path, cache=True):
+        """Cómo arrancar el ISO (ver inspect_iso).
+
+        Con `cache` el resultado se busca y se guarda en la caché de ISOs de
+        origen; las copias del USB se inspeccionan con `cache=False`.
+        """
+        if cache:
+            info = self.hash_cache.get(path, "boot")
+            if info and info.get("format") == ISO_INSPECT_FORMAT:
+                return info
+        try:
+            st = os.stat(path)
+            info = inspect_iso(path)
+        except (OSError, ValueError) as e:
+            self.log(f"No se pudo inspeccionar {os.path.basename(path)}: {e}")
+            return None
+        if cache:
+            self.hash_cache.put(path, st, boot=info)
+        return info
+
+    def _grub_boot_lines(self, iso_filename, info):
+        if info and info["family"]:
+            self.log(f"{iso_filename}: arranque {info['family']} ({info['kernel']}).")
+            args = GRUB_FAMILY_ARGS[info["family"]].replace(
+                "{label}", info["label"].replace(" ", "\\x20")
+            )
+            return [
+                f"""    linux (loop){info['kernel']} {args}""",
+                f"""    initrd (loop){info['initrd']}""",
+            ]
+        if info and info["loopback_cfg"]:
+            # El propio ISO trae el menú para arrancar desde un fichero
+            self.log(f"{iso_filename}: usando su {info['loopback_cfg']}.")
+            return [
+                f"""    set iso_path="$isofile" """,
+                f"""    export iso_path""",
+                f"""    set root=(loop)""",
+                f"""    configfile {info['loopback_cfg']}""",
+            ]
+        self.log(f"{iso_filename}: sistema de arranque no reconocido.")
+        return [
+            f"""    echo "No se reconoce cómo arrancar este ISO." """,
+            f"""    echo "Presiona una tecla..." """,
+            f"""    read""",
+        ]
+
+    def _grub_menu_entry(self, iso_filename, isos_dir, manifest=None):
+        """Líneas del menuentry del ISO; se reutilizan las del manifiesto si vale.
+
+        El perfil de arranque sale del manifiesto (anotado al copiar desde el
+        origen); solo si falta se inspecciona la copia del USB, sin guardarla
+        en la caché de ISOs de origen.
+        """
+        iso_path = os.path.join(isos_dir, iso_filename)
+        recorded = manifest.entry(iso_filename, iso_path) if manifest else None
+        if recorded and recorded.get("grub_entry"):
+            return recorded["grub_entry"]
+        title = iso_filename.replace(".iso", "").replace("_", " ").replace("-", " ")
+        grub_iso_path = f"/isos/{iso_filename}"
+        info = recorded.get("boot") if recorded else None
+        if not info or info.get("format") != ISO_INSPECT_FORMAT:
+            info = self.iso_boot_info(iso_path, cache=False)
+
+        entry = [
+            f"""menuentry "Arrancar {title}" {{""",
+            f"""    set isofile="{grub_iso_path}" """,
+            f"""    echo "Cargando $isofile..." """,
+            f"""    loopback loop $isofile""",
+        ]
+        entry.extend(self._grub_boot_lines(iso_filename, info))
+        entry.append(f"""}}""")
+        if manifest is not None and os.path.exists(iso_path):
+            manifest.add(iso_filename, iso_path, boot=info, grub_entry=entry)
+        return entry
+
+    def generate_grub_cfg_content(self, iso_filenames_on_usb, isos_dir, manifest=None):
+        cfg_parts = [
+            "set timeout=20",
+            "set default=0",
+            "insmod part_msdos",
+            "insmod exfat",
+            "insmod all_video",
+            "insmod gfxterm",
+            "terminal_output gfxterm",
+            "loadfont unicode",
+            "",
+        ]
+
+        for iso_filename in iso_filenames_on_usb:
+            cfg_parts.extend(self._grub_menu_entry(iso_filename, isos_dir, manifest))
+            cfg_parts.append("")
+        return "\n".join(cfg_parts)
+
+    def _write_grub_cfg(self, grub_cfg, iso_filenames, isos_dir, manifest=None):
+        self.log("Actualizando grub.cfg...")
+        if iso_filenames:
+            with open(grub_cfg, "w") as f:
+                f.write(
+                    self.generate_grub_cfg_content(iso_filenames, isos_dir, manifest)
+                )
+            self.log("grub.cfg actualizado.")
+        else:
+            with open(grub_cfg, "w") as f:
+                f.write(
+                    "set timeout=5\nmenuentry 'No hay ISOs' {echo 'Añade ISOs a /isos/'; sleep 10}\n"
+                )
+            self.log("Directorio ISOs vacío; grub.cfg con mensaje.")
+        if manifest is not None:
+            manifest.retain(iso_filenames)
+            self._save_manifest(manifest)
+
+    def _save_manifest(self, manifest):
+        try:
+            manifest.save()
+        except OSError as e:
+            self.log(f"No se pudo guardar el índice de ISOs del USB: {e}")
+
+    def _record_copied_iso(self, manifest, name, dest_path, iso_path):
+        """Anota en el manifiesto un ISO recién copiado desde `iso_path`."""
+        manifest.add(
+            name,
+            dest_path,
+            sha256=self.hash_cache.lookup(iso_path)
+            or self.hash_cache.hash_file(iso_path),
+            fingerprint=quick_fingerprint(iso_path),
+            boot=self.iso_boot_info(iso_path),
+        )
+        self._save_manifest(manifest)
+
+    # ----- Gestión de un USB ya creado -----
+
+    @staticmethod
+    def list_isos_on_usb(isos_dir):
+        return sorted(f for f in os.listdir(isos_dir) if f.lower().endswith(".iso"))
+
+    def inspect_usb(self, device_partition1):
+        """Devuelve los ISOs de un USB creado con esta aplicación, o None si no lo es.
+
+        Lanza una excepción si la partición no se puede montar.
+        """
+        details = self.describe_usb(device_partition1)
+        return sorted(details) if details is not None else None
+
+    def describe_usb(self, device_partition1):
+        """Como inspect_usb, pero devuelve {nombre: {"size", "sha256", "family"}}.
+
+        Manda lo que hay en /isos: del manifiesto solo se toman las entradas
+        que siguen describiendo su fichero (mismo tamaño y mtime); los ISOs
+        sin entrada válida, y todos los de USB creados por versiones
+        anteriores (que se reconocen por grub.cfg y /isos), solo traen tamaño.
+        """
+        with self.mount_manager.session(device_partition1) as mount_point:
+            manifest = UsbManifest.load(mount_point)
+            grub_cfg_path = os.path.join(mount_point, "boot/grub/grub.cfg")
+            isos_dir = os.path.join(mount_point, "isos")
+            if manifest is None and not (
+                os.path.exists(grub_cfg_path) and os.path.isdir(isos_dir)
+            ):
+                return None
+            try:
+                names = self.list_isos_on_usb(isos_dir)
+            except FileNotFoundError:
+                names = []
+            details = {}
+            for name in names:
+                path = os.path.join(isos_dir, name)
+                entry = manifest.entry(name, path) if manifest else None
+                if entry is not None:
+                    details[name] = {
+                        "size": entry.get("size"),
+                        "sha256": entry.get("sha256"),
+                        "family": (entry.get("boot") or {}).get("family"),
+                    }
+                else:
+                    with contextlib.suppress(OSError):
+                        details[name] = {"size": os.path.getsize(path)}
+            return details
+
+    def _check_free_space(self, mount_point, bytes_to_copy, freed):
+        available = shutil.disk_usage(mount_point).free + freed
+        if bytes_to_copy > available:
+            raise Exception(
+                f"Espacio insuficiente: se necesitan {bytes_to_copy / 1024**3:.2f} GiB "
+                f"y habría {available / 1024**3:.2f} GiB libres."
+            )
+
+    def fragmentation_report(self, device_partition1):
+        """Devuelve [(nombre, bytes, fragmentos)] de los ISOs del USB.
+
+        `fragmentos` es None si el sistema de ficheros no permite averiguarlo.
+        """
+        report = []
+        with self.mount_manager.session(device_partition1) as mount_point:
+            isos_dir = os.path.join(mount_point, "isos")
+            for name in self.list_isos_on_usb(isos_dir):
+                path = os.path.join(isos_dir, name)
+                try:
+                    fragments = count_fragments(path)
+                except OSError as e:
+                    self.log(f"No se pudo leer el mapa de {name}: {e}")
+                    fragments = None
+                report.append((name, os.path.getsize(path), fragments))
+        return report
+
+    @staticmethod
+    def _partial_bytes(isos_dir, names):
+        """Bytes ocupados por copias parciales de `names` (se reutilizan o se borran)."""
+        return sum(
+            os.path.getsize(os.path.join(isos_dir, name + PARTIAL_SUFFIX))
+            for name in names
+            if os.path.exists(os.path.join(isos_dir, name + PARTIAL_SUFFIX))
+        )
+
+    def _remove_stale_partials(self, isos_dir, keep_names):
+        """Borra las copias parciales de ISOs que ya no se van a copiar."""
+        for entry in os.listdir(isos_dir):
+            for suffix in (PARTIAL_SUFFIX, CHECKPOINT_SUFFIX):
+                if entry.endswith(suffix) and entry[: -len(suffix)] not in keep_names:
+                    os.remove(os.path.join(isos_dir, entry))
+                    if suffix == PARTIAL_SUFFIX:
+                        self.log(
+                            f"Copia parcial de {entry[: -len(suffix)]} descartada."
+                        )
+
+    def apply_changes(
+        self, device_path, device_partition1, adds, removes, verify=False
+    ):
+        """Aplica en una única sesión de montaje una lista de altas [(nombre, ruta)]
+        y bajas [nombre]: borra, copia, regenera grub.cfg una vez y desmonta.
+
+        Devuelve un ManageResult; los ISOs que fallan quedan en `failed`.
+        """
+        result = ManageResult()
+        result.message = "Aplicación de cambios fallida."
+        token = self.tokens["manage"]
+        token.reset()
+        with self._traced("apply"):
+            try:
+                with self.mount_manager.session(device_partition1) as mount_point:
+                    isos_dir = os.path.join(mount_point, "isos")
+                    grub_cfg = os.path.join(mount_point, "boot/grub/grub.cfg")
+                    if not os.path.isdir(isos_dir):
+                        self.run_command(["mkdir", "-p", isos_dir])
+                    # parciales de altas abandonadas: liberan espacio antes de medirlo
+                    self._remove_stale_partials(isos_dir, {name for name, _ in adds})
+
+                    self._check_free_space(
+                        mount_point,
+                        sum(os.path.getsize(path) for _, path in adds),
+                        sum(
+                            os.path.getsize(os.path.join(isos_dir, name))
+                            for name in set(removes) | {name for name, _ in adds}
+                            if os.path.exists(os.path.join(isos_dir, name))
+                        )
+                        + self._partial_bytes(isos_dir, [name for name, _ in adds]),
+                    )
+                    manifest = UsbManifest.load(mount_point) or UsbManifest(mount_point)
+
+                    # Primero los borrados, para liberar espacio antes de copiar
+                    for name in removes:
+                        if token.cancelled:
+                            result.cancelled = True
+                            break
+                        path_to_rm = os.path.join(isos_dir, name)
+                        if os.path.exists(path_to_rm):
+                            with self._span("Borrar ISO", iso=name):
+                                os.remove(path_to_rm)
+                            self.log(f"ISO {name} eliminado.")
+                        else:
+                            self.log(f"Advertencia: {name} no encontrado.")
+                        manifest.remove(name)
+                        self._save_manifest(manifest)
+                        result.removed.append(name)
+
+                    probe_model = self.device_models.get(device_path)
+                    adds = sorted(
+                        adds, key=lambda add: os.path.getsize(add[1]), reverse=True
+                    )
+                    for idx, (name, iso_path) in enumerate(adds):
+                        if result.cancelled:
+                            break
+                        text = f"Copiando ({idx + 1}/{len(adds)}): {name}"
+                        dest_path = os.path.join(isos_dir, name)
+                        try:
+                            self._copy_iso_for_manage(
+                                iso_path, dest_path, text, probe_model, verify
+                            )
+                            self._record_copied_iso(manifest, name, dest_path, iso_path)
+                            result.added.append(name)
+                        except OperationCancelled:
+                            result.cancelled = True
+                            self.log(
+                                f"Copia de {name} interrumpida; se podrá reanudar."
+                            )
+                        except Exception as e:
+                            self.log(f"Error copiando {name}: {e}")
+                            result.failed.append(name)
+
+                    current_isos = self.list_isos_on_usb(isos_dir)
+                    with self._span("Generar grub.cfg"):
+                        self._write_grub_cfg(grub_cfg, current_isos, isos_dir, manifest)
+                    result.names_on_usb = current_isos
+                result.message = (
+                    f"{'Cancelado tras aplicar' if result.cancelled else 'Cambios aplicados'}: "
+                    f"{len(result.added)} añadidos, {len(result.removed)} quitados."
+                )
+                if result.failed:
+                    result.message += f" Fallaron: {', '.join(result.failed)}."
+                self.log(result.message)
+            except Exception as e:
+                result.error = e
+                self.log(f"Error aplicando cambios en el USB: {e}")
+        return result
+
+    def sync(self, device_path, device_partition1, desired_paths, verify=False):
+        """Deja /isos igual que la lista deseada copiando y borrando solo la diferencia.
+
+        Pide confirmación con `listener.confirm` antes de tocar el USB.
+        """
+        result = ManageResult()
+        result.message = "Sincronización fallida."
+        token = self.tokens["manage"]
+        token.reset()
+        with self._traced("sync"):
+            try:
+                with self.mount_manager.session(device_partition1) as mount_point:
+                    isos_dir = os.path.join(mount_point, "isos")
+                    grub_cfg = os.path.join(mount_point, "boot/grub/grub.cfg")
+                    if not os.path.isdir(isos_dir):
+                        self.run_command(["mkdir", "-p", isos_dir])
+
+                    manifest = UsbManifest.load(mount_point) or UsbManifest(mount_point)
+                    self.log("Comparando los ISOs del USB con la lista...")
+                    to_copy, to_delete, unchanged, unverified = plan_iso_sync(
+                        desired_paths, isos_dir, manifest, self.hash_cache
+                    )
+                    result.names_on_usb = self.list_isos_on_usb(isos_dir)
+                    self.log(
+                        f"Sincronización: {len(to_copy)} a copiar, {len(to_delete)} a borrar, "
+                        f"{len(unchanged)} sin cambios, {len(unverified)} por comprobar."
+                    )
+                    if not to_copy and not to_delete and not unverified:
+                        result.message = "El USB ya está sincronizado."
+                        self.log(result.message)
+                        return result
+
+                    self._check_free_space(
+                        mount_point,
+                        sum(os.path.getsize(p) for p in to_copy),
+                        sum(
+                            os.path.getsize(os.path.join(isos_dir, name))
+                            for name in to_delete
+                        )
+                        + sum(
+                            os.path.getsize(os.path.join(isos_dir, os.path.basename(p)))
+                            for p in to_copy
+                            if os.path.exists(
+                                os.path.join(isos_dir, os.path.basename(p))
+                            )
+                        )
+                        + self._partial_bytes(
+                            isos_dir, [os.path.basename(p) for p in to_copy]
+                        ),
+                    )
+                    summary = "\n".join(
+                        [f"+ {os.path.basename(p)}" for p in to_copy]
+                        + [f"- {name}" for name in to_delete]
+                        + [f"? {os.path.basename(p)}" for p in unverified]
+                    )
+                    if unverified:
+                        summary += (
+                            "\n\n? = se comprobará con SHA-256 y se copiará de nuevo "
+                            "solo si no coincide."
+                        )
+                    if not self.listener.confirm(
+                        "Confirmar Sincronización",
+                        f"Cambios a aplicar en el USB:\n\n{summary}",
+                    ):
+                        result.message = "Sincronización cancelada."
+                        self.log(result.message)
+                        return result
+
+                    result.names_on_usb = None
+                    for src_path in unverified:
+                        if token.cancelled:
+                            result.cancelled = True
+                            break
+                        name = os.path.basename(src_path)
+                        self.log(f"Comprobando {name} (SHA-256)...")
+                        with self._span("Comprobar ISO", iso=name):
+                            matches = check_iso_digests(
+                                src_path,
+                                os.path.join(isos_dir, name),
+                                manifest,
+                                self.hash_cache,
+                            )
+                        if matches:
+                            unchanged.append(name)
+                        else:
+                            self.log(f"{name} ha cambiado; se copiará de nuevo.")
+                            to_copy.append(src_path)
+                    if unverified:
+                        self._save_manifest(manifest)
+                    self._remove_stale_partials(
+                        isos_dir, {os.path.basename(p) for p in to_copy}
+                    )
+                    for name in to_delete:
+                        if token.cancelled:
+                            result.cancelled = True
+                            break
+                        with self._span("Borrar ISO", iso=name):
+                            os.remove(os.path.join(isos_dir, name))
+                        self.log(f"ISO {name} eliminado.")
+                        manifest.remove(name)
+                        self._save_manifest(manifest)
+                        result.removed.append(name)
+
+                    probe_model = self.device_models.get(device_path)
+                    to_copy.sort(key=os.path.getsize, reverse=True)
+                    for idx, iso_path in enumerate(to_copy):
+                        if result.cancelled:
+                            break
+                        iso_name = os.path.basename(iso_path)
+                        text = f"Sincronizando ({idx + 1}/{len(to_copy)}): {iso_name}"
+                        dest_path = os.path.join(isos_dir, iso_name)
+                        try:
+                            self._copy_iso_for_manage(
+                                iso_path, dest_path, text, probe_model, verify
+                            )
+                            self._record_copied_iso(
+                                manifest, iso_name, dest_path, iso_path
+                            )
+                            result.added.append(iso_name)
+                        except OperationCancelled:
+                            result.cancelled = True
+                            self.log(
+                                f"Copia de {iso_name} interrumpida; se podrá reanudar."
+                            )
+                        except Exception as e:
+                            self.log(f"Error copiando {iso_name}: {e}")
+                            result.failed.append(iso_name)
+
+                    # Un único grub.cfg con los ISOs deseados que están en el USB
+                    present_names = [
+                        os.path.basename(p)
+                        for p in desired_paths
+                        if os.path.basename(p) not in result.failed
+                        and os.path.exists(os.path.join(isos_dir, os.path.basename(p)))
+                    ]
+                    with self._span("Generar grub.cfg"):
+                        self._write_grub_cfg(
+                            grub_cfg, present_names, isos_dir, manifest
+                        )
+                    result.names_on_usb = self.list_isos_on_usb(isos_dir)
+                result.message = (
+                    f"{'Sincronización cancelada tras' if result.cancelled else 'USB sincronizado:'} "
+                    f"{len(result.added)} copiados, {len(result.removed)} borrados."
+                )
+                if result.failed:
+                    result.message += f" Fallaron: {', '.join(result.failed)}."
+                self.log(result.message)
+            except Exception as e:
+                result.error = e
+                self.log(f"Error sincronizando el USB: {e}")
+        return result
+
+    def _make_manage_progress_cb(self, total, text, copied=0):
+        """Empieza `text` como paso de gestión y devuelve on_chunk(n) para su progreso."""
+        tracker = self.progress["manage"]
+        token = self.tokens["manage"]
+        tracker.begin_step(text, total, copied)
+
+        def on_chunk(n):
+            nonlocal copied
+            token.check()
+            copied += n
+            tracker.update(copied)
+
+        return on_chunk
+
+    def _copy_iso_for_manage(self, iso_path, dest_path, text, model, verify=False):
+        """Copia un ISO al USB montado informando del progreso de gestión.
+
+        La copia es reanudable (ver ResumableCopy): si se interrumpe, el
+        parcial se conserva y el siguiente intento continúa donde se quedó.
+        Si la caché no conoce el SHA-256 del origen, se calcula durante la
+        copia; con `verify` después se relee el destino sin caché para
+        compararlo.
+        """
+        iso_name = os.path.basename(iso_path)
+        src_stat = os.stat(iso_path)
+        size_iso = src_stat.st_size
+        copy = ResumableCopy(iso_path, dest_path)
+        offset = copy.resume_offset()
+        if offset:
+            self.log(f"Reanudando {iso_name} desde {format_size(offset)}.")
+        if os.path.exists(dest_path):
+            # se sobrescribe: liberar el espacio antes de copiar
+            os.remove(dest_path)
+        source_digest = self.hash_cache.lookup(iso_path)
+        hasher = StreamHasher() if not source_digest else None
+        try:
+            with self._span("Copiar ISO", iso=iso_name) as span:
+                result = copy.run(
+                    self.copy_engine,
+                    offset,
+                    self._make_manage_progress_cb(size_iso, text, offset),
+                    self.chunk_tuner.probe_for(model),
+                    hasher,
+                )
+                span["bytes"] = result.bytes_copied
+                span["method"] = result.method
+        finally:
+            if hasher:
+                source_digest = hasher.hexdigest()
+        if hasher:
+            self.hash_cache.put(iso_path, src_stat, sha256=source_digest)
+        self.log(f"ISO {iso_name} copiado ({result.describe()}).")
+        if verify:
+            self.log(f"SHA-256 de {iso_name}: {source_digest}")
+            start_t = time.monotonic()
+            with self._span("Verificar ISO", iso=iso_name, bytes=size_iso):
+                matches, mode = verify_file_direct(
+                    copy.partial_path,
+                    source_digest,
+                    self._make_manage_progress_cb(size_iso, f"Verificando: {iso_name}"),
+                )
+            if not matches:
+                copy.discard()
+                raise Exception(
+                    f"La verificación de {iso_name} falló: el contenido del USB no coincide con el origen."
+                )
+            speed = size_iso / max(time.monotonic() - start_t, 0.001) / (1024 * 1024)
+            self.log(f"{iso_name} verificado ({mode}, {speed:.2f} MB/s).")
+        copy.commit()
+        self.progress["manage"].update(size_iso)
+        return result